@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+    This file is part of BOMtools.
+
+    BOMtools is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    BOMTools is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with BOMTools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'srodgers'
+
+#
+# Measure concurrent read throughput for each [database] setting in bommgr.conf.
+#
+# Several reader processes look up random part numbers while one writer process
+# keeps changing titles, the same as the merge scripts running while partmgr is in use.
+#
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import bommdb
+import partsdb
+
+# Settings to compare. Each entry is a name, the [database] settings, and whether the writer runs.
+
+profiles = [
+    ('default', {}, True),
+    ('wal', {'journal_mode': 'wal'}, True),
+    ('wal, synchronous=normal', {'journal_mode': 'wal', 'synchronous': 'normal'}, True),
+    ('wal, cache_size=-16000', {'journal_mode': 'wal', 'cache_size': '-16000'}, True),
+    ('wal, mmap_size=256M', {'journal_mode': 'wal', 'mmap_size': '268435456'}, True),
+    ('wal, merge_open=ro', {'journal_mode': 'wal', 'merge_open': 'ro'}, True),
+    ('merge_open=immutable, no writer', {'merge_open': 'immutable'}, False),
+]
+
+
+def makedb(path, numparts):
+    """
+    Create a database with numparts part numbers
+    """
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE pndesc (PartNumber TEXT,Description TEXT)')
+    conn.execute('CREATE TABLE pnmpn (PartNumber TEXT,Manufacturer TEXT, MPN TEXT, DataSheet TEXT)')
+    conn.execute('CREATE TABLE mlist (MFGId TEXT,MFGName TEXT)')
+    conn.execute('CREATE TABLE version (major INTEGER,minor INTEGER)')
+    conn.execute('INSERT INTO version (major,minor) VALUES(?,?)', [0, 1])
+    conn.execute('INSERT INTO mlist (MFGId,MFGName) VALUES (?,?)', ['M0000000', 'Open Market'])
+    conn.executemany('INSERT INTO pndesc (PartNumber,Description) VALUES (?,?)',
+                     (('{:06d}-101'.format(800000 + i), 'PART {}'.format(i)) for i in range(numparts)))
+    conn.executemany('INSERT INTO pnmpn (PartNumber,Manufacturer,MPN) VALUES (?,?,?)',
+                     (('{:06d}-101'.format(800000 + i), 'M0000000', 'MPN{}'.format(i)) for i in range(numparts)))
+    conn.commit()
+    conn.close()
+    bommdb.BOMdb(path).migrate()
+
+
+def reader(path, options, numparts, seconds, results):
+    """
+    Look up random part numbers until time runs out, then report the number of lookups and lock errors
+    """
+    # Opened the way the merge scripts open it
+    conn = partsdb.open_db(path, options)
+    lookups = 0
+    locked = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pn = '{:06d}-101'.format(800000 + random.randrange(numparts))
+        try:
+            conn.execute('SELECT d.Description,p.MPN FROM pndesc d JOIN pnmpn p ON p.PartNumber = d.PartNumber '
+                         'WHERE d.PartNumber = ?', [pn]).fetchall()
+            lookups += 1
+        except sqlite3.OperationalError:
+            locked += 1
+    results.put((lookups, locked))
+
+
+def writer(path, options, numparts, stop):
+    """
+    Change part titles one transaction at a time until told to stop
+    """
+    db = bommdb.BOMdb(path, options=options)
+    i = 0
+    while not stop.is_set():
+        pn = '{:06d}-101'.format(800000 + random.randrange(numparts))
+        try:
+            db.update_title(pn, 'PART {} REV {}'.format(pn, i))
+        except sqlite3.OperationalError:
+            db.conn.rollback()
+        i += 1
+
+
+def run(path, options, use_writer, numparts, numreaders, seconds):
+    """
+    Run one profile
+    :return: Tuple containing (lookups per second, lock errors)
+    """
+    # The journal mode is stored in the database file, so set it before anything else opens it
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode={}'.format(options.get('journal_mode', 'delete'))).fetchall()
+    conn.close()
+
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=reader, args=(path, options, numparts, seconds, results))
+             for i in range(numreaders)]
+    if use_writer:
+        wproc = multiprocessing.Process(target=writer, args=(path, options, numparts, stop))
+        wproc.start()
+    for proc in procs:
+        proc.start()
+    totals = [results.get() for proc in procs]
+    for proc in procs:
+        proc.join()
+    if use_writer:
+        stop.set()
+        wproc.join()
+    return (sum(t[0] for t in totals) / seconds, sum(t[1] for t in totals))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrent read throughput benchmark', prog='benchconn.py')
+    parser.add_argument('--parts', type=int, default=20000, help='Number of part numbers in the test database')
+    parser.add_argument('--readers', type=int, default=4, help='Number of reader processes')
+    parser.add_argument('--seconds', type=float, default=2.0, help='Seconds to run each profile')
+    parser.add_argument('--specdb', help='Directory to create the test database in')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.specdb) as tmpdir:
+        path = os.path.join(tmpdir, 'bench.db')
+        makedb(path, args.parts)
+        print('{0:<35}  {1:>14}  {2:>12}'.format('Settings', 'Lookups/sec', 'Lock errors'))
+        for (name, options, use_writer) in profiles:
+            (rate, locked) = run(path, options, use_writer, args.parts, args.readers, args.seconds)
+            print('{0:<35}  {1:>14.0f}  {2:>12d}'.format(name, rate, locked))
+
+    sys.exit(0)
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+    This file is part of BOMtools.
+
+    BOMtools is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    BOMTools is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with BOMTools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'srodgers'
+
+#
+# Micro-benchmarks for every public BOMdb method and the main bommgr.py commands.
+#
+# The benchmarks run on a scratch copy of a database made by synthdb.py, or of the database given
+# with --specdb, so the methods which change the database can be timed too. Results are printed
+# as operations per second and may be written to a JSON file and compared with an earlier run.
+#
+
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import bommdb
+import synthdb
+
+# Parts, sources and manufacturers added by the benchmarks which change the database
+batchSize = 100
+maxNew = 20000
+
+
+class Fixture:
+    """
+    Sample keys from the database and the state shared by the benchmarks which change it
+    """
+    def __init__(self, db, scratch, seed):
+        self.rnd = random.Random(seed)
+        self.scratch = scratch
+        rows = db.get_pnmpn()
+        sample = self.rnd.sample(rows, min(1000, len(rows)))
+        self.sources = [(row[0], row[1], row[2]) for row in sample]
+        self.pns = [source[0] for source in self.sources]
+        self.mpns = [source[2] for source in self.sources]
+        self.mids = [item['mid'] for item in db.get_mid_name_list()]
+        self.mfgrs = db.get_mfgr_list()
+        self.descs = [desc for (pn, desc) in self.rnd.sample(db.get_parts(), min(1000, len(self.pns)))]
+        self.marker = db.change_marker()
+        # Claimed in advance so the benchmarks which add parts don't time the allocator
+        self.newpns = db.allocate_pns(maxNew)
+        self.newmids = db.allocate_mids(maxNew)
+        self.added = []
+        self.altsources = []
+        self.addedmids = []
+
+    def pick(self, items, i):
+        return items[i % len(items)]
+
+
+class Exhausted(Exception):
+    """
+    Raised by a benchmark which has used up what the earlier ones added
+    """
+    pass
+
+
+def mutating(op):
+    """
+    Wrap a benchmark which works through the fixture lists, running out of items ends it
+    """
+    def run(i):
+        try:
+            op(i)
+        except IndexError:
+            raise(Exhausted)
+    return run
+
+
+def shares(items, count):
+    """
+    Split what the benchmarks which add rows left in a list between the ones which remove them
+    :param items: List of rows added
+    :param count: Number of benchmarks removing them
+    :return: Function returning the list for the n'th of them. The split is made the first time it's called.
+    """
+    chunks = []
+
+    def share(n):
+        if not chunks:
+            size = len(items) // count
+            chunks.extend(items[k * size:(k + 1) * size] for k in range(count))
+        return chunks[n]
+    return share
+
+
+def consume(rows):
+    collections.deque(rows, maxlen=0)
+
+
+def benchmarks(db, fx):
+    """
+    Return the list of (name, operation) tuples. Each operation is called with 0, 1, 2, ...
+    They run in this order, the later ones change the database. Names are the method name, optionally
+    followed by a note on the arguments.
+    """
+    pick = fx.pick
+    sources = shares(fx.altsources, 2)
+    added = shares(fx.added, 5)
+    mids = shares(fx.addedmids, 2)
+    like = fx.descs[0].split(',')[0] + ',%'
+    return [
+        ('schema_version', lambda i: db.schema_version()),
+        ('latest_schema_version', lambda i: db.latest_schema_version()),
+        ('migrate', lambda i: db.migrate()),
+        ('has_changelog', lambda i: db.has_changelog()),
+        ('has_fulltext', lambda i: db.has_fulltext()),
+        ('has_trigrams', lambda i: db.has_trigrams()),
+        ('has_mpn_keys', lambda i: db.has_mpn_keys()),
+        ('mfg_table_has_datasheet_col', lambda i: db.mfg_table_has_datasheet_col()),
+        ('in_transaction', lambda i: db.in_transaction()),
+        ('cache_stats', lambda i: db.cache_stats()),
+        ('clear_cache', lambda i: db.clear_cache()),
+        ('change_marker', lambda i: db.change_marker()),
+        ('changelog_start', lambda i: db.changelog_start()),
+        ('get_parts', lambda i: db.get_parts()),
+        ('get_parts like', lambda i: db.get_parts(like)),
+        ('get_parts_containing', lambda i: db.get_parts_containing('REMOVE')),
+        ('get_dangling_sources', lambda i: db.get_dangling_sources()),
+        ('get_unused_mfgrs', lambda i: db.get_unused_mfgrs()),
+        ('get_orphan_sources', lambda i: db.get_orphan_sources()),
+        ('get_parts_without_sources', lambda i: db.get_parts_without_sources()),
+        ('get_duplicate_sources', lambda i: db.get_duplicate_sources()),
+        ('get_duplicate_descriptions', lambda i: db.get_duplicate_descriptions()),
+        ('get_duplicate_keys', lambda i: db.get_duplicate_keys()),
+        ('get_dangling_sources since', lambda i: db.get_dangling_sources(since=max(fx.marker - 1000, 0))),
+        ('get_duplicate_sources since', lambda i: db.get_duplicate_sources(since=max(fx.marker - 1000, 0))),
+        ('get_unused_mfgrs since', lambda i: db.get_unused_mfgrs(since=max(fx.marker - 1000, 0))),
+        ('get_duplicate_descriptions since', lambda i: db.get_duplicate_descriptions(since=max(fx.marker - 1000, 0))),
+        ('get_parts_with_sources like', lambda i: consume(db.get_parts_with_sources(like))),
+        ('export_rows', lambda i: consume(db.export_rows())),
+        ('export_rows since', lambda i: consume(db.export_rows(since=max(fx.marker - 1000, 0)))),
+        ('deleted_since', lambda i: db.deleted_since(max(fx.marker - 1000, 0))),
+        ('get_setting', lambda i: db.get_setting('bench_setting')),
+        ('get_pnmpn', lambda i: db.get_pnmpn()),
+        ('get_mfgrs', lambda i: db.get_mfgrs()),
+        ('get_mfgr_list', lambda i: db.get_mfgr_list()),
+        ('get_mid_name_list', lambda i: db.get_mid_name_list()),
+        ('lookup_pn', lambda i: db.lookup_pn(pick(fx.pns, i))),
+        ('lookup_pns x100', lambda i: db.lookup_pns(fx.pns[:batchSize])),
+        ('lookup_mpn_by_pn', lambda i: db.lookup_mpn_by_pn(pick(fx.pns, i))),
+        ('lookup_mpn_by_pns x100', lambda i: db.lookup_mpn_by_pns(fx.pns[:batchSize])),
+        ('lookup_mpn', lambda i: db.lookup_mpn(pick(fx.mpns, i))),
+        ('lookup_mpns x100', lambda i: db.lookup_mpns(fx.mpns[:batchSize])),
+        ('lookup_mpn_canonical', lambda i: db.lookup_mpn_canonical(pick(fx.mpns, i).lower())),
+        ('lookup_mpns_canonical x100', lambda i: db.lookup_mpns_canonical(fx.mpns[:batchSize])),
+        ('lookup_mpn_like', lambda i: db.lookup_mpn_like(pick(fx.mpns, i)[:6] + '%')),
+        ('lookup_part_by_pn_mpn', lambda i: db.lookup_part_by_pn_mpn(pick(fx.pns, i), pick(fx.mpns, i))),
+        ('lookup_mfg_by_pn_mpn', lambda i: db.lookup_mfg_by_pn_mpn(pick(fx.pns, i), pick(fx.mpns, i))),
+        ('lookup_mfg', lambda i: db.lookup_mfg(pick(fx.mfgrs, i))),
+        ('lookup_mfg_by_id', lambda i: db.lookup_mfg_by_id(pick(fx.mids, i))),
+        ('search', lambda i: db.search(' '.join(pick(fx.descs, i).split(',')[:2]))),
+        ('similar_parts', lambda i: db.similar_parts(pick(fx.descs, i))),
+        ('last_pn', lambda i: db.last_pn()),
+        ('last_mid', lambda i: db.last_mid()),
+        ('next_pn', lambda i: db.next_pn()),
+        ('allocate_pns', lambda i: db.allocate_pns()),
+        ('allocate_tabulated_pn', lambda i: db.allocate_tabulated_pn(pick(fx.pns, i), claim=False)),
+        ('allocate_mids', lambda i: db.allocate_mids()),
+        ('write_snapshot', lambda i: db.write_snapshot(os.path.join(fx.scratch, 'bench.snap'))),
+        ('db_stats', lambda i: db.db_stats()),
+        ('query_plan', lambda i: db.query_plan('SELECT * FROM pndesc WHERE PartNumber = ?', [pick(fx.pns, i)])),
+        ('optimize', lambda i: db.optimize()),
+        ('transaction', lambda i: empty_transaction(db)),
+        ('set_setting', lambda i: db.set_setting('bench_setting', i)),
+        ('add_pn', mutating(lambda i: add_pn(db, fx, i))),
+        ('add_pns x100', mutating(lambda i: add_pns(db, fx, i))),
+        ('add_mpn', mutating(lambda i: add_mpn(db, fx, i))),
+        ('add_mpns x100', mutating(lambda i: add_mpns(db, fx, i))),
+        ('add_mfg_to_mlist', mutating(lambda i: add_mfg(db, fx, i))),
+        ('add_mfgs_to_mlist x100', mutating(lambda i: add_mfgs(db, fx, i))),
+        ('update_title', lambda i: db.update_title(pick(fx.pns, i), 'BENCH TITLE {}'.format(i))),
+        ('update_mfg', mutating(lambda i: db.update_mfg(fx.addedmids[i], 'Renamed {}'.format(i)))),
+        ('update_datasheet', mutating(lambda i: update_datasheet(db, fx, i))),
+        ('update_mpn', mutating(lambda i: update_mpn(db, fx, i))),
+        ('update_mid', mutating(lambda i: update_mid(db, fx, i))),
+        ('remove_sources x100', mutating(lambda i: db.remove_sources(pop_batch(sources(0))))),
+        ('remove_source', mutating(lambda i: db.remove_source(*sources(1).pop()))),
+        ('remove_duplicate_keys x100', lambda i: db.remove_duplicate_keys(fx.pns[:batchSize], fx.mids[:batchSize])),
+        ('remove_duplicate_sources x100', lambda i: db.remove_duplicate_sources(fx.sources[:batchSize])),
+        ('merge_parts x50', mutating(lambda i: merge_parts(db, pop_batch(added(4))))),
+        ('remove_pnmpn_records x100', mutating(lambda i: db.remove_pnmpn_records(pop_batch(added(0))))),
+        ('remove_pnmpn_record', mutating(lambda i: db.remove_pnmpn_record(added(1).pop()))),
+        ('remove_part_numbers x100', mutating(lambda i: db.remove_part_numbers(pop_batch(added(2))))),
+        ('remove_part_number', mutating(lambda i: db.remove_part_number(added(3).pop(), dryrun=False))),
+        ('remove_mids x100', mutating(lambda i: db.remove_mids(pop_batch(mids(0))))),
+        ('remove_mid', mutating(lambda i: db.remove_mid(mids(1).pop()))),
+        ('prune_changelog', lambda i: db.prune_changelog()),
+    ]
+
+
+def empty_transaction(db):
+    with db.transaction():
+        pass
+
+
+def pop_batch(items):
+    if len(items) < batchSize:
+        raise(IndexError)
+    return [items.pop() for j in range(batchSize)]
+
+
+def merge_parts(db, pns):
+    db.merge_parts([(pns[j + 1], pns[j]) for j in range(0, len(pns), 2)])
+
+
+def add_pn(db, fx, i):
+    pn = fx.newpns.pop()
+    db.add_pn(pn, 'BENCH PART {}'.format(i), 'M0000000', 'BENCH-{}'.format(pn))
+    fx.added.append(pn)
+
+
+def add_pns(db, fx, i):
+    pns = pop_batch(fx.newpns)
+    db.add_pns([(pn, 'BENCH PART {}'.format(pn)) for pn in pns])
+    fx.added.extend(pns)
+
+
+def add_mpn(db, fx, i):
+    source = (fx.added[i], fx.mids[1 + i % (len(fx.mids) - 1)], 'BENCHALT-{}'.format(i))
+    db.add_mpn(*source)
+    fx.altsources.append(source)
+
+
+def add_mpns(db, fx, i):
+    start = len(fx.altsources)
+    sources = [(fx.added[j], 'M0000000', 'BENCHALT-{}'.format(j)) for j in range(start, start + batchSize)]
+    db.add_mpns(sources)
+    fx.altsources.extend(sources)
+
+
+def add_mfg(db, fx, i):
+    mid = fx.newmids.pop()
+    db.add_mfg_to_mlist('Bench Manufacturer {}'.format(mid), mid)
+    fx.addedmids.append(mid)
+
+
+def add_mfgs(db, fx, i):
+    mids = pop_batch(fx.newmids)
+    db.add_mfgs_to_mlist([('Bench Manufacturer {}'.format(mid), mid) for mid in mids])
+    fx.addedmids.extend(mids)
+
+
+def update_datasheet(db, fx, i):
+    (pn, mid, mpn) = fx.altsources[i]
+    db.update_datasheet(pn, mid, mpn, 'datasheets/{}.pdf'.format(mpn))
+
+
+def update_mpn(db, fx, i):
+    (pn, mid, mpn) = fx.altsources[i]
+    db.update_mpn(pn, mpn, mpn + 'U', mid)
+    fx.altsources[i] = (pn, mid, mpn + 'U')
+
+
+def update_mid(db, fx, i):
+    (pn, mid, mpn) = fx.altsources[i]
+    newmid = 'M0000000' if mid != 'M0000000' else fx.mids[1]
+    db.update_mid(pn, mpn, mid, newmid)
+    fx.altsources[i] = (pn, newmid, mpn)
+
+
+def cli_benchmarks(dbpath, fx):
+    """
+    Return the list of (name, bommgr.py arguments) for the command line benchmarks
+    """
+    return [
+        ('bommgr.py list parts', ['list', 'parts']),
+        ('bommgr.py query pn', ['query', 'pn', fx.pns[0]]),
+        ('bommgr.py nextpn', ['nextpn']),
+    ]
+
+
+def timed(op, seconds):
+    """
+    Call op(0), op(1), ... until the time is up or it raises Exhausted
+    :return: Tuple containing (operations, seconds taken)
+    """
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while True:
+        try:
+            op(count)
+        except Exhausted:
+            break
+        count += 1
+        now = time.perf_counter()
+        if now >= end:
+            break
+    return (count, time.perf_counter() - start)
+
+
+def git_commit():
+    """
+    Return the commit the benchmarks were run on, or None if it can't be found
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(name, ops, seconds, previous):
+    rate = ops / seconds if seconds > 0 else 0.0
+    change = ''
+    if previous and previous.get('ops_per_sec'):
+        change = '{:+.0%}'.format(rate / previous['ops_per_sec'] - 1)
+    print('{0:<35}  {1:>9}  {2:>14.1f}  {3:>8}'.format(name, ops, rate, change))
+    return {'ops': ops, 'seconds': round(seconds, 6), 'ops_per_sec': round(rate, 3)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BOMdb micro-benchmarks', prog='benchdb.py')
+    parser.add_argument('--parts', default='10k',
+                        help='Number of part numbers in the generated database, or one of ' + ', '.join(synthdb.sizes))
+    parser.add_argument('--specdb', help='Benchmark a copy of this database instead of a generated one')
+    parser.add_argument('--seconds', type=float, default=0.5, help='Seconds to run each benchmark')
+    parser.add_argument('--cache', action='store_true', help='Turn the BOMdb lookup cache on')
+    parser.add_argument('--only', help='Only run the benchmarks whose names contain this text')
+    parser.add_argument('--no-cli', action='store_true', help='Skip the bommgr.py command benchmarks')
+    parser.add_argument('--json', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Show the change from the results in this JSON file')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+
+    try:
+        numparts = synthdb.sizes.get(args.parts) or int(args.parts)
+    except ValueError:
+        print('Error: --parts must be a number or one of {}'.format(', '.join(synthdb.sizes)))
+        sys.exit(2)
+    if args.specdb is not None and not os.path.isfile(args.specdb):
+        print('Error: Database file {} doesn\'t exist'.format(args.specdb))
+        sys.exit(2)
+    previous = {}
+    if args.compare is not None:
+        try:
+            with open(args.compare) as f:
+                previous = json.load(f)['results']
+        except (OSError, ValueError, KeyError) as e:
+            print('Error: Can\'t read {}: {}'.format(args.compare, e))
+            sys.exit(2)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, 'bench.db')
+        if args.specdb is not None:
+            # The backup API copies a consistent database even if it's in use
+            src = sqlite3.connect(args.specdb)
+            dst = sqlite3.connect(path)
+            src.backup(dst)
+            dst.close()
+            src.close()
+        else:
+            synthdb.generate(path, numparts, args.seed)
+
+        db = bommdb.BOMdb(path, cache=args.cache)
+        db.migrate()
+        fx = Fixture(db, scratch, args.seed)
+        info = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                'database': args.specdb or 'synthdb.py --parts {} --seed {}'.format(numparts, args.seed),
+                'parts': len(db.get_parts()), 'cache': args.cache, 'seconds': args.seconds}
+        print('BOMdb benchmarks at commit {}, {} part numbers, SQLite {}'.format(info['commit'], info['parts'],
+                                                                                info['sqlite']))
+        print('{0:<35}  {1:>9}  {2:>14}  {3:>8}'.format('Benchmark', 'Ops', 'Ops/sec', 'Change'))
+
+        results = {}
+        bench = benchmarks(db, fx)
+        covered = set(name.split()[0] for (name, op) in bench)
+        for (name, op) in bench:
+            if args.only is not None and args.only not in name:
+                continue
+            (ops, seconds) = timed(op, args.seconds)
+            results[name] = print_result(name, ops, seconds, previous.get(name))
+        db.close()
+
+        if not args.no_cli:
+            bommgr = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bommgr.py')
+            for (name, cliargs) in cli_benchmarks(path, fx):
+                if args.only is not None and args.only not in name:
+                    continue
+                command = [sys.executable, '-W', 'ignore::SyntaxWarning', bommgr, '--specdb', path] + cliargs
+                (ops, seconds) = timed(lambda i: subprocess.check_call(command, stdout=subprocess.DEVNULL),
+                                       args.seconds)
+                results[name] = print_result(name, ops, seconds, previous.get(name))
+
+    # New public methods need a benchmark
+    public = [name for name in dir(bommdb.BOMdb) if not name.startswith('_') and name != 'close'
+              and callable(getattr(bommdb.BOMdb, name))]
+    missing = sorted(set(public) - covered)
+    if missing:
+        print('Warning: no benchmark for {}'.format(', '.join(missing)))
+
+    if args.json is not None:
+        info['results'] = results
+        with open(args.json, 'w') as f:
+            json.dump(info, f, indent=2)
+
+    sys.exit(0)
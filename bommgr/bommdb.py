@@ -19,31 +19,708 @@ __author__ = 'srodgers'
 
 import sys
 import os
+import re
+import json
+import math
 import sqlite3
+import threading
+import time
+import asyncio
+import contextvars
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+import sqltrace
+# Connection settings and the lookup snapshot are shared with the merge scripts
+from partsdb import db_options, apply_pragmas, snapshot_path
+import partsdb
+
+
+def _migrate_datasheet_col(cur):
+    """
+    Add the DataSheet column to the pnmpn table if it is not already there
+    :param cur: Database cursor
+    :return: N/A
+    """
+    cur.execute('PRAGMA table_info(pnmpn)')
+    cols = [row[1] for row in cur.fetchall()]
+    if 'DataSheet' not in cols:
+        cur.execute('ALTER TABLE pnmpn ADD COLUMN DataSheet TEXT')
+
+
+def _migrate_changelog_mids(cur):
+    """
+    Add the MFGId column to the changelog table if it is not already there.
+    Rows logging a manufacturer ID have no part number.
+    :param cur: Database cursor
+    :return: N/A
+    """
+    cur.execute('PRAGMA table_info(changelog)')
+    cols = [row[1] for row in cur.fetchall()]
+    if 'MFGId' not in cols:
+        cur.execute('ALTER TABLE changelog ADD COLUMN MFGId TEXT')
+
+
+def _check_unique_keys(cur):
+    """
+    Make sure the part numbers in pndesc and the manufacturer IDs in mlist are unique before unique indexes
+    are put on them, so the migration fails with a list of the duplicates instead of a bare constraint error
+    :param cur: Database cursor
+    :return: N/A
+    """
+    problems = []
+    for (table, column, what) in [('pndesc', 'PartNumber', 'Part numbers'), ('mlist', 'MFGId', 'Manufacturer IDs')]:
+        cur.execute('SELECT {1},COUNT(*) FROM {0} GROUP BY {1} HAVING COUNT(*) > 1 ORDER BY {1}'.format(table, column))
+        dups = cur.fetchall()
+        if dups:
+            listed = ', '.join('{} ({} rows)'.format(key, count) for (key, count) in dups[:10])
+            more = ' and {} more'.format(len(dups) - 10) if len(dups) > 10 else ''
+            problems.append('{} listed more than once in {}: {}{}'.format(what, table, listed, more))
+    if problems:
+        raise(sqlite3.IntegrityError('. '.join(problems) +
+                                     '. Run btmaintutil.py --fix to remove the extra rows, then migrate again'))
+
+
+# The triggers which keep the search indexes up to date, keyed by trigger name. Each entry is a tuple of
+# the index table and the statement which creates the trigger. The migrations which add the indexes create them,
+# and BOMdb._trigger_off() puts them back after a bulk change.
+
+_searchMpns = "(SELECT group_concat(MPN, ' ') FROM pnmpn WHERE PartNumber = {0}.PartNumber)"
+_searchRefresh = ("UPDATE partsearch SET MPNs = " + _searchMpns +
+                  " WHERE rowid = (SELECT rowid FROM pndesc WHERE PartNumber = {0}.PartNumber);")
+_trigramDelete = "INSERT INTO desctrigram (desctrigram, rowid, Description) VALUES ('delete', OLD.rowid, OLD.Description);"
+_trigramInsert = "INSERT INTO desctrigram (rowid, Description) VALUES (NEW.rowid, NEW.Description);"
+
+searchTriggers = OrderedDict([
+    ('pndesc_insert_search', ('partsearch', 'CREATE TRIGGER IF NOT EXISTS pndesc_insert_search AFTER INSERT ON pndesc BEGIN '
+     'INSERT INTO partsearch (rowid, Description, MPNs) VALUES (NEW.rowid, NEW.Description, ' + _searchMpns.format('NEW') + '); END')),
+    ('pndesc_update_search', ('partsearch', 'CREATE TRIGGER IF NOT EXISTS pndesc_update_search AFTER UPDATE ON pndesc BEGIN '
+     'DELETE FROM partsearch WHERE rowid = OLD.rowid; '
+     'INSERT INTO partsearch (rowid, Description, MPNs) VALUES (NEW.rowid, NEW.Description, ' + _searchMpns.format('NEW') + '); END')),
+    ('pndesc_delete_search', ('partsearch', 'CREATE TRIGGER IF NOT EXISTS pndesc_delete_search AFTER DELETE ON pndesc BEGIN '
+     'DELETE FROM partsearch WHERE rowid = OLD.rowid; END')),
+    ('pnmpn_insert_search', ('partsearch', 'CREATE TRIGGER IF NOT EXISTS pnmpn_insert_search AFTER INSERT ON pnmpn BEGIN ' +
+     _searchRefresh.format('NEW') + ' END')),
+    ('pnmpn_update_search', ('partsearch', 'CREATE TRIGGER IF NOT EXISTS pnmpn_update_search AFTER UPDATE OF PartNumber, MPN ON pnmpn BEGIN ' +
+     _searchRefresh.format('OLD') + ' ' + _searchRefresh.format('NEW') + ' END')),
+    ('pnmpn_delete_search', ('partsearch', 'CREATE TRIGGER IF NOT EXISTS pnmpn_delete_search AFTER DELETE ON pnmpn BEGIN ' +
+     _searchRefresh.format('OLD') + ' END')),
+    ('pndesc_insert_trigram', ('desctrigram', 'CREATE TRIGGER IF NOT EXISTS pndesc_insert_trigram AFTER INSERT ON pndesc BEGIN ' +
+     _trigramInsert + ' END')),
+    ('pndesc_update_trigram', ('desctrigram', 'CREATE TRIGGER IF NOT EXISTS pndesc_update_trigram AFTER UPDATE ON pndesc BEGIN ' +
+     _trigramDelete + ' ' + _trigramInsert + ' END')),
+    ('pndesc_delete_trigram', ('desctrigram', 'CREATE TRIGGER IF NOT EXISTS pndesc_delete_trigram AFTER DELETE ON pndesc BEGIN ' +
+     _trigramDelete + ' END')),
+])
+
+
+def _create_search_triggers(cur, table):
+    """
+    Create the triggers in searchTriggers which keep one search index up to date
+    :param cur: Database cursor
+    :param table: Index table name
+    :return: N/A
+    """
+    for (name, (index, sql)) in searchTriggers.items():
+        if index == table:
+            cur.execute(sql)
+
+
+def _migrate_fulltext(cur):
+    """
+    Add the partsearch full text index over part descriptions and manufacturer part numbers,
+    and the triggers which keep it up to date. There is one row for each pndesc row with the same rowid.
+    Nothing is done if SQLite was built without FTS5. search() falls back to LIKE matching in that case.
+    :param cur: Database cursor
+    :return: N/A
+    """
+    try:
+        # Keep periods in tokens so values like 0.1UF are indexed whole
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS partsearch USING fts5(Description, MPNs, tokenize=\"unicode61 tokenchars '.'\")")
+    except sqlite3.OperationalError:
+        return
+    cur.execute('DELETE FROM partsearch')
+    cur.execute('INSERT INTO partsearch (rowid, Description, MPNs) SELECT rowid, Description, ' +
+                _searchMpns.format('pndesc') + ' FROM pndesc')
+    _create_search_triggers(cur, 'partsearch')
+
+
+def mpn_key(mpn):
+    """
+    Return the canonical form of a manufacturer part number used to find near duplicates.
+    Punctuation and white space are removed and letters are upper cased, so LM358DR, LM358-DR and
+    lm358 dr all have the key LM358DR.
+    :param mpn: Manufacturer part number
+    :return: Canonical key
+    """
+    return re.sub(r'[\W_]+', '', mpn).upper()
+
+
+def _migrate_mpn_keys(cur):
+    """
+    Add the MPNKey column to the pnmpn table and fill it in for the existing rows
+    :param cur: Database cursor
+    :return: N/A
+    """
+    cur.execute('PRAGMA table_info(pnmpn)')
+    if 'MPNKey' not in [row[1] for row in cur.fetchall()]:
+        cur.execute('ALTER TABLE pnmpn ADD COLUMN MPNKey TEXT')
+    # Filling in the keys isn't a change to the parts, so keep it out of the change log
+    cur.execute('DROP TRIGGER IF EXISTS pnmpn_update_log')
+    cur.execute('CREATE TRIGGER pnmpn_update_log AFTER UPDATE OF PartNumber, Manufacturer, MPN, DataSheet ON pnmpn BEGIN '
+                'INSERT INTO changelog (PartNumber) VALUES (OLD.PartNumber); '
+                'INSERT INTO changelog (PartNumber) SELECT NEW.PartNumber WHERE NEW.PartNumber IS NOT OLD.PartNumber; END')
+    cur.execute('SELECT rowid,MPN FROM pnmpn')
+    keys = [(mpn_key(mpn or ''), rowid) for (rowid, mpn) in cur.fetchall()]
+    cur.executemany('UPDATE pnmpn SET MPNKey=? WHERE rowid=?', keys)
+    cur.execute('CREATE INDEX IF NOT EXISTS pnmpn_mpnkey ON pnmpn (MPNKey)')
+
+
+def _migrate_trigrams(cur):
+    """
+    Add the desctrigram index over part descriptions used to find similar parts, and the triggers
+    which keep it up to date. It is an FTS5 table using the trigram tokenizer with pndesc as its content table.
+    Nothing is done if SQLite is too old to have the trigram tokenizer. similar_parts() compares every
+    description in that case.
+    :param cur: Database cursor
+    :return: N/A
+    """
+    try:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS desctrigram USING fts5(Description, content='pndesc', tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return
+    cur.execute("INSERT INTO desctrigram (desctrigram) VALUES ('rebuild')")
+    _create_search_triggers(cur, 'desctrigram')
+
+
+def trigrams(text):
+    """
+    Return the set of three character sequences in a string, ignoring case
+    :param text: String to split up
+    :return: Set of trigrams. Empty if the string is shorter than three characters.
+    """
+    text = text.upper()
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+# Schema migrations in the order they must be applied.
+# Each entry is a tuple containing the (major, minor) version the database is upgraded to,
+# a description, and a list of steps. A step is either an SQL statement or a function which
+# is passed a cursor.
+
+schemaMigrations = [
+    ((0, 1), 'Add datasheet column to pnmpn table', [_migrate_datasheet_col]),
+    ((0, 2), 'Add keys and indexes to pndesc, pnmpn and mlist tables', [
+        _check_unique_keys,
+        'CREATE UNIQUE INDEX IF NOT EXISTS pndesc_pn ON pndesc (PartNumber)',
+        'CREATE INDEX IF NOT EXISTS pndesc_desc_nocase ON pndesc (Description COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS pnmpn_pn ON pnmpn (PartNumber)',
+        'CREATE INDEX IF NOT EXISTS pnmpn_mpn ON pnmpn (MPN)',
+        'CREATE INDEX IF NOT EXISTS pnmpn_mid ON pnmpn (Manufacturer)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS mlist_mid ON mlist (MFGId)',
+        'CREATE INDEX IF NOT EXISTS mlist_name ON mlist (MFGName)']),
+    ((0, 3), 'Add change log for incremental exports', [
+        'CREATE TABLE IF NOT EXISTS changelog (seq INTEGER PRIMARY KEY AUTOINCREMENT, PartNumber TEXT)',
+        'CREATE INDEX IF NOT EXISTS changelog_pn ON changelog (PartNumber)',
+        'INSERT INTO changelog (PartNumber) SELECT PartNumber FROM pndesc ORDER BY PartNumber',
+        'CREATE TRIGGER IF NOT EXISTS pndesc_insert_log AFTER INSERT ON pndesc BEGIN '
+        'INSERT INTO changelog (PartNumber) VALUES (NEW.PartNumber); END',
+        'CREATE TRIGGER IF NOT EXISTS pndesc_update_log AFTER UPDATE ON pndesc BEGIN '
+        'INSERT INTO changelog (PartNumber) VALUES (OLD.PartNumber); '
+        'INSERT INTO changelog (PartNumber) SELECT NEW.PartNumber WHERE NEW.PartNumber IS NOT OLD.PartNumber; END',
+        'CREATE TRIGGER IF NOT EXISTS pndesc_delete_log AFTER DELETE ON pndesc BEGIN '
+        'INSERT INTO changelog (PartNumber) VALUES (OLD.PartNumber); END',
+        'CREATE TRIGGER IF NOT EXISTS pnmpn_insert_log AFTER INSERT ON pnmpn BEGIN '
+        'INSERT INTO changelog (PartNumber) VALUES (NEW.PartNumber); END',
+        'CREATE TRIGGER IF NOT EXISTS pnmpn_update_log AFTER UPDATE ON pnmpn BEGIN '
+        'INSERT INTO changelog (PartNumber) VALUES (OLD.PartNumber); '
+        'INSERT INTO changelog (PartNumber) SELECT NEW.PartNumber WHERE NEW.PartNumber IS NOT OLD.PartNumber; END',
+        'CREATE TRIGGER IF NOT EXISTS pnmpn_delete_log AFTER DELETE ON pnmpn BEGIN '
+        'INSERT INTO changelog (PartNumber) VALUES (OLD.PartNumber); END',
+        'CREATE TRIGGER IF NOT EXISTS mlist_update_log AFTER UPDATE ON mlist BEGIN '
+        'INSERT INTO changelog (PartNumber) SELECT DISTINCT PartNumber FROM pnmpn '
+        'WHERE Manufacturer = OLD.MFGId OR Manufacturer = NEW.MFGId; END',
+        'CREATE TRIGGER IF NOT EXISTS mlist_delete_log AFTER DELETE ON mlist BEGIN '
+        'INSERT INTO changelog (PartNumber) SELECT DISTINCT PartNumber FROM pnmpn WHERE Manufacturer = OLD.MFGId; END']),
+    ((0, 4), 'Add full text search index over descriptions and MPNs', [_migrate_fulltext]),
+    ((0, 5), 'Add canonical MPN keys to pnmpn table', [_migrate_mpn_keys]),
+    ((0, 6), 'Add trigram index over descriptions for finding similar parts', [_migrate_trigrams]),
+    ((0, 7), 'Add unique keys to config table for the number sequences', [
+        'CREATE TABLE IF NOT EXISTS config (key TEXT,value TEXT)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS config_key ON config (key)']),
+    ((0, 8), 'Log the manufacturer IDs which may have become unused', [
+        _migrate_changelog_mids,
+        # Sources changed or removed leave their old manufacturer ID with one source less
+        'DROP TRIGGER IF EXISTS pnmpn_update_log',
+        'CREATE TRIGGER pnmpn_update_log AFTER UPDATE ON pnmpn BEGIN '
+        'INSERT INTO changelog (PartNumber,MFGId) VALUES (OLD.PartNumber,OLD.Manufacturer); '
+        'INSERT INTO changelog (PartNumber) SELECT NEW.PartNumber WHERE NEW.PartNumber IS NOT OLD.PartNumber; END',
+        'DROP TRIGGER IF EXISTS pnmpn_delete_log',
+        'CREATE TRIGGER pnmpn_delete_log AFTER DELETE ON pnmpn BEGIN '
+        'INSERT INTO changelog (PartNumber,MFGId) VALUES (OLD.PartNumber,OLD.Manufacturer); END',
+        # New manufacturer IDs start out unused
+        'CREATE TRIGGER IF NOT EXISTS mlist_insert_log AFTER INSERT ON mlist BEGIN '
+        'INSERT INTO changelog (MFGId) VALUES (NEW.MFGId); END',
+        'DROP TRIGGER IF EXISTS mlist_update_log',
+        'CREATE TRIGGER mlist_update_log AFTER UPDATE ON mlist BEGIN '
+        'INSERT INTO changelog (PartNumber) SELECT DISTINCT PartNumber FROM pnmpn '
+        'WHERE Manufacturer = OLD.MFGId OR Manufacturer = NEW.MFGId; '
+        'INSERT INTO changelog (MFGId) SELECT NEW.MFGId WHERE NEW.MFGId IS NOT OLD.MFGId; END']),
+]
+
+# Part numbers changed after a change marker, for the queries which take one
+changedSince = '(SELECT PartNumber FROM changelog WHERE seq > ?)'
+
+# Config table keys of the change markers saved by the readers of the change log, such as incremental checks
+# and exports, start with this. prune_changelog() only removes the changes all of them have seen.
+changeMarkerPrefix = 'marker.'
+
+# Config table key of the last change removed by prune_changelog()
+prunedMarkerKey = 'changelog_pruned'
+
+
+def _changed(since, recheck=None, column='PartNumber'):
+    """
+    Return the subquery selecting the keys changed after a change marker, plus the keys to check again
+    :param since: Change marker returned by change_marker()
+    :param recheck: Optional list of keys to include whether they changed or not
+    :param column: Key logged in the changelog table, PartNumber or MFGId
+    :return: Tuple containing (subquery in parentheses, list of parameters)
+    """
+    query = '(SELECT {0} FROM changelog WHERE seq > ? AND {0} IS NOT NULL'.format(column)
+    params = [since]
+    if recheck:
+        query += ' UNION SELECT value FROM json_each(?)'
+        params.append(json.dumps(sorted(recheck)))
+    return (query + ')', params)
+
+# Maximum number of keys bound to a single IN (...) query by the multi-key lookups
+lookupChunkSize = 500
+
+# Seconds between checks for changes committed by other processes, which discard the cache
+cacheCheckInterval = 0.5
+
+# Shortest word search() looks for. A search for single characters would match nearly every part.
+searchMinLength = 2
+
 
 class BOMdb:
     """
     A class to encapsulate the database operations for bommgr.py
     """
-    def __init__(self, dbfile):
-        self.conn = sqlite3.connect(dbfile)
-        self.cur = self.conn.cursor()
+    def __init__(self, dbfile, cache=False, cache_size=1000, options=None):
+        """
+        Each thread which uses the object gets its own connection to the database, so one BOMdb object
+        can be shared by worker threads. The cache is shared by all of the threads.
+
+        :param dbfile: Path to the database file
+        :param cache: Keep the manufacturer list in memory and cache recent part number and source lookups.
+        Changes made through this object update the cache when they are committed. Changes committed by
+        other processes discard it within cacheCheckInterval seconds.
+        :param cache_size: Maximum number of entries in each of the part number and source caches
+        :param options: Dictionary of SQLite connection settings as returned by db_options()
+        """
+        self.dbfile = dbfile
+        self.options = options
+        sqltrace.setup(options) # Statement tracing, if the settings or BOMMGR_TRACE ask for it
+        self._local = threading.local()
+        self._connections = []
+
+        self.cache = cache
+        self.cache_size = cache_size
+        self._lock = threading.RLock() # Guards the cache and the connection list
+        self._cache_gen = 0
+        self._mfgrs_by_id = None
+        self._mfgrs_by_name = None
+        self._caches = {'pn': OrderedDict(), 'sources': OrderedDict()}
+        self._cache_counts = {name: {'hits': 0, 'misses': 0} for name in ['mfg', 'pn', 'sources']}
 
         self.major = 0
         self.minor = 0
 
 
-        self.cur.execute('SELECT major,minor FROM version')
-        res = self.cur.fetchone()
+        cur = self.conn.cursor()
+        cur.execute('SELECT major,minor FROM version')
+        res = cur.fetchone()
         if res is not None:
             self.major = int(res[0])
             self.minor = int(res[1])
 
+        # Note if the schema needs to be upgraded with migrate()
+        self.out_of_date = self.schema_version() < self.latest_schema_version()
+        self._find_indexes()
+
+    def _find_indexes(self):
+        """
+        Note which of the search indexes the database has, so has_fulltext() and has_trigrams() don't query
+        the schema every time. The migrations leave an index out if SQLite can't build it.
+        :return: N/A
+        """
+        cur = self.conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('partsearch', 'desctrigram')")
+        self._indexes = set(row[0] for row in cur.fetchall())
+
+    def _thread(self):
+        """
+        Return the state kept for the calling thread. The thread's connection is opened on first use.
+        :return: threading.local object with conn, txn_depth and invalidated attributes
+        """
+        local = self._local
+        if not hasattr(local, 'conn'):
+            # Every connection is only used by the thread which opened it. Allow other
+            # threads to use it so close() can close all of them.
+            conn = sqltrace.connect(self.dbfile, check_same_thread=False)
+            if self.options:
+                apply_pragmas(conn, self.options)
+            with self._lock:
+                self._connections.append(conn)
+            local.conn = conn
+            local.txn_depth = 0
+            local.invalidated = []
+            local.data_version = None
+            local.data_checked = None
+        return local
+
+    @property
+    def conn(self):
+        """
+        The database connection for the calling thread
+        """
+        return self._thread().conn
+
+    def close(self):
+        """
+        Close the database connections opened by every thread
+        :return: N/A
+        """
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._local = threading.local()
+
     def _get_conn(self):
         return self.conn
 
     def _get_cur(self):
-        return self.cur
+        return self.conn.cursor()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several changes into a single transaction.
+        The mutators do not commit while a transaction is open. The changes are committed once when the
+        outermost transaction block exits, or rolled back if it exits with an exception.
+        Transaction blocks may be nested. Only the outermost block commits or rolls back.
+        Transactions belong to the calling thread.
+
+        with db.transaction():
+            db.remove_source(pn, mid, mpn)
+            db.remove_mid(mid)
+
+        :return: N/A
+        """
+        local = self._thread()
+        if local.txn_depth == 0:
+            local.conn.commit() # Start from a clean slate
+        local.txn_depth += 1
+        try:
+            yield self
+        except BaseException:
+            local.txn_depth -= 1
+            if local.txn_depth == 0:
+                local.conn.rollback()
+                # The cache may hold rows which no longer exist
+                local.invalidated = []
+                self.clear_cache()
+            raise
+        local.txn_depth -= 1
+        if local.txn_depth == 0:
+            local.conn.commit()
+            self._flush_invalidations()
+
+    def in_transaction(self):
+        """
+        :return: True if the calling thread has a transaction block open
+        """
+        return self._thread().txn_depth > 0
+
+    def _commit(self):
+        """
+        Commit the changes made by a mutator unless a transaction block is open
+        :return: N/A
+        """
+        local = self._thread()
+        if not local.txn_depth:
+            local.conn.commit()
+            self._flush_invalidations()
+
+    def cache_stats(self):
+        """
+        Return the cache hit and miss counters
+        :return: Dictionary keyed by cache name (mfg, pn, sources) containing dictionaries with hits and misses keys
+        """
+        with self._lock:
+            return {name: dict(counts) for (name, counts) in self._cache_counts.items()}
+
+    def clear_cache(self):
+        """
+        Discard everything in the cache
+        :return: N/A
+        """
+        with self._lock:
+            self._cache_gen += 1
+            self._mfgrs_by_id = None
+            self._mfgrs_by_name = None
+            for cache in self._caches.values():
+                cache.clear()
+
+    def _use_cache(self):
+        """
+        Decide whether the calling thread may read from and add to the shared cache.
+        A thread with a write transaction open bypasses the cache, so its uncommitted rows are never
+        served to other threads and the rows it changed are never served to it from the cache.
+        Every cacheCheckInterval seconds, PRAGMA data_version is read to find out whether another
+        connection has committed a change, and if so everything in the cache is discarded.
+        :return: True if the cache may be used
+        """
+        local = self._thread()
+        if local.conn.in_transaction:
+            return False
+        now = time.monotonic()
+        if local.data_checked is None or now - local.data_checked >= cacheCheckInterval:
+            local.data_checked = now
+            cur = local.conn.cursor()
+            cur.execute('PRAGMA data_version')
+            version = cur.fetchone()[0]
+            if local.data_version is not None and version != local.data_version:
+                self.clear_cache()
+            local.data_version = version
+        return True
+
+    def _load_mfgrs(self):
+        """
+        Load the manufacturer list into memory if it isn't already there
+        :return: Tuple containing dictionaries of manufacturer records keyed by (ID, name)
+        """
+        use = self._use_cache()
+        with self._lock:
+            if use and self._mfgrs_by_id is not None:
+                self._cache_counts['mfg']['hits'] += 1
+                return (self._mfgrs_by_id, self._mfgrs_by_name)
+            self._cache_counts['mfg']['misses'] += 1
+            by_id = {}
+            by_name = {}
+            cur = self.conn.cursor()
+            cur.execute('SELECT MFGName,MFGId FROM mlist ORDER BY rowid')
+            for row in cur.fetchall():
+                by_id.setdefault(row[1], row)
+                by_name.setdefault(row[0], row)
+            if use:
+                (self._mfgrs_by_id, self._mfgrs_by_name) = (by_id, by_name)
+            return (by_id, by_name)
+
+    def _cached(self, name, key, loader):
+        """
+        Return a result from one of the LRU caches. On a miss, call loader and cache its result.
+        :param name: Cache name
+        :param key: Key to look up
+        :param loader: Function which takes the key and queries the database
+        :return: The cached or loaded result
+        """
+        if not self._use_cache():
+            with self._lock:
+                self._cache_counts[name]['misses'] += 1
+            return loader(key)
+        cache = self._caches[name]
+        with self._lock:
+            if key in cache:
+                cache.move_to_end(key)
+                self._cache_counts[name]['hits'] += 1
+                return cache[key]
+            self._cache_counts[name]['misses'] += 1
+            gen = self._cache_gen
+        res = loader(key)
+        with self._lock:
+            # Don't cache the result if something was invalidated while it was being loaded
+            if gen == self._cache_gen:
+                cache[key] = res
+                if len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+        return res
+
+    def _invalidate_mfgrs(self, mid=None):
+        """
+        Invalidate the cached manufacturer list after a change to the mlist table
+        :param mid: Manufacturer ID changed or removed. Cached sources referring to it are discarded.
+        :return: N/A
+        """
+        self._drop_mfgrs(mid)
+        self._thread().invalidated.append((self._drop_mfgrs, mid))
+
+    def _drop_mfgrs(self, mid):
+        with self._lock:
+            self._cache_gen += 1
+            self._mfgrs_by_id = None
+            self._mfgrs_by_name = None
+            if mid is not None:
+                cache = self._caches['sources']
+                for pn in [pn for (pn, sources) in cache.items() if any(item['mid'] == mid for item in sources)]:
+                    del cache[pn]
+
+    def _invalidate_part(self, pn, desc=True):
+        """
+        Invalidate the cached lookups for a part number
+        :param pn: Part number
+        :param desc: Set to False if only the sources for the part number changed
+        :return: N/A
+        """
+        if desc:
+            self._drop_part(pn)
+            self._thread().invalidated.append((self._drop_part, pn))
+        else:
+            self._drop_sources(pn)
+            self._thread().invalidated.append((self._drop_sources, pn))
+
+    def _drop_part(self, pn):
+        with self._lock:
+            self._cache_gen += 1
+            self._caches['pn'].pop(pn, None)
+            self._caches['sources'].pop(pn, None)
+
+    def _drop_sources(self, pn):
+        with self._lock:
+            self._cache_gen += 1
+            self._caches['sources'].pop(pn, None)
+
+    def _flush_invalidations(self):
+        """
+        Repeat the invalidations made by the calling thread once its changes are committed.
+        Another thread may have cached the old rows between the change and the commit.
+        :return: N/A
+        """
+        local = self._thread()
+        for (drop, key) in local.invalidated:
+            drop(key)
+        local.invalidated = []
+
+    def schema_version(self):
+        """
+        Return the schema version of the database
+        :return: Tuple containing (major, minor)
+        """
+        return (self.major, self.minor)
+
+    def latest_schema_version(self):
+        """
+        Return the schema version this module upgrades databases to
+        :return: Tuple containing (major, minor)
+        """
+        return schemaMigrations[-1][0]
+
+    def migrate(self):
+        """
+        Upgrade the database schema to the latest version.
+        All pending migrations are applied in a single transaction. If one fails, the database
+        is left unchanged.
+        :return: List of descriptions of the migrations applied
+        """
+        if self.in_transaction():
+            raise(RuntimeError('Schema migrations can not be run inside a transaction block'))
+        cur = self.conn.cursor()
+        applied = []
+        pending = [m for m in schemaMigrations if m[0] > self.schema_version()]
+        if not pending:
+            return applied
+
+        self.conn.commit()
+        cur.execute('BEGIN')
+        try:
+            for (version, description, steps) in pending:
+                for step in steps:
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                applied.append(description)
+            (major, minor) = pending[-1][0]
+            cur.execute('SELECT COUNT(*) FROM version')
+            if cur.fetchone()[0]:
+                cur.execute('UPDATE version SET major=?, minor=?', [major, minor])
+            else:
+                cur.execute('INSERT INTO version (major,minor) VALUES(?,?)', [major, minor])
+            self.conn.commit()
+        except sqlite3.DatabaseError:
+            self.conn.rollback()
+            raise
+
+        self.major = major
+        self.minor = minor
+        self.out_of_date = False
+        self._find_indexes()
+        self.clear_cache()
+        return applied
+
+    def db_stats(self):
+        """
+        Return the size of the database and of each of its tables and indexes
+        :return: Dictionary containing page_size, page_count, freelist_count, analyzed (True if ANALYZE has been run),
+        tables, a list of (table name, number of rows, pages) tuples, and indexes, a list of (index name, table name,
+        pages) tuples. Pages are None if SQLite was built without the dbstat table.
+        """
+        cur = self.conn.cursor()
+        stats = {}
+        for pragma in ['page_size', 'page_count', 'freelist_count']:
+            cur.execute('PRAGMA {}'.format(pragma))
+            stats[pragma] = cur.fetchone()[0]
+        try:
+            cur.execute("SELECT name,pageno FROM dbstat WHERE aggregate = TRUE")
+            pages = dict(cur.fetchall())
+        except sqlite3.OperationalError:
+            pages = {}
+        cur.execute("SELECT type,name,tbl_name,sql FROM sqlite_master WHERE type IN ('table','index') ORDER BY name")
+        stats['tables'] = []
+        stats['indexes'] = []
+        stats['analyzed'] = False
+        for (kind, name, table, sql) in cur.fetchall():
+            if kind == 'index':
+                stats['indexes'].append((name, table, pages.get(name)))
+            elif name == 'sqlite_stat1':
+                stats['analyzed'] = True
+            elif not name.startswith('sqlite_') and not (sql or '').upper().startswith('CREATE VIRTUAL'):
+                cur.execute('SELECT COUNT(*) FROM "{}"'.format(name))
+                stats['tables'].append((name, cur.fetchone()[0], pages.get(name)))
+        return stats
+
+    def query_plan(self, sql, params=()):
+        """
+        Return how SQLite would run a statement
+        :param sql: Statement
+        :param params: Statement parameters
+        :return: List of the plan steps, as given by EXPLAIN QUERY PLAN
+        """
+        cur = self.conn.cursor()
+        cur.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cur.fetchall()]
+
+    def optimize(self, vacuum_into=None):
+        """
+        Gather the statistics the query planner uses to choose indexes, with ANALYZE and PRAGMA optimize,
+        and optionally write a defragmented copy of the database
+        :param vacuum_into: Path of a new database file to write a compacted copy to with VACUUM INTO.
+        The database itself is left as it is. The file must not exist.
+        :return: N/A
+        """
+        if self.in_transaction():
+            raise(RuntimeError('The database can not be optimized inside a transaction block'))
+        self.conn.commit()
+        cur = self.conn.cursor()
+        cur.execute('ANALYZE')
+        cur.execute('PRAGMA optimize')
+        self.conn.commit()
+        if vacuum_into is not None:
+            cur.execute('VACUUM INTO ?', [vacuum_into])
 
     def get_parts(self, like=None):
         """
@@ -51,20 +728,355 @@ class BOMdb:
         :param like:  Database matching string. Use % as a wild card
         :return: List of part numbers and descriptions
         """
+        cur = self.conn.cursor()
+        if like != None:
+            cur.execute('SELECT Partnumber,Description FROM pndesc WHERE Description LIKE ? ORDER BY PartNumber ASC',[like])
+        else:
+            cur.execute('SELECT Partnumber,Description FROM pndesc ORDER BY PartNumber ASC')
+        return cur.fetchall()
+
+    def get_parts_containing(self, text, since=None, recheck=None):
+        """
+        Returns a sorted list of the part numbers whose description contains some text.
+        Unlike get_parts(), the match is case sensitive.
+        :param text: Text to look for
+        :param since: Change marker returned by change_marker(). Only part numbers changed after it are returned.
+        :param recheck: Part numbers to check as well as the ones changed after since
+        :return: List of part numbers and descriptions
+        """
+        query = 'SELECT PartNumber,Description FROM pndesc WHERE instr(Description, ?) > 0 '
+        params = [text]
+        if since is not None:
+            (changed, changed_params) = _changed(since, recheck)
+            query += 'AND PartNumber IN ' + changed + ' '
+            params += changed_params
+        cur = self.conn.cursor()
+        cur.execute(query + 'ORDER BY PartNumber ASC', params)
+        return cur.fetchall()
+
+    def get_parts_with_sources(self, like=None):
+        """
+        Returns a sorted list of part numbers and descriptions along with their sources.
+        The rows are streamed from a single query, so this is a generator.
+        :param like:  Database matching string. Use % as a wild card
+        :return: Yields tuples containing (part number, description, sources). Sources is a list of dictionaries
+        in the same form as returned by lookup_mpn_by_pn(). It is empty if the part number has no sources.
+        """
+        if self.mfg_table_has_datasheet_col():
+            datasheet = 'p.DataSheet'
+        else:
+            datasheet = 'NULL'
 
+        query = 'SELECT d.rowid,d.PartNumber,d.Description,p.rowid,p.Manufacturer,p.MPN,{},m.MFGName,m.MFGId FROM pndesc d ' \
+                'LEFT JOIN pnmpn p ON p.PartNumber = d.PartNumber ' \
+                'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer '.format(datasheet)
+        params = []
         if like != None:
-            self.cur.execute('SELECT Partnumber,Description FROM pndesc WHERE Description LIKE ? ORDER BY PartNumber ASC',[like])
+            query += 'WHERE d.Description LIKE ? '
+            params.append(like)
+        query += 'ORDER BY d.PartNumber ASC, d.rowid ASC, p.rowid ASC'
+
+        # Use a separate cursor so the caller is free to make other queries while iterating
+        cur = self.conn.cursor()
+        cur.execute(query, params)
+
+        part = None
+        for (rowid, pn, desc, source_rowid, mid, mpn, datasheet, mname, mlist_mid) in cur:
+            if part is None or part[0] != rowid:
+                if part is not None:
+                    yield part[1:]
+                part = (rowid, pn, desc, [])
+            if source_rowid is None:
+                continue # No sources for this part number
+            if mlist_mid is None:
+                raise(ValueError) # Something is messed up in the database
+            part[3].append({'pn' : pn,'mid' : mid, 'mpn' : mpn,'datasheet':datasheet, 'mname' : mname})
+        if part is not None:
+            yield part[1:]
+
+    def has_changelog(self):
+        """
+        :return: True if the database schema has the change log used by incremental exports
+        """
+        return self.schema_version() >= (0, 3)
+
+    def change_marker(self):
+        """
+        Return a marker for the most recent change to the parts database.
+        Pass it to export_rows() or deleted_since() later to get only what changed after it.
+        :return: Change marker. 0 if nothing has been logged.
+        """
+        # The log is AUTOINCREMENT, so this is still the latest change after prune_changelog() has emptied it
+        cur = self.conn.cursor()
+        cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changelog'")
+        res = cur.fetchone()
+        return res[0] if res is not None else 0
+
+    def export_rows(self, like=None, since=None):
+        """
+        Returns every source of every part number with its manufacturer name and datasheet, sorted by part number.
+        The rows are streamed from a single query, so this is a generator.
+        :param like: Database matching string for the description. Use % as a wild card
+        :param since: Change marker returned by change_marker(). Only part numbers changed after it are returned.
+        :return: Yields tuples containing (part number, description, manufacturer name, manufacturer ID,
+        manufacturer part number, datasheet). Part numbers without sources are returned once with the
+        last four items set to None.
+        """
+        if self.mfg_table_has_datasheet_col():
+            datasheet = 'p.DataSheet'
         else:
-            self.cur.execute('SELECT Partnumber,Description FROM pndesc ORDER BY PartNumber ASC')
-        return self.cur.fetchall()
+            datasheet = 'NULL'
+
+        query = 'SELECT d.PartNumber,d.Description,m.MFGName,p.Manufacturer,p.MPN,{} FROM pndesc d ' \
+                'LEFT JOIN pnmpn p ON p.PartNumber = d.PartNumber ' \
+                'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer '.format(datasheet)
+        where = []
+        params = []
+        if like != None:
+            where.append('d.Description LIKE ?')
+            params.append(like)
+        if since != None:
+            where.append('d.PartNumber IN ' + changedSince)
+            params.append(since)
+        if where:
+            query += 'WHERE ' + ' AND '.join(where) + ' '
+        query += 'ORDER BY d.PartNumber ASC, d.rowid ASC, p.rowid ASC'
+
+        # Use a separate cursor so the caller is free to make other queries while iterating
+        cur = self.conn.cursor()
+        cur.execute(query, params)
+        for row in cur:
+            yield row
+
+    def deleted_since(self, since):
+        """
+        Returns the part numbers deleted after a change marker
+        :param since: Change marker returned by change_marker()
+        :return: Sorted list of part numbers
+        """
+        cur = self.conn.cursor()
+        cur.execute('SELECT DISTINCT c.PartNumber FROM changelog c WHERE c.seq > ? AND c.PartNumber IS NOT NULL '
+                    'AND NOT EXISTS (SELECT 1 FROM pndesc d WHERE d.PartNumber = c.PartNumber) ORDER BY c.PartNumber',
+                    [since])
+        return [row[0] for row in cur.fetchall()]
+
+    def changelog_start(self):
+        """
+        Return the oldest change marker the change log can still be read from
+        :return: Change marker of the last change removed by prune_changelog(). 0 if none have been removed.
+        """
+        return int(self.get_setting(prunedMarkerKey, 0))
+
+    def prune_changelog(self):
+        """
+        Remove the changes every reader of the change log has seen: the ones up to the lowest change marker saved in
+        the config table under a key starting with changeMarkerPrefix. If no markers are saved, every change is removed.
+        Afterwards changelog_start() tells readers with older markers that they have to start over.
+        :return: Number of changes removed
+        """
+        cur = self.conn.cursor()
+        cur.execute('SELECT MIN(CAST(value AS INTEGER)) FROM config WHERE key LIKE ?', [changeMarkerPrefix + '%'])
+        floor = cur.fetchone()[0]
+        if floor is None:
+            floor = self.change_marker()
+        if floor <= self.changelog_start():
+            return 0
+        with self.transaction():
+            cur.execute('DELETE FROM changelog WHERE seq <= ?', [floor])
+            removed = cur.rowcount
+            self.set_setting(prunedMarkerKey, floor)
+        return removed
+
+    def get_setting(self, key, default=None):
+        """
+        Return a value stored in the config table
+        :param key: Config table key
+        :param default: Returned if the key isn't there
+        :return: Value as a string, or default
+        """
+        cur = self.conn.cursor()
+        cur.execute('SELECT value FROM config WHERE key = ?', [key])
+        res = cur.fetchone()
+        return default if res is None else res[0]
+
+    def set_setting(self, key, value):
+        """
+        Store a value in the config table, replacing what was there
+        :param key: Config table key
+        :param value: Value to store. It is read back as a string.
+        :return: N/A
+        """
+        cur = self.conn.cursor()
+        cur.execute('UPDATE config SET value = ? WHERE key = ?', [str(value), key])
+        if cur.rowcount == 0:
+            cur.execute('INSERT INTO config (key,value) VALUES (?,?)', [key, str(value)])
+        self._commit()
 
     def get_pnmpn(self):
         """
         Return entire pnmpn table contents
         :return: List of rows with rows as tuples
         """
-        self.cur.execute('SELECT Partnumber,Manufacturer,MPN,Datasheet FROM pnmpn ORDER BY PartNumber ASC')
-        return self.cur.fetchall()
+        cur = self.conn.cursor()
+        cur.execute('SELECT Partnumber,Manufacturer,MPN,Datasheet FROM pnmpn ORDER BY PartNumber ASC')
+        return cur.fetchall()
+
+    def get_dangling_sources(self, since=None, recheck=None):
+        """
+        Return the sources whose manufacturer ID is missing from the manufacturer list, or has no name
+        :param since: Change marker returned by change_marker(). Only the sources of part numbers changed
+        after it are returned.
+        :param recheck: Part numbers to check as well as the ones changed after since
+        :return: List of (part number, manufacturer ID, manufacturer part number, manufacturer name) tuples
+        sorted by part number. The name is None when the manufacturer ID is missing.
+        """
+        # Check each manufacturer ID in use once, then fetch only the sources which have a bad one
+        used = 'SELECT DISTINCT Manufacturer FROM pnmpn'
+        query = 'SELECT p.PartNumber,p.Manufacturer,p.MPN,m.MFGName FROM pnmpn p ' \
+                'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer ' \
+                'WHERE p.Manufacturer IN (SELECT u.Manufacturer FROM ({}) u ' \
+                "WHERE NOT EXISTS (SELECT 1 FROM mlist n WHERE n.MFGId = u.Manufacturer AND n.MFGName != '')) "
+        params = []
+        if since is not None:
+            (changed, changed_params) = _changed(since, recheck)
+            used += ' WHERE PartNumber IN ' + changed
+            query += 'AND p.PartNumber IN ' + changed + ' '
+            params = changed_params + changed_params
+        cur = self.conn.cursor()
+        cur.execute(query.format(used) + 'ORDER BY p.PartNumber ASC, p.rowid ASC', params)
+        return cur.fetchall()
+
+    def get_unused_mfgrs(self, since=None, recheck=None):
+        """
+        Return the manufacturers which no source refers to
+        :param since: Change marker returned by change_marker(). Only manufacturer IDs added, or which lost a source,
+        after it are checked. Ignored if the changelog doesn't log manufacturer IDs (before schema version 0.8).
+        :param recheck: Manufacturer IDs to check as well as the ones changed after since
+        :return: List of (manufacturer ID, manufacturer name) tuples sorted by manufacturer ID
+        """
+        query = 'SELECT m.MFGId,m.MFGName FROM mlist m WHERE NOT EXISTS (SELECT 1 FROM pnmpn p WHERE p.Manufacturer = m.MFGId) '
+        params = []
+        if since is not None and self.schema_version() >= (0, 8):
+            (changed, params) = _changed(since, recheck, 'MFGId')
+            query += 'AND m.MFGId IN ' + changed + ' '
+        cur = self.conn.cursor()
+        cur.execute(query + 'ORDER BY m.MFGId ASC', params)
+        return cur.fetchall()
+
+    def get_orphan_sources(self, since=None, recheck=None):
+        """
+        Return the sources whose part number is missing from the pndesc table
+        :param since: Change marker returned by change_marker(). Only part numbers changed after it are checked.
+        :param recheck: Part numbers to check as well as the ones changed after since
+        :return: List of (part number, manufacturer ID, manufacturer part number) tuples sorted by part number
+        """
+        query = 'SELECT p.PartNumber,p.Manufacturer,p.MPN FROM pnmpn p ' \
+                'WHERE NOT EXISTS (SELECT 1 FROM pndesc d WHERE d.PartNumber = p.PartNumber) '
+        params = []
+        if since is not None:
+            (changed, params) = _changed(since, recheck)
+            query += 'AND p.PartNumber IN ' + changed + ' '
+        cur = self.conn.cursor()
+        cur.execute(query + 'ORDER BY p.PartNumber ASC, p.rowid ASC', params)
+        return cur.fetchall()
+
+    def get_parts_without_sources(self, since=None, recheck=None):
+        """
+        Return the part numbers which have no sources
+        :param since: Change marker returned by change_marker(). Only part numbers changed after it are checked.
+        :param recheck: Part numbers to check as well as the ones changed after since
+        :return: List of (part number, description) tuples sorted by part number
+        """
+        query = 'SELECT d.PartNumber,d.Description FROM pndesc d ' \
+                'WHERE NOT EXISTS (SELECT 1 FROM pnmpn p WHERE p.PartNumber = d.PartNumber) '
+        params = []
+        if since is not None:
+            (changed, params) = _changed(since, recheck)
+            query += 'AND d.PartNumber IN ' + changed + ' '
+        cur = self.conn.cursor()
+        cur.execute(query + 'ORDER BY d.PartNumber ASC', params)
+        return cur.fetchall()
+
+    def get_duplicate_sources(self, placeholder='N/A', since=None, recheck=None):
+        """
+        Find sources listed more than once, and manufacturer part numbers listed under more than one part number.
+        Only rows which share their canonical MPN key (or MPN, if the database has no keys) with another row
+        can be duplicates, so those are found with the index and grouped here.
+        :param placeholder: MPN used for parts without a real one, never counted as shared
+        :param since: Change marker returned by change_marker(). Only groups with a part number changed after it
+        are returned.
+        :param recheck: Part numbers to check as well as the ones changed after since
+        :return: Tuple containing (repeated, shared).
+        repeated is a list of ((part number, manufacturer ID, manufacturer part number), number of rows) tuples.
+        shared is a list of ((manufacturer ID, canonical MPN key), list of (part number, manufacturer part number))
+        tuples for MPNs from the same manufacturer which only differ in punctuation, spacing or case, under more
+        than one part number. Both lists are sorted with the largest groups first.
+        """
+        key = 'MPNKey' if self.has_mpn_keys() else 'MPN'
+        if since is None:
+            candidates = 'SELECT {0} FROM pnmpn GROUP BY {0} HAVING COUNT(*) > 1'
+            params = []
+        else:
+            # Groups of one row fall out below
+            (changed, params) = _changed(since, recheck)
+            candidates = 'SELECT {0} FROM pnmpn WHERE PartNumber IN ' + changed
+        cur = self.conn.cursor()
+        cur.execute(('SELECT PartNumber,Manufacturer,MPN,{0} FROM pnmpn WHERE {0} IN (' + candidates + ') '
+                     'ORDER BY PartNumber ASC, rowid ASC').format(key), params)
+        rows = {}
+        groups = {}
+        for (pn, mid, mpn, mkey) in cur.fetchall():
+            rows[(pn, mid, mpn)] = rows.get((pn, mid, mpn), 0) + 1
+            if mpn != placeholder and mkey:
+                group = groups.setdefault((mid, mpn_key(mkey)), [])
+                if (pn, mpn) not in group:
+                    group.append((pn, mpn))
+        repeated = [(source, count) for (source, count) in rows.items() if count > 1]
+        repeated.sort(key=lambda item: -item[1])
+        shared = [(group, sources) for (group, sources) in groups.items() if len(set(pn for (pn, mpn) in sources)) > 1]
+        shared.sort(key=lambda item: -len(item[1]))
+        return (repeated, shared)
+
+    def get_duplicate_descriptions(self, since=None, recheck=None):
+        """
+        Find descriptions, ignoring case, used by more than one part number
+        :param since: Change marker returned by change_marker(). Only descriptions of part numbers changed after it
+        are returned.
+        :param recheck: Part numbers to check as well as the ones changed after since
+        :return: List of (description, list of part numbers) tuples sorted with the largest groups first
+        """
+        if since is None:
+            candidates = 'SELECT Description COLLATE NOCASE FROM pndesc GROUP BY Description COLLATE NOCASE HAVING COUNT(*) > 1'
+            params = []
+        else:
+            (changed, params) = _changed(since, recheck)
+            candidates = 'SELECT Description COLLATE NOCASE FROM pndesc WHERE PartNumber IN ' + changed
+        cur = self.conn.cursor()
+        cur.execute('SELECT Description,PartNumber FROM pndesc WHERE Description COLLATE NOCASE IN (' + candidates + ') '
+                    'ORDER BY Description COLLATE NOCASE ASC, PartNumber ASC', params)
+        res = []
+        for (desc, pn) in cur.fetchall():
+            if res and (res[-1][0] or '').lower() == (desc or '').lower():
+                res[-1][1].append(pn)
+            else:
+                res.append((desc, [pn]))
+        res = [item for item in res if len(item[1]) > 1]
+        res.sort(key=lambda item: -len(item[1]))
+        return res
+
+    def get_duplicate_keys(self):
+        """
+        Find part numbers listed more than once in pndesc and manufacturer IDs listed more than once in mlist.
+        Only databases older than schema version 0.2 can have them, later ones have unique keys.
+        :return: Tuple containing (part numbers, manufacturer IDs), each a list of (key, number of rows) tuples
+        """
+        if self.schema_version() >= (0, 2):
+            return ([], [])
+        cur = self.conn.cursor()
+        cur.execute('SELECT PartNumber,COUNT(*) FROM pndesc GROUP BY PartNumber HAVING COUNT(*) > 1 ORDER BY PartNumber')
+        pns = cur.fetchall()
+        cur.execute('SELECT MFGId,COUNT(*) FROM mlist GROUP BY MFGId HAVING COUNT(*) > 1 ORDER BY MFGId')
+        return (pns, cur.fetchall())
 
     def get_mfgrs(self, like=None):
         """
@@ -72,11 +1084,12 @@ class BOMdb:
         :param like: Database matching string. Use % as a wild card
         :return: List of manufacturer tuples
         """
+        cur = self.conn.cursor()
         if like != None:
-            self.cur.execute('SELECT MFGName FROM mlist WHERE MFGName LIKE ? ORDER BY MFGName ASC')
+            cur.execute('SELECT MFGName FROM mlist WHERE MFGName LIKE ? ORDER BY MFGName ASC')
         else:
-            self.cur.execute('SELECT MFGName FROM mlist ORDER BY MFGName ASC')
-        return self.cur.fetchall()
+            cur.execute('SELECT MFGName FROM mlist ORDER BY MFGName ASC')
+        return cur.fetchall()
 
 
 
@@ -97,8 +1110,9 @@ class BOMdb:
         Return a list of dictionary entries ordered by the manufacturer ID (mid).
         :return: List of 2 element dictionaries containing keys mid, and mname
         """
-        self.cur.execute('SELECT MFGid,MFGName FROM mlist ORDER BY MFGid ASC')
-        rows = self.cur.fetchall()
+        cur = self.conn.cursor()
+        cur.execute('SELECT MFGid,MFGName FROM mlist ORDER BY MFGid ASC')
+        rows = cur.fetchall()
         res = []
         for row in rows:
             res.append({"mid": row[0], "mname": row[1]})
@@ -112,8 +1126,82 @@ class BOMdb:
         :param pn: The part number to look up
         :return: The part number and description if there was a match, else None
         """
-        self.cur.execute('SELECT PartNumber,Description FROM pndesc WHERE PartNumber = ?', [pn])
-        return self.cur.fetchone()
+        if self.cache:
+            return self._cached('pn', pn, self._lookup_pn)
+        return self._lookup_pn(pn)
+
+    def _lookup_pn(self, pn):
+        cur = self.conn.cursor()
+        cur.execute('SELECT PartNumber,Description FROM pndesc WHERE PartNumber = ?', [pn])
+        return cur.fetchone()
+
+    def _lookup_chunked(self, query, keys):
+        """
+        Run a query containing an IN ({}) clause for a large number of keys.
+        The keys are de-duplicated and bound in chunks of lookupChunkSize.
+        :param query: Query with a {} placeholder for the IN clause parameters
+        :param keys: Iterable of keys
+        :return: Yields the result rows of every chunk
+        """
+        keys = list(dict.fromkeys(keys))
+        cur = self.conn.cursor()
+        for i in range(0, len(keys), lookupChunkSize):
+            chunk = keys[i:i + lookupChunkSize]
+            cur.execute(query.format(','.join('?' * len(chunk))), chunk)
+            for row in cur:
+                yield row
+
+    def lookup_pns(self, pns):
+        """
+        Look up descriptions for many part numbers at once
+        :param pns: Iterable of part numbers to look up
+        :return: Dictionary keyed by part number containing (part number, description) tuples.
+        Part numbers which were not found are not in the dictionary.
+        """
+        res = {}
+        for row in self._lookup_chunked('SELECT PartNumber,Description FROM pndesc WHERE PartNumber IN ({})', pns):
+            res.setdefault(row[0], row)
+        return res
+
+    def lookup_mpns(self, mpns):
+        """
+        Look up many manufacturer part numbers at once
+        :param mpns: Iterable of manufacturer part numbers to look up
+        :return: Dictionary keyed by manufacturer part number containing a list of
+        (part number, manufacturer name, manufacturer part number, manufacturer ID) tuples, one for
+        each part number the MPN is listed under. MPN's which were not found are not in the dictionary.
+        """
+        res = {}
+        query = 'SELECT p.PartNumber,m.MFGName,p.MPN,p.Manufacturer,m.MFGId FROM pnmpn p ' \
+                'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer WHERE p.MPN IN ({}) ORDER BY p.rowid'
+        for row in self._lookup_chunked(query, mpns):
+            if row[4] is None:
+                raise(ValueError) # Something is messed up in the database
+            res.setdefault(row[2], []).append(row[0:4])
+        return res
+
+    def lookup_mpn_by_pns(self, pns):
+        """
+        Returns all manufacturers and manufacturer part numbers for many part numbers at once
+        :param pns: Iterable of part numbers to look up
+        :return: Dictionary keyed by part number containing lists of dictionaries in the same form
+        as returned by lookup_mpn_by_pn(). Part numbers without sources are not in the dictionary.
+        """
+        if self.mfg_table_has_datasheet_col():
+            datasheet = 'p.DataSheet'
+        else:
+            datasheet = 'NULL'
+
+        res = {}
+        query = 'SELECT p.PartNumber,p.Manufacturer,p.MPN,{},m.MFGName,m.MFGId FROM pnmpn p ' \
+                'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer WHERE p.PartNumber IN ({{}}) ' \
+                'ORDER BY p.rowid'.format(datasheet)
+        for item in self._lookup_chunked(query, pns):
+            if item[5] is None:
+                raise(ValueError) # Something is messed up in the database
+            res.setdefault(item[0], []).append({'pn' : item[0],'mid' : item[1], 'mpn' : item[2],
+                                                'datasheet':item[3], 'mname' : item[4]})
+        return res
 
     def lookup_mfg(self, mfgr):
         """
@@ -122,8 +1210,11 @@ class BOMdb:
         :param  a manufacturer name:
         :return: the Manufacturer name and ID if found else None
         """
-        self.cur.execute('SELECT MFGName,MFGId FROM mlist WHERE MFGName = ?', [mfgr])
-        return self.cur.fetchone()
+        if self.cache:
+            return self._load_mfgrs()[1].get(mfgr)
+        cur = self.conn.cursor()
+        cur.execute('SELECT MFGName,MFGId FROM mlist WHERE MFGName = ?', [mfgr])
+        return cur.fetchone()
 
     def lookup_mfg_by_id(self, mid):
         """
@@ -131,8 +1222,11 @@ class BOMdb:
         :param mid: The manufacturer ID to look up
         :return: the manufacturer name and ID if found else None
         """
-        self.cur.execute('SELECT MFGName,MFGId FROM mlist WHERE MFGId = ?', [mid])
-        return self.cur.fetchone()
+        if self.cache:
+            return self._load_mfgrs()[0].get(mid)
+        cur = self.conn.cursor()
+        cur.execute('SELECT MFGName,MFGId FROM mlist WHERE MFGId = ?', [mid])
+        return cur.fetchone()
 
     def lookup_mpn(self, mpn):
         """
@@ -142,25 +1236,154 @@ class BOMdb:
         :param mpn: a manufacturer part number
         :return: a tuple containing: (part number, manufacturer name, manufacturer part number, manufacturer ID)
         """
+        cur = self.conn.cursor()
 
-        self.cur.execute('SELECT PartNumber,Manufacturer,MPN FROM pnmpn WHERE MPN = ?', [mpn])
-        res = self.cur.fetchone()
+        cur.execute('SELECT p.PartNumber,m.MFGName,p.MPN,p.Manufacturer,m.MFGId FROM pnmpn p '
+                         'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer WHERE p.MPN = ?', [mpn])
+        res = cur.fetchone()
         if(res is None):
             return None
-        pn = res[0]
-        mid = res[1]
-        mpn = res[2]
+        if res[4] is None:
+            raise(ValueError) # Something is messed up in the database
 
-        # Convert Manufacturer ID to name
+        return res[0:4]
 
-        res = self.lookup_mfg_by_id(mid)
-        if res is not None:
-            mname = res[0]
-        else:
-            raise(ValueError) # Something is messed up in the database
 
-        return (pn, mname, mpn, mid)
+    def has_fulltext(self):
+        """
+        :return: True if the database has the full text search index
+        """
+        return 'partsearch' in self._indexes
+
+    def search(self, text, limit=100):
+        """
+        Search part descriptions and manufacturer part numbers for words in any order.
+        Each word matches the start of a word in a description or MPN, so "10K 0603" finds "RES,10K,0603,1%".
+        Words shorter than searchMinLength are left out.
+        :param text: Words to search for
+        :param limit: Maximum number of results
+        :return: List of part numbers and descriptions, best matches first. Empty if no word is long enough.
+        """
+        words = [word for word in re.split(r'[^\w.]+', text) if len(word) >= searchMinLength]
+        if not words:
+            return []
+        cur = self.conn.cursor()
+        if not self.has_fulltext():
+            # No full text index, fall back to matching every word anywhere in the description
+            cur.execute('SELECT PartNumber,Description FROM pndesc WHERE ' +
+                        ' AND '.join(['Description LIKE ?'] * len(words)) + ' ORDER BY PartNumber ASC LIMIT ?',
+                        ['%{}%'.format(word) for word in words] + [limit])
+            return cur.fetchall()
+        match = ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+        # Rank description matches above MPN matches
+        cur.execute('SELECT d.PartNumber,d.Description FROM partsearch s JOIN pndesc d ON d.rowid = s.rowid '
+                    'WHERE partsearch MATCH ? ORDER BY bm25(partsearch, 2.0, 1.0), d.PartNumber LIMIT ?', [match, limit])
+        return cur.fetchall()
+
+    def has_trigrams(self):
+        """
+        :return: True if the database has the trigram index used by similar_parts()
+        """
+        return 'desctrigram' in self._indexes
+
+    def similar_parts(self, desc, limit=10, min_similarity=0.3):
+        """
+        Find the parts with descriptions most like the argument, for example to warn about a
+        part being added twice. Similarity is the number of trigrams the descriptions have in common
+        divided by the number of distinct trigrams in both, so CAP,CER,100NF,0402 is similar to
+        CAP,CER,0.1UF,0402. Without the trigram index every description in the database is compared.
+        :param desc: Description to compare
+        :param limit: Maximum number of results
+        :param min_similarity: Smallest similarity returned, from 0 to 1
+        :return: List of (part number, description, similarity) tuples, most similar first
+        """
+        grams = trigrams(desc)
+        if not grams:
+            return []
+        similarities = {}
+        res = []
+
+        def score(rows, threshold):
+            # Rows of a description and a JSON array of the part numbers with it
+            for (other, pns) in rows:
+                if other not in similarities:
+                    othergrams = trigrams(other)
+                    similarities[other] = len(grams & othergrams) / len(grams | othergrams)
+                if similarities[other] >= threshold:
+                    res.extend((pn, other, similarities[other]) for pn in json.loads(pns))
+            res.sort(key=lambda part: (-part[2], part[0]))
+            del res[limit:]
+
+        def phrase(gram):
+            return '"{}"'.format(gram.replace('"', '""'))
+
+        cur = self.conn.cursor()
+        if not self.has_trigrams():
+            cur.execute('SELECT Description,json_group_array(PartNumber) FROM pndesc GROUP BY Description')
+            score(cur, min_similarity)
+            return res
+
+        # A description with similarity t has at least ceil(t * n) of the n trigrams, so it has at least one of
+        # the n - ceil(t * n) + 1 rarest. Fetch the descriptions with each trigram, rarest first, and stop once
+        # the trigrams left can't find anything as similar as the results so far.
+        cur.execute('CREATE VIRTUAL TABLE IF NOT EXISTS temp.desctrigram_vocab USING fts5vocab(main, desctrigram, row)')
+        cur.execute('SELECT term,doc FROM temp.desctrigram_vocab WHERE term IN ({})'.format(','.join('?' * len(grams))),
+                    [gram.lower() for gram in grams])
+        docs = dict(cur.fetchall())
+        found = sorted((gram for gram in grams if gram.lower() in docs), key=lambda gram: docs[gram.lower()])
+        threshold = min_similarity
+        for (i, gram) in enumerate(found):
+            if i > len(grams) - math.ceil(threshold * len(grams) - 1e-9):
+                break
+            # Leave out the descriptions already fetched for rarer trigrams
+            match = phrase(gram)
+            if i:
+                match += ' NOT ({})'.format(' OR '.join(phrase(rarer) for rarer in found[0:i]))
+            cur.execute('SELECT d.Description,json_group_array(d.PartNumber) FROM desctrigram t JOIN pndesc d ON d.rowid = t.rowid '
+                        'WHERE desctrigram MATCH ? GROUP BY d.Description', [match])
+            score(cur, threshold)
+            if len(res) == limit:
+                threshold = max(threshold, res[-1][2])
+        return res
+
+    def has_mpn_keys(self):
+        """
+        :return: True if the database schema has the canonical MPN keys used by lookup_mpn_canonical()
+        """
+        return self.schema_version() >= (0, 5)
 
+    def lookup_mpn_canonical(self, mpn):
+        """
+        Look up the manufacturer part numbers which are the same as the argument once punctuation,
+        white space and case are ignored. See mpn_key().
+        On databases without canonical keys only exact matches are found.
+        :param mpn: a manufacturer part number
+        :return: a list of tuples containing: (part number, manufacturer name, manufacturer part number, manufacturer ID).
+        Empty list returned if no match
+        """
+        return self.lookup_mpns_canonical([mpn]).get(mpn_key(mpn), [])
+
+    def lookup_mpns_canonical(self, mpns):
+        """
+        Look up many manufacturer part numbers at once, ignoring punctuation, white space and case
+        :param mpns: Iterable of manufacturer part numbers to look up
+        :return: Dictionary keyed by the canonical key of each MPN found (see mpn_key()) containing a list of
+        (part number, manufacturer name, manufacturer part number, manufacturer ID) tuples.
+        """
+        res = {}
+        if self.has_mpn_keys():
+            query = 'SELECT p.PartNumber,m.MFGName,p.MPN,p.Manufacturer,m.MFGId FROM pnmpn p ' \
+                    'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer WHERE p.MPNKey IN ({}) ORDER BY p.rowid'
+            keys = [mpn_key(mpn) for mpn in mpns]
+        else:
+            query = 'SELECT p.PartNumber,m.MFGName,p.MPN,p.Manufacturer,m.MFGId FROM pnmpn p ' \
+                    'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer WHERE p.MPN IN ({}) ORDER BY p.rowid'
+            keys = mpns
+        for row in self._lookup_chunked(query, keys):
+            if row[4] is None:
+                raise(ValueError) # Something is messed up in the database
+            res.setdefault(mpn_key(row[2]), []).append(row[0:4])
+        return res
 
     def lookup_mpn_like(self, mpn):
         """
@@ -170,9 +1393,10 @@ class BOMdb:
         :param mpn: a manufacturer part number
         :return: a list of tuples containing: part number, manufacturer part number. Empty list returned if no match
         """
+        cur = self.conn.cursor()
 
-        self.cur.execute('SELECT PartNumber,MPN FROM pnmpn WHERE MPN LIKE ?', [mpn])
-        res = self.cur.fetchall()
+        cur.execute('SELECT PartNumber,MPN FROM pnmpn WHERE MPN LIKE ?', [mpn])
+        res = cur.fetchall()
         return res
 
     def lookup_part_by_pn_mpn(self, pn, mpn):
@@ -181,24 +1405,17 @@ class BOMdb:
         :param mpn: a manufacturer part number
         :return: a tuple containing: (part number, manufacturer name, manufacturer part number, manufacturer ID)
         """
+        cur = self.conn.cursor()
 
-        self.cur.execute('SELECT PartNumber,Manufacturer,MPN FROM pnmpn WHERE PartNumber = ? AND MPN = ?', [pn, mpn])
-        res = self.cur.fetchone()
+        cur.execute('SELECT p.PartNumber,m.MFGName,p.MPN,p.Manufacturer,m.MFGId FROM pnmpn p '
+                         'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer WHERE p.PartNumber = ? AND p.MPN = ?', [pn, mpn])
+        res = cur.fetchone()
         if(res is None):
             return None
-        pn = res[0]
-        mid = res[1]
-        mpn = res[2]
-
-        # Convert Manufacturer ID to name
-
-        res = self.lookup_mfg_by_id(mid)
-        if res is not None:
-            mname = res[0]
-        else:
+        if res[4] is None:
             raise(ValueError) # Something is messed up in the database
 
-        return (pn, mname, mpn, mid)
+        return res[0:4]
 
     def lookup_mfg_by_pn_mpn(self, pn, mpn):
         """
@@ -207,23 +1424,17 @@ class BOMdb:
         :param mpn: a manufacturer part number
         :return: a tuple containing: (manufacturer name, manufacturer ID)
         """
+        cur = self.conn.cursor()
 
-        self.cur.execute('SELECT Manufacturer FROM pnmpn WHERE PartNumber = ? AND MPN = ?', [pn, mpn])
-        res = self.cur.fetchone()
+        cur.execute('SELECT m.MFGName,p.Manufacturer,m.MFGId FROM pnmpn p '
+                         'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer WHERE p.PartNumber = ? AND p.MPN = ?', [pn, mpn])
+        res = cur.fetchone()
         if(res is None):
             return None
-        mid = res[0]
-
-
-        # Convert Manufacturer ID to name
-
-        res = self.lookup_mfg_by_id(mid)
-        if res is not None:
-            mname = res[0]
-        else:
+        if res[2] is None:
             raise(ValueError) # Something is messed up in the database
 
-        return (mname, mid)
+        return res[0:2]
 
     def mfg_table_has_datasheet_col(self):
         """
@@ -242,30 +1453,27 @@ class BOMdb:
         mname: Manufacturer Name}
 
         """
-
-        hdc = self.mfg_table_has_datasheet_col()
-
-        if hdc:
-            self.cur.execute('SELECT PartNumber,Manufacturer,MPN,DataSheet FROM pnmpn WHERE PartNumber = ?', [pn])
+        if self.cache:
+            # Hand out copies so the caller can't alter the cached dictionaries
+            return [dict(item) for item in self._cached('sources', pn, self._lookup_mpn_by_pn)]
+        return self._lookup_mpn_by_pn(pn)
+
+    def _lookup_mpn_by_pn(self, pn):
+        cur = self.conn.cursor()
+        if self.mfg_table_has_datasheet_col():
+            datasheet = 'p.DataSheet'
         else:
-            self.cur.execute('SELECT PartNumber,Manufacturer,MPN FROM pnmpn WHERE PartNumber = ?',[pn])
+            datasheet = 'NULL'
 
-        res = self.cur.fetchall()
+        cur.execute('SELECT p.PartNumber,p.Manufacturer,p.MPN,{},m.MFGName,m.MFGId FROM pnmpn p '
+                         'LEFT JOIN mlist m ON m.MFGId = p.Manufacturer WHERE p.PartNumber = ? '
+                         'ORDER BY p.rowid'.format(datasheet), [pn])
 
         reslist = []
-        for item in res:
-            if hdc:
-                reslist.append({'pn' : item[0],'mid' : item[1], 'mpn' : item[2],'datasheet':item[3]})
-            else:
-                reslist.append({'pn' : item[0],'mid' : item[1], 'mpn' : item[2],'datasheet':None})
-
-        for i,item in enumerate(reslist):
-            # Convert Manufacturer ID to name
-            res = self.lookup_mfg_by_id(reslist[i]['mid'])
-            if res is not None:
-                reslist[i]['mname'] = res[0]
-            else:
+        for item in cur.fetchall():
+            if item[5] is None:
                 raise(ValueError) # Something is messed up in the database
+            reslist.append({'pn' : item[0],'mid' : item[1], 'mpn' : item[2],'datasheet':item[3], 'mname' : item[4]})
 
         return reslist
 
@@ -274,8 +1482,9 @@ class BOMdb:
         Return the highest numbered pn in the database
         :return: Part number
         """
-        self.cur.execute('SELECT MAX(PartNumber) from pndesc')
-        res = self.cur.fetchone()
+        cur = self.conn.cursor()
+        cur.execute('SELECT MAX(PartNumber) from pndesc')
+        res = cur.fetchone()
         if(res is not None):
             return res[0]
         else:
@@ -287,12 +1496,133 @@ class BOMdb:
         :return: Highest mid
 
         """
-        self.cur.execute('SELECT MAX(MFGId) from mlist')
-        res = self.cur.fetchone()
+        cur = self.conn.cursor()
+        cur.execute('SELECT MAX(MFGId) from mlist')
+        res = cur.fetchone()
         if(res is not None):
             res = res[0]
         return res
 
+    def _sequence(self, key, count, query, params, first, claim=True, floor=None):
+        """
+        Hand out the next numbers of a sequence whose last number is stored in the config table.
+        The numbers start after the stored number or the highest number in use, whichever is greater,
+        so part numbers added by hand or by older tools are never handed out again. The sequence
+        only starts at first when there is neither.
+        The config row is read and written while holding the database write lock (BEGIN IMMEDIATE,
+        or the lock already held by an open transaction), so two tools can't claim the same numbers.
+        :param key: Config table key holding the last number handed out
+        :param count: How many numbers to claim
+        :param query: Query returning the highest number in use, or NULL
+        :param params: Query parameters
+        :param first: First number of the sequence, used when no number is stored or in use
+        :param claim: If False, return the next number without claiming it
+        :param floor: Optional lowest number which may be handed out
+        :return: First number of the block
+        """
+        cur = self.conn.cursor()
+        began = claim and not self.conn.in_transaction
+        if began:
+            cur.execute('BEGIN IMMEDIATE')
+        try:
+            cur.execute('SELECT value FROM config WHERE key = ?', [key])
+            stored = cur.fetchone()
+            cur.execute(query, params)
+            used = cur.fetchone()[0]
+            known = [int(num) for num in [stored and stored[0], used] if num is not None]
+            last = max(known) if known else first - 1
+            if floor is not None:
+                last = max(last, floor - 1)
+            if claim:
+                if stored is None:
+                    cur.execute('INSERT INTO config (key,value) VALUES (?,?)', [key, str(last + count)])
+                else:
+                    cur.execute('UPDATE config SET value = ? WHERE key = ?', [str(last + count), key])
+        except BaseException:
+            if began:
+                self.conn.rollback()
+            raise
+        if began and not self.in_transaction():
+            self.conn.commit()
+        return last + 1
+
+    def next_pn(self, firstpn='800000-101'):
+        """
+        Return the part number allocate_pns() would hand out next, without claiming it
+        :param firstpn: Part number used when the database has none
+        :return: Part number
+        """
+        return self.allocate_pns(1, firstpn, claim=False)[0]
+
+    def allocate_pns(self, count=1, firstpn='800000-101', above=None, claim=True):
+        """
+        Claim a block of new part numbers. Each has a new prefix and the suffix 101.
+        Safe to use from several tools at once. Numbers claimed but not used are skipped.
+        :param count: Number of part numbers
+        :param firstpn: Part number used when the database has none
+        :param above: Optional part number the new ones must follow, for example the highest one about to be added
+        :param claim: If False, return the part numbers without claiming them
+        :return: List of part numbers
+        """
+        floor = int(above.split('-')[0]) + 1 if above is not None else None
+        prefix = self._sequence('pn_sequence', count, 'SELECT CAST(substr(MAX(PartNumber), 1, 6) AS INTEGER) FROM pndesc',
+                                [], int(firstpn.split('-')[0]), claim, floor)
+        return ['{prefix:06d}-{suffix:03d}'.format(prefix=num, suffix=101) for num in range(prefix, prefix + count)]
+
+    def allocate_tabulated_pn(self, pn, claim=True):
+        """
+        Claim the next free -1xx suffix for a tabulated part number (a series of parts sharing a prefix)
+        :param pn: Part number or prefix, for example 800123-101 or 800123-
+        :param claim: If False, return the part number without claiming it
+        :return: Part number. ValueError is raised if suffixes 101 through 199 are all used.
+        """
+        prefix = pn.split('-')[0]
+        if self.in_transaction() or not claim:
+            suffix = self._tabulated_suffix(prefix, claim)
+        else:
+            with self.transaction():
+                suffix = self._tabulated_suffix(prefix, claim)
+        return '{}-{:03d}'.format(prefix, suffix)
+
+    def _tabulated_suffix(self, prefix, claim):
+        suffix = self._sequence('pn_suffix:' + prefix, 1,
+                                'SELECT CAST(substr(MAX(PartNumber), 8) AS INTEGER) FROM pndesc WHERE PartNumber BETWEEN ? AND ?',
+                                [prefix + '-100', prefix + '-199'], 101, claim)
+        if suffix > 199:
+            raise(ValueError('No free suffixes left for {}'.format(prefix)))
+        return suffix
+
+    def allocate_mids(self, count=1):
+        """
+        Claim a block of new manufacturer ID's. Safe to use from several tools at once.
+        :param count: Number of manufacturer ID's
+        :return: List of manufacturer ID's
+        """
+        num = self._sequence('mid_sequence', count, 'SELECT CAST(substr(MAX(MFGId), 2) AS INTEGER) FROM mlist', [], 0)
+        return ['M{num:07d}'.format(num=mid) for mid in range(num, num + count)]
+
+    def write_snapshot(self, path):
+        """
+        Write a lookup snapshot of every part number, description and ordered list of sources for the merge scripts.
+        The file is written under a temporary name and renamed, so readers never see a partial snapshot.
+        :param path: Snapshot file path
+        :return: Number of part numbers written
+        """
+        return partsdb.write_snapshot(self.conn, self.dbfile, path)
+
+    def _insert_sources(self, cur, sources):
+        """
+        Insert pnmpn rows, filling in their canonical MPN keys if the database has them
+        :param cur: Database cursor
+        :param sources: List of (part number, manufacturer ID, manufacturer part number) tuples
+        :return: N/A
+        """
+        if self.has_mpn_keys():
+            cur.executemany('INSERT INTO pnmpn (PartNumber,Manufacturer,MPN,MPNKey) VALUES (?,?,?,?)',
+                            [tuple(source) + (mpn_key(source[2]),) for source in sources])
+        else:
+            cur.executemany('INSERT INTO pnmpn (PartNumber,Manufacturer,MPN) VALUES (?,?,?)', sources)
+
     def add_pn(self, pn, desc, mid, mpn ):
         """
         Add a part number to the database, add corresponding manufacturer part number and manufacturer
@@ -302,15 +1632,17 @@ class BOMdb:
         :param mpn:  Manufacturer part number
         :return: N/A
         """
+        cur = self.conn.cursor()
 
         # Insert part number and description
-        self.cur.execute('INSERT INTO pndesc (PartNumber,Description) VALUES (?,?)', [pn, desc])
+        cur.execute('INSERT INTO pndesc (PartNumber,Description) VALUES (?,?)', [pn, desc])
 
         # Insert part number, manufacturer id, and manufactuer part number
-        self.cur.execute('INSERT INTO pnmpn (PartNumber,Manufacturer,MPN) VALUES (?,?,?)', [pn, mid, mpn])
+        self._insert_sources(cur, [(pn, mid, mpn)])
+        self._invalidate_part(pn)
 
         # Save (commit) the changes
-        self.conn.commit()
+        self._commit()
 
     def add_mpn(self, pn, mid, mpn):
         """
@@ -321,9 +1653,11 @@ class BOMdb:
         :param mpn: Manufacturer's part number
         :return: N/A
         """
+        cur = self.conn.cursor()
 
-        self.cur.execute('INSERT INTO pnmpn (PartNumber,Manufacturer,MPN) VALUES (?,?,?)', [pn, mid, mpn])
-        self.conn.commit()
+        self._insert_sources(cur, [(pn, mid, mpn)])
+        self._invalidate_part(pn, desc=False)
+        self._commit()
 
     def add_mfg_to_mlist(self, mfg, mid):
         """
@@ -333,23 +1667,129 @@ class BOMdb:
         :param mid:  Manufacturer ID
         :return: N/A
         """
+        cur = self.conn.cursor()
          # Insert the manufacturer
-        self.cur.execute('INSERT INTO mlist (MFGId,MFGName) VALUES (?,?)', [mid, mfg])
+        cur.execute('INSERT INTO mlist (MFGId,MFGName) VALUES (?,?)', [mid, mfg])
+        self._invalidate_mfgrs()
 
         # Save (commit) the changes
-        self.conn.commit()
+        self._commit()
+
+    @contextmanager
+    def _trigger_off(self, cur, name):
+        """
+        Drop a trigger for the duration of a block and put it back afterwards, all inside one transaction.
+        FTS5 flushes its pending changes after every statement run by a trigger, which makes bulk inserts
+        very slow. The bulk mutators hold the search index triggers off and update the index themselves.
+        If the block fails and the transaction was begun here, it is rolled back, which also puts the trigger back.
+        :param cur: Database cursor
+        :param name: Trigger name in searchTriggers. Nothing is done if the database doesn't have its index.
+        :return: N/A
+        """
+        (index, sql) = searchTriggers[name]
+        if index not in self._indexes:
+            yield
+            return
+        began = not self.conn.in_transaction
+        if began:
+            cur.execute('BEGIN')
+        try:
+            cur.execute('DROP TRIGGER IF EXISTS {}'.format(name))
+            yield
+        except BaseException:
+            if began:
+                self.conn.rollback()
+            else:
+                cur.execute(sql)
+            raise
+        cur.execute(sql)
+
+    def add_pns(self, parts):
+        """
+        Add many part numbers and descriptions at once
+        :param parts: List of (part number, description) tuples
+        :return: N/A
+        """
+        cur = self.conn.cursor()
+        with self._trigger_off(cur, 'pndesc_insert_search'), self._trigger_off(cur, 'pndesc_insert_trigram'):
+            cur.execute('SELECT MAX(rowid) FROM pndesc')
+            last = cur.fetchone()[0] or 0
+            cur.executemany('INSERT INTO pndesc (PartNumber,Description) VALUES (?,?)', parts)
+            # New rows always get rowids above the highest one in use
+            if self.has_fulltext():
+                cur.execute("INSERT INTO partsearch (rowid, Description, MPNs) SELECT d.rowid, d.Description, "
+                            "(SELECT group_concat(p.MPN, ' ') FROM pnmpn p WHERE p.PartNumber = d.PartNumber) "
+                            "FROM pndesc d WHERE d.rowid > ?", [last])
+            if self.has_trigrams():
+                cur.execute('INSERT INTO desctrigram (rowid, Description) SELECT rowid, Description FROM pndesc '
+                            'WHERE rowid > ?', [last])
+        for (pn, desc) in parts:
+            self._invalidate_part(pn)
+        self._commit()
+
+    def add_mpns(self, sources):
+        """
+        Add many manufacturer's part numbers at once. They may be added before or after their part numbers:
+        add_pns() indexes the MPNs already in the database, and the search index is only updated here
+        for part numbers which are already in it.
+        :param sources: List of (part number, manufacturer ID, manufacturer part number) tuples
+        :return: N/A
+        """
+        cur = self.conn.cursor()
+        pns = set(source[0] for source in sources)
+        with self._bulk_keys(cur, pns), self._trigger_off(cur, 'pnmpn_insert_search'):
+            self._insert_sources(cur, sources)
+            self._refresh_search_mpns(cur)
+        for pn in pns:
+            self._invalidate_part(pn, desc=False)
+        self._commit()
+
+    def add_mfgs_to_mlist(self, mfgrs):
+        """
+        Add many manufacturers to the manufacturer list at once
+        :param mfgrs: List of (manufacturer, manufacturer ID) tuples
+        :return: N/A
+        """
+        cur = self.conn.cursor()
+        cur.executemany('INSERT INTO mlist (MFGName,MFGId) VALUES (?,?)', mfgrs)
+        self._invalidate_mfgrs()
+        self._commit()
+
+    def _update_one(self, query, params):
+        """
+        Run an UPDATE statement which must change exactly one row.
+        If it matches no rows or more than one row, nothing is changed and ValueError is raised.
+        :param query: UPDATE statement
+        :param params: Query parameters
+        :return: Number of rows changed
+        """
+        cur = self.conn.cursor()
+        if not self.conn.in_transaction:
+            cur.execute('BEGIN')
+        cur.execute('SAVEPOINT update_one')
+        cur.execute(query, params)
+        count = cur.rowcount
+        if count != 1:
+            cur.execute('ROLLBACK TO update_one')
+        cur.execute('RELEASE update_one')
+        if count != 1:
+            if not self.in_transaction():
+                self.conn.rollback()
+            raise(ValueError('Update matched {} rows, expected 1'.format(count)))
+        return count
 
     def update_title(self, pn, title):
         """
         Update the title (description of a part number
         :param pn: Part number
         :param title:  Title/Description
-        :return: N/A
+        :return: Number of rows changed. ValueError is raised if the part number doesn't match exactly one row.
         """
-        self.cur.execute("DELETE FROM pndesc WHERE PartNumber=?",[pn])
-        self.cur.execute('INSERT INTO pndesc (PartNumber,Description) VALUES (?,?)', [pn, title])
+        count = self._update_one('UPDATE pndesc SET Description=? WHERE PartNumber=?', [title, pn])
+        self._invalidate_part(pn)
         # Save (commit) the changes
-        self.conn.commit()
+        self._commit()
+        return count
 
     def update_mfg(self,mid, newname):
         """
@@ -357,25 +1797,34 @@ class BOMdb:
 
         :param mid: Manufacturer ID
         :param newname: New manufacturer name
-        :return: N/A
+        :return: Number of rows changed. ValueError is raised if the manufacturer ID doesn't match exactly one row.
         """
-        self.cur.execute('DELETE FROM mlist WHERE MFGId=?',[mid])
-        self.cur.execute('INSERT INTO mlist (MFGName,MFGId) VALUES (?,?)', [newname, mid])
+        count = self._update_one('UPDATE mlist SET MFGName=? WHERE MFGId=?', [newname, mid])
+        self._invalidate_mfgrs(mid)
         # Save (commit) the changes
-        self.conn.commit()
+        self._commit()
+        return count
 
     def update_mpn(self, pn, curmpn, newmpn, mid):
         """
         Update a manufacturer part number for a given part number/manufacturer part number combination.
+        The datasheet associated with the source is kept.
 
         :param pn: Affected part number
-        :param mpn: Affected manufacturer part number
+        :param curmpn: Affected manufacturer part number
+        :param newmpn: New manufacturer part number
         :param mid: New manufacturer ID
-        :return:
+        :return: Number of rows changed. ValueError is raised if the source doesn't match exactly one row.
         """
-        self.cur.execute('DELETE FROM pnmpn WHERE PartNumber=? AND MPN=? ', [pn, curmpn])
-        self.cur.execute('INSERT INTO pnmpn (PartNumber,Manufacturer,MPN) VALUES (?,?,?)',[pn, mid, newmpn])
-        self.conn.commit()
+        if self.has_mpn_keys():
+            count = self._update_one('UPDATE pnmpn SET Manufacturer=?, MPN=?, MPNKey=? WHERE PartNumber=? AND MPN=?',
+                                     [mid, newmpn, mpn_key(newmpn), pn, curmpn])
+        else:
+            count = self._update_one('UPDATE pnmpn SET Manufacturer=?, MPN=? WHERE PartNumber=? AND MPN=?',
+                                     [mid, newmpn, pn, curmpn])
+        self._invalidate_part(pn, desc=False)
+        self._commit()
+        return count
 
     def update_datasheet(self, pn, mid, mpn, datasheet):
         """
@@ -385,25 +1834,31 @@ class BOMdb:
         :param mid: Manufacturer ID
         :param mpn: Affected manufacturer part number
         :param datasheet: Path to datasheet file
-        :return:
+        :return: Number of rows changed. ValueError is raised if the source doesn't match exactly one row.
         """
-        self.cur.execute('DELETE FROM pnmpn WHERE PartNumber=? AND Manufacturer=? AND MPN=? ', [pn, mid, mpn])
-        self.cur.execute('INSERT INTO pnmpn (PartNumber,Manufacturer,MPN,DataSheet) VALUES (?,?,?,?)',[pn, mid, mpn, datasheet])
-        self.conn.commit()
+        count = self._update_one('UPDATE pnmpn SET DataSheet=? WHERE PartNumber=? AND Manufacturer=? AND MPN=?',
+                                 [datasheet, pn, mid, mpn])
+        self._invalidate_part(pn, desc=False)
+        self._commit()
+        return count
 
 
     def update_mid(self, pn, mpn, oldmid, newmid):
         """
         Update a manufacturer ID for a given part number/manufacturer part number combination.
+        The datasheet associated with the source is kept.
 
         :param pn: Affected part number
         :param mpn: Affected manufacturer part number
-        :param mid: New manufacturer ID
-        :return:
+        :param oldmid: Current manufacturer ID
+        :param newmid: New manufacturer ID
+        :return: Number of rows changed. ValueError is raised if the source doesn't match exactly one row.
         """
-        self.cur.execute('DELETE FROM pnmpn WHERE PartNumber=? AND MPN=? AND Manufacturer=? ', [pn, mpn, oldmid])
-        self.cur.execute('INSERT INTO pnmpn (PartNumber,Manufacturer,MPN) VALUES (?,?,?)',[pn, newmid, mpn])
-        self.conn.commit()
+        count = self._update_one('UPDATE pnmpn SET Manufacturer=? WHERE PartNumber=? AND MPN=? AND Manufacturer=?',
+                                 [newmid, pn, mpn, oldmid])
+        self._invalidate_part(pn, desc=False)
+        self._commit()
+        return count
 
     def remove_mid(self, mid):
         """
@@ -412,8 +1867,10 @@ class BOMdb:
         :param mid - manufacturer ID to remove
         :return: Nothing
         """
-        self.cur.execute('DELETE FROM mlist WHERE MFGid=?', [mid])
-        self.conn.commit()
+        cur = self.conn.cursor()
+        cur.execute('DELETE FROM mlist WHERE MFGid=?', [mid])
+        self._invalidate_mfgrs(mid)
+        self._commit()
 
 
     def remove_source(self, pn, mfgid, mpn):
@@ -426,8 +1883,10 @@ class BOMdb:
         :param mpn: Manufacturer's part number
         :return: N/A
         """
-        self.cur.execute('DELETE FROM pnmpn WHERE PartNumber=? AND Manufacturer=? AND MPN=? ', [pn, mfgid, mpn])
-        self.conn.commit()
+        cur = self.conn.cursor()
+        cur.execute('DELETE FROM pnmpn WHERE PartNumber=? AND Manufacturer=? AND MPN=? ', [pn, mfgid, mpn])
+        self._invalidate_part(pn, desc=False)
+        self._commit()
 
     def remove_pnmpn_record(self, part_number):
         """
@@ -436,8 +1895,10 @@ class BOMdb:
         :param part_number:
         :return: N/A
         """
-        self.cur.execute("DELETE FROM pnmpn WHERE PartNumber=? ",[part_number])
-        self.conn.commit()
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM pnmpn WHERE PartNumber=? ",[part_number])
+        self._invalidate_part(part_number, desc=False)
+        self._commit()
 
 
     def remove_part_number(self, pn, dryrun = True, annotate=False):
@@ -451,6 +1912,7 @@ class BOMdb:
         Return True if the part number was found and deleted.
 
         """
+        cur = self.conn.cursor()
         if not self.lookup_pn(pn):
             if annotate:
                 print("Part number: {} not found".format(pn))
@@ -459,34 +1921,387 @@ class BOMdb:
         mfgrs = self.lookup_mpn_by_pn(pn)
 
         if mfgrs:
-            # Remove all references to manufacturers
-            for mfgr in mfgrs:
-                mrec = self.lookup_mfg_by_id(mfgr["mid"])
-                # Do not remove Open Market manufacturer records
-                # Skip if there is no manufacturer record
-                if not mrec or mrec[0] == "Open Market" or mrec[0] == "None":
+            # Commit all of the deletions for the part number at once
+            with self.transaction():
+                # Remove all references to manufacturers
+                for mfgr in mfgrs:
+                    mrec = self.lookup_mfg_by_id(mfgr["mid"])
+                    # Do not remove Open Market manufacturer records
+                    # Skip if there is no manufacturer record
+                    if not mrec or mrec[0] == "Open Market" or mrec[0] == "None":
+                        if annotate:
+                            if mrec:
+                                print("Skipping mpn deletion due to Open Market/None manufacturer")
+                            else:
+                                print("Skipping mpn deletion due to manufacturer not found")
+                            continue
                     if annotate:
-                        if mrec:
-                            print("Skipping mpn deletion due to Open Market/None manufacturer")
-                        else:
-                            print("Skipping mpn deletion due to manufacturer not found")
-                        continue
+                        print("Delete mpn: {}".format(mfgr["mpn"]))
+                    if not dryrun:
+                        self.remove_source(pn, mfgr["mid"], mfgr["mpn"])
+
                 if annotate:
-                    print("Delete mpn: {}".format(mfgr["mpn"]))
+                    print("Delete Part Number: {}".format(pn))
                 if not dryrun:
-                    self.remove_source(pn, mfgr["mid"], mfgr["mpn"])
-
-            if annotate:
-                print("Delete Part Number: {}".format(pn))
-            if not dryrun:
-                # Delete pndesc record(s)
-                self.cur.execute('DELETE FROM pndesc WHERE PartNumber=?', [pn])
-                self.conn.commit()
-                # Delete pnmpn record
-                self.cur.execute('DELETE FROM pnmpn WHERE PartNumber=?', [pn])
-                self.conn.commit()
+                    # Delete pndesc record(s)
+                    cur.execute('DELETE FROM pndesc WHERE PartNumber=?', [pn])
+                    # Delete pnmpn record
+                    cur.execute('DELETE FROM pnmpn WHERE PartNumber=?', [pn])
+                    self._invalidate_part(pn)
         return True
 
+    @contextmanager
+    def _bulk_keys(self, cur, rows, width=1):
+        """
+        Load the keys of a bulk change into the temporary table bulkkeys (k1, k2, ...) for the duration
+        of a block, so the change can be made with one statement joined against it
+        :param cur: Database cursor
+        :param rows: List of keys, or of key tuples when width is more than 1
+        :param width: Number of columns in a key
+        :return: N/A. If the block fails and the transaction was begun here, it is rolled back.
+        """
+        columns = ['k{}'.format(i + 1) for i in range(width)]
+        if width == 1:
+            rows = [(row,) for row in rows]
+        began = not self.conn.in_transaction
+        if began:
+            cur.execute('BEGIN')
+        try:
+            cur.execute('DROP TABLE IF EXISTS temp.bulkkeys')
+            cur.execute('CREATE TEMP TABLE bulkkeys ({})'.format(','.join(columns)))
+            cur.executemany('INSERT INTO temp.bulkkeys VALUES ({})'.format(','.join('?' * width)), rows)
+            cur.execute('CREATE INDEX temp.bulkkeys_k1 ON bulkkeys (k1)')
+            yield
+        except BaseException:
+            cur.execute('DROP TABLE IF EXISTS temp.bulkkeys')
+            if began:
+                self.conn.rollback()
+            raise
+        cur.execute('DROP TABLE temp.bulkkeys')
+
+    def _refresh_search_mpns(self, cur):
+        """
+        Bring the MPNs in the search index up to date for the part numbers in bulkkeys
+        after their sources were changed with the pnmpn search triggers held off
+        :param cur: Database cursor
+        :return: N/A
+        """
+        if self.has_fulltext():
+            cur.execute("UPDATE partsearch SET MPNs = (SELECT group_concat(p.MPN, ' ') FROM pnmpn p, pndesc d "
+                        "WHERE d.rowid = partsearch.rowid AND p.PartNumber = d.PartNumber) "
+                        "WHERE rowid IN (SELECT d.rowid FROM pndesc d WHERE d.PartNumber IN (SELECT k1 FROM temp.bulkkeys))")
+
+    def remove_part_numbers(self, pns):
+        """
+        Remove many part numbers and all of their sources at once
+        :param pns: List of part numbers
+        :return: Tuple containing the number of (part numbers, sources) removed
+        """
+        cur = self.conn.cursor()
+        with self._bulk_keys(cur, pns), self._trigger_off(cur, 'pnmpn_delete_search'), \
+                self._trigger_off(cur, 'pndesc_delete_search'), self._trigger_off(cur, 'pndesc_delete_trigram'):
+            # Take the rows out of the search indexes with one statement each before they go
+            if self.has_fulltext():
+                cur.execute('DELETE FROM partsearch WHERE rowid IN '
+                            '(SELECT rowid FROM pndesc WHERE PartNumber IN (SELECT k1 FROM temp.bulkkeys))')
+            if self.has_trigrams():
+                cur.execute("INSERT INTO desctrigram (desctrigram, rowid, Description) SELECT 'delete', rowid, Description "
+                            "FROM pndesc WHERE PartNumber IN (SELECT k1 FROM temp.bulkkeys)")
+            cur.execute('DELETE FROM pnmpn WHERE PartNumber IN (SELECT k1 FROM temp.bulkkeys)')
+            sources = cur.rowcount
+            cur.execute('DELETE FROM pndesc WHERE PartNumber IN (SELECT k1 FROM temp.bulkkeys)')
+            parts = cur.rowcount
+        for pn in pns:
+            self._invalidate_part(pn)
+        self._commit()
+        return (parts, sources)
+
+    def remove_sources(self, sources):
+        """
+        Remove many sources at once. Each must match on part number, manufacturer ID and manufacturer part number.
+        :param sources: List of (part number, manufacturer ID, manufacturer part number) tuples
+        :return: Number of sources removed
+        """
+        cur = self.conn.cursor()
+        with self._bulk_keys(cur, sources, width=3), self._trigger_off(cur, 'pnmpn_delete_search'):
+            cur.execute('DELETE FROM pnmpn WHERE rowid IN (SELECT p.rowid FROM temp.bulkkeys k JOIN pnmpn p '
+                        'ON p.PartNumber = k.k1 AND p.Manufacturer = k.k2 AND p.MPN = k.k3)')
+            count = cur.rowcount
+            self._refresh_search_mpns(cur)
+        for pn in set(source[0] for source in sources):
+            self._invalidate_part(pn, desc=False)
+        self._commit()
+        return count
+
+    def remove_pnmpn_records(self, pns):
+        """
+        Remove every source of many part numbers at once
+        :param pns: List of part numbers
+        :return: Number of sources removed
+        """
+        cur = self.conn.cursor()
+        with self._bulk_keys(cur, pns), self._trigger_off(cur, 'pnmpn_delete_search'):
+            cur.execute('DELETE FROM pnmpn WHERE PartNumber IN (SELECT k1 FROM temp.bulkkeys)')
+            count = cur.rowcount
+            self._refresh_search_mpns(cur)
+        for pn in set(pns):
+            self._invalidate_part(pn, desc=False)
+        self._commit()
+        return count
+
+    def remove_mids(self, mids):
+        """
+        Remove many manufacturer IDs from the MFGid table at once
+        :param mids: List of manufacturer IDs
+        :return: Number of manufacturers removed
+        """
+        cur = self.conn.cursor()
+        with self._bulk_keys(cur, mids):
+            cur.execute('DELETE FROM mlist WHERE MFGId IN (SELECT k1 FROM temp.bulkkeys)')
+            count = cur.rowcount
+        for mid in set(mids):
+            self._invalidate_mfgrs(mid)
+        self._commit()
+        return count
+
+    def remove_duplicate_keys(self, pns, mids):
+        """
+        Remove the extra rows of part numbers and manufacturer IDs listed more than once, keeping the first
+        :param pns: List of part numbers
+        :param mids: List of manufacturer IDs
+        :return: Number of rows removed
+        """
+        cur = self.conn.cursor()
+        count = 0
+        for (keys, table, column) in [(pns, 'pndesc', 'PartNumber'), (mids, 'mlist', 'MFGId')]:
+            if not keys:
+                continue
+            with self._bulk_keys(cur, keys):
+                cur.execute('DELETE FROM {0} WHERE {1} IN (SELECT k1 FROM temp.bulkkeys) AND rowid > '
+                            '(SELECT MIN(f.rowid) FROM {0} f WHERE f.{1} = {0}.{1})'.format(table, column))
+                count += cur.rowcount
+        for pn in pns:
+            self._invalidate_part(pn)
+        for mid in mids:
+            self._invalidate_mfgrs(mid)
+        self._commit()
+        return count
+
+    def remove_duplicate_sources(self, sources):
+        """
+        Remove the extra rows of sources listed more than once, keeping the first
+        :param sources: List of (part number, manufacturer ID, manufacturer part number) tuples
+        :return: Number of rows removed
+        """
+        cur = self.conn.cursor()
+        with self._bulk_keys(cur, sources, width=3), self._trigger_off(cur, 'pnmpn_delete_search'):
+            cur.execute('DELETE FROM pnmpn WHERE rowid IN (SELECT p.rowid FROM temp.bulkkeys k JOIN pnmpn p '
+                        'ON p.PartNumber = k.k1 AND p.Manufacturer = k.k2 AND p.MPN = k.k3 '
+                        'WHERE p.rowid > (SELECT MIN(q.rowid) FROM pnmpn q '
+                        'WHERE q.PartNumber = k.k1 AND q.Manufacturer = k.k2 AND q.MPN = k.k3))')
+            count = cur.rowcount
+            self._refresh_search_mpns(cur)
+        for pn in set(source[0] for source in sources):
+            self._invalidate_part(pn, desc=False)
+        self._commit()
+        return count
+
+    def merge_parts(self, merges):
+        """
+        Merge duplicate part numbers into the ones kept. The sources of each duplicate are moved to the part
+        number kept, except for ones it already has, then the duplicate is removed. Sources are the same if they
+        have the same manufacturer and canonical MPN key (or MPN, if the database has no keys), as with
+        get_duplicate_sources(), so LM358-DR isn't moved to a part number which has LM358DR.
+        :param merges: List of (duplicate part number, part number to keep) tuples
+        :return: Tuple containing the number of (part numbers removed, sources moved)
+        """
+        key = 'MPNKey' if self.has_mpn_keys() else 'MPN'
+        with self.transaction():
+            cur = self.conn.cursor()
+            with self._bulk_keys(cur, merges, width=2), self._trigger_off(cur, 'pnmpn_update_search'):
+                cur.execute('SELECT PartNumber,Manufacturer,{} FROM pnmpn WHERE PartNumber IN (SELECT k2 FROM temp.bulkkeys)'.format(key))
+                have = set(cur.fetchall())
+                # Two duplicates may have the same source, so only the first one moves
+                cur.execute('SELECT p.rowid,k.k2,p.Manufacturer,p.{} FROM temp.bulkkeys k JOIN pnmpn p ON p.PartNumber = k.k1 '
+                            'ORDER BY p.rowid'.format(key))
+                moves = []
+                for (rowid, keep, mid, mkey) in cur.fetchall():
+                    if mkey is None or (keep, mid, mkey) not in have:
+                        have.add((keep, mid, mkey))
+                        moves.append((keep, rowid))
+                cur.executemany('UPDATE pnmpn SET PartNumber = ? WHERE rowid = ?', moves)
+            kept = sorted(set(keep for (pn, keep) in merges))
+            with self._bulk_keys(cur, kept):
+                self._refresh_search_mpns(cur)
+            (removed, sources) = self.remove_part_numbers([pn for (pn, keep) in merges])
+            for pn in kept:
+                self._invalidate_part(pn, desc=False)
+        return (removed, len(moves))
+
+
+# Number of rows an AsyncBOMdb stream fetches from its worker thread at a time
+asyncStreamBatch = 200
+
+
+class _AsyncWorker:
+    """
+    A worker thread used by AsyncBOMdb, with the lock held by whoever is using it
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bommdb')
+        self.lock = asyncio.Lock()
+
+
+class AsyncBOMdb:
+    """
+    Asyncio front end to BOMdb, so an event loop isn't held up by sqlite3 calls.
+    Every public BOMdb method is available as a coroutine which runs the BOMdb method on a dedicated
+    worker thread, so the SQL and the results are exactly those of BOMdb. get_parts_with_sources() and
+    export_rows() are async generators, and transaction() is an async context manager.
+
+    adb = AsyncBOMdb('parts.db', options={'journal_mode': 'wal'})
+    res = await adb.lookup_pn('800000-101')
+    async with adb.transaction():
+        await adb.update_title('800000-101', 'RES,10K,0603,1%')
+    async for (pn, desc, sources) in adb.get_parts_with_sources('RES%'):
+        ...
+    await adb.close()
+
+    Each worker thread runs one call at a time. At most queue_size calls wait for a worker, and further
+    callers wait their turn in the event loop. A transaction block keeps its worker to itself until it
+    exits, and the calls made inside the block (including by tasks it starts) run on that worker.
+    Streams run on a worker of their own, as an unfinished query holds a read transaction open on its
+    connection. Changes committed while a stream is running may not show up in it.
+    """
+    def __init__(self, dbfile, cache=False, cache_size=1000, options=None, workers=1, queue_size=100):
+        """
+        :param dbfile: Database file path
+        :param cache: Passed to BOMdb
+        :param cache_size: Passed to BOMdb
+        :param options: Passed to BOMdb
+        :param workers: Number of worker threads. More than one only helps readers with journal_mode=wal.
+        :param queue_size: Maximum number of calls queued for the worker threads
+        """
+        self.db = BOMdb(dbfile, cache=cache, cache_size=cache_size, options=options)
+        self._workers = [_AsyncWorker() for i in range(workers)]
+        self._stream_worker = _AsyncWorker()
+        self._next_worker = 0
+        self._queue = asyncio.Semaphore(queue_size)
+        self._pinned = contextvars.ContextVar('bommdb_worker', default=None)
+
+    def _pick_worker(self):
+        """
+        Return the worker for a call: the one held by the caller's transaction, an idle one, or the next in turn
+        """
+        worker = self._pinned.get()
+        if worker is not None:
+            return worker
+        for worker in self._workers:
+            if not worker.lock.locked():
+                return worker
+        self._next_worker = (self._next_worker + 1) % len(self._workers)
+        return self._workers[self._next_worker]
+
+    async def _run_on(self, worker, func, *args, **kwargs):
+        """
+        Run a function on a worker thread and return its result
+        """
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        if self._pinned.get() is worker:
+            # Inside a transaction block which already holds the worker. Don't queue behind
+            # callers waiting for the block to finish.
+            return await loop.run_in_executor(worker.executor, call)
+        async with self._queue:
+            async with worker.lock:
+                return await loop.run_in_executor(worker.executor, call)
+
+    async def _run(self, func, *args, **kwargs):
+        return await self._run_on(self._pick_worker(), func, *args, **kwargs)
+
+    async def _stream(self, func, *args):
+        """
+        Iterate over a BOMdb generator on one worker thread, fetching rows in batches.
+        Inside a transaction block the block's worker is used, so the stream sees the changes made in the block.
+        """
+        worker = self._pinned.get() or self._stream_worker
+        rows = await self._run_on(worker, func, *args)
+        try:
+            while True:
+                batch = await self._run_on(worker, lambda: [row for (i, row) in zip(range(asyncStreamBatch), rows)])
+                for row in batch:
+                    yield row
+                if len(batch) < asyncStreamBatch:
+                    break
+        finally:
+            await self._run_on(worker, rows.close)
+
+    def get_parts_with_sources(self, like=None):
+        """
+        Async generator version of BOMdb.get_parts_with_sources()
+        """
+        return self._stream(self.db.get_parts_with_sources, like)
+
+    def export_rows(self, like=None, since=None):
+        """
+        Async generator version of BOMdb.export_rows()
+        """
+        return self._stream(self.db.export_rows, like, since)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Async version of BOMdb.transaction(). The changes made inside the block are committed when the
+        outermost block exits, or rolled back if it exits with an exception.
+        :return: N/A
+        """
+        nested = self._pinned.get()
+        worker = nested or self._pick_worker()
+        if nested is None:
+            await worker.lock.acquire()
+        token = self._pinned.set(worker)
+        try:
+            block = self.db.transaction()
+            await self._run_on(worker, block.__enter__)
+            try:
+                yield self
+            except BaseException:
+                if not await self._run_on(worker, block.__exit__, *sys.exc_info()):
+                    raise
+            else:
+                await self._run_on(worker, block.__exit__, None, None, None)
+        finally:
+            self._pinned.reset(token)
+            if nested is None:
+                worker.lock.release()
+
+    async def close(self):
+        """
+        Wait for the queued calls to finish, close the database connections and stop the worker threads
+        :return: N/A
+        """
+        workers = self._workers + [self._stream_worker]
+        for worker in workers:
+            await self._run_on(worker, lambda: None)
+        await self._run(self.db.close)
+        for worker in workers:
+            worker.executor.shutdown(wait=False)
+
+
+def _async_method(name):
+    """
+    Return a coroutine function which runs a BOMdb method on an AsyncBOMdb worker thread
+    """
+    async def method(self, *args, **kwargs):
+        return await self._run(getattr(self.db, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(BOMdb, name).__doc__
+    return method
+
+
+for _name in dir(BOMdb):
+    if not _name.startswith('_') and callable(getattr(BOMdb, _name)) and not hasattr(AsyncBOMdb, _name):
+        setattr(AsyncBOMdb, _name, _async_method(_name))
 
 
 if __name__ == '__main__':
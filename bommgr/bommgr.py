@@ -21,6 +21,10 @@ __author__ = 'srodgers'
 
 import argparse
 import configparser
+import csv
+import json
+import sqlite3
+from collections import OrderedDict
 from bommdb import *
 
 defaultMpn = 'N/A'
@@ -69,13 +73,8 @@ def listParts(like=None):
     global defaultMpn, defaultMfgr
     global DB
 
-    res = DB.get_parts(like)
-
     print('{0:<20}  {1:<50}  {2:<30}  {3:<20}'.format("Part Num","Title/Description","Manufacturer","MPN"))
-    for (pn,desc) in res:
-        # Try to retrieve manufacturer info
-        minfo = DB.lookup_mpn_by_pn(pn)
-
+    for (pn,desc,minfo) in DB.get_parts_with_sources(like):
         if minfo == []: # Use defaults if it no MPN and manufacturer
             minfo =[{'mname': defaultMfgr, 'mpn': defaultMpn}]
 
@@ -111,47 +110,36 @@ def addMfgr(new_mfgr):
         raise(ValueError)
 
 
-    # Get the last used ID and generate the next ID to be used
-    mid = DB.last_mid()
-    if mid is not None:
-        mid = int(mid[1:]) + 1
-    else:
-        mid = 0
-    nextid = 'M{num:07d}'.format(num=mid)
-
-    DB.add_mfg_to_mlist(new_mfgr, nextid)
+    # Claim the next ID to be used
+    with DB.transaction():
+        nextid = DB.allocate_mids()[0]
+        DB.add_mfg_to_mlist(new_mfgr, nextid)
 
     print("Manufacturer {} added".format(new_mfgr))
 
-# Validate a part number to ensure it is in the correct 6-3 format
+# Return True if a part number is in the correct 6-3 format
 
-def validatePN(pn):
+def checkPN(pn):
     try:
         (prefix, suffix) = pn.split('-')
     except ValueError:
-        print('Error: Bad part number format, needs to be XXXXXX-YYY')
-        raise(ValueError)
+        return False
+    return len(prefix) == 6 and len(suffix) == 3
 
-    if len(prefix) != 6 or len(suffix)!= 3:
+# Validate a part number to ensure it is in the correct 6-3 format
+
+def validatePN(pn):
+    if not checkPN(pn):
         print('Error: Bad part number format, needs to be XXXXXX-YYY')
         raise(ValueError)
 
 
-# Return the next available part number
+# Return the next available part number. It isn't claimed, so another user may take it first.
 
 def nextPN():
     global DB
-     # Get the last used part number and generate the next ID to be used
-    res = DB.last_pn()
     # If this is the very first part number added use the default for firstpn
-    if res is None or res[0] is None:
-        pn = firstPn
-    else:
-        pn = res
-        (prefix, suffix) = pn.split('-')
-        nextnum = int(prefix) + 1
-        pn = '{prefix:06d}-{suffix:03d}'.format(prefix=nextnum, suffix=101)
-    return pn
+    return DB.next_pn(firstPn)
 
 # Add a new part to the database
 
@@ -174,15 +162,17 @@ def newPart(desc, newpn = None, mfg='', mpn=''):
         validatePN(newpn)
         pn = newpn
     else:
-        pn = nextPN()
+        pn = None
 
     # Avoid duplicate part number assignment if mpn is not N/A
 
-    if mpn is not None:
-        minfo = DB.lookup_mpn(mpn) # This is a check to see if the MPM exists anywhere else
-        if mpn != defaultMpn and minfo is not None and minfo[1] == mfg:
-            print("Error: MPN already exists with same manufacturer under part number {}".format(minfo[0]))
-            sys.exit(2)
+    # MPN's which only differ in punctuation, spacing or case are treated as the same MPN
+
+    if mpn is not None and mpn != defaultMpn:
+        for minfo in DB.lookup_mpn_canonical(mpn): # This is a check to see if the MPM exists anywhere else
+            if minfo[1] == mfg:
+                print("Error: MPN already exists with same manufacturer as {} under part number {}".format(minfo[2], minfo[0]))
+                sys.exit(2)
 
     # Check to see if the manufacturer exists
     minfo = DB.lookup_mfg(mfg)
@@ -196,15 +186,37 @@ def newPart(desc, newpn = None, mfg='', mpn=''):
     mid = minfo[1]
 
 
-    # We now have a valid pn, desc, mname, mpn, and mid. Insert the pn and description in the pndesc table,
-    # and insert the pn, mid, and mpn in the pnmpn table
+    # We now have a valid desc, mname, mpn, and mid. Claim a part number if need be, insert the pn
+    # and description in the pndesc table, and insert the pn, mid, and mpn in the pnmpn table
 
-    DB.add_pn(pn, desc, mid, mpn)
+    with DB.transaction():
+        if pn is None:
+            pn = DB.allocate_pns(1, firstPn)[0]
+        DB.add_pn(pn, desc, mid, mpn)
 
     return pn
 
 
 
+# Search descriptions and MPN's for words in any order and list the best matches
+
+def searchParts(text, limit=100):
+    global defaultMpn, defaultMfgr
+    global DB
+
+    parts = DB.search(text, limit)
+    sources = DB.lookup_mpn_by_pns([pn for (pn, desc) in parts])
+
+    print('{0:<20}  {1:<50}  {2:<30}  {3:<20}'.format("Part Num","Title/Description","Manufacturer","MPN"))
+    for (pn, desc) in parts:
+        minfo = sources.get(pn, [{'mname': defaultMfgr, 'mpn': defaultMpn}])
+        for i,item in enumerate(minfo):
+            if i > 0:
+                pn = ''
+                desc = ''
+            print('{0:<20}  {1:<50}  {2:<30}  {3:<20}'.format(pn, desc, item['mname'], item['mpn']))
+
+
 # Query by MPN and print results if the MPN exists
 
 def queryMPN(mpn):
@@ -247,6 +259,333 @@ def queryPN(pn):
         print('{0:<20}  {1:<50}  {2:<30}  {3:<20}'.format(pn,
             desc, defaultMfgr, defaultMpn))
 
+# Read lookup keys from a file. The keys are taken from the first column, blank lines are skipped
+
+def readKeys(filename):
+    keys = []
+    with open(filename, newline='') as keyfile:
+        for row in csv.reader(keyfile):
+            if len(row) and len(row[0].strip()):
+                keys.append(row[0].strip())
+    return keys
+
+
+# Print the results of a multi-key query in tabular form, or write them to a .csv file
+
+def printQueryResults(rows, csvfile=None):
+    columns = ["Query","Part Num","Title/Description","Manufacturer","MPN"]
+    if csvfile is not None:
+        with open(csvfile, 'w', newline='') as f:
+            out = csv.writer(f, lineterminator='\n', delimiter=',', quotechar='\"', quoting=csv.QUOTE_MINIMAL)
+            out.writerow(columns)
+            for row in rows:
+                out.writerow(row)
+        return
+
+    print('{0:<20}  {1:<20}  {2:<50}  {3:<30}  {4:<20}'.format(*columns))
+    for row in rows:
+        print('{0:<20}  {1:<20}  {2:<50}  {3:<30}  {4:<20}'.format(*row))
+
+
+# Query many PN's listed in a file
+
+def queryPNs(filename, csvfile=None):
+    global defaultMpn, defaultMfgr
+    global DB
+
+    keys = readKeys(filename)
+    parts = DB.lookup_pns(keys)
+    sources = DB.lookup_mpn_by_pns(parts.keys())
+
+    rows = []
+    for key in keys:
+        if key not in parts:
+            rows.append((key, '', 'Part number does not exist', '', ''))
+            continue
+        (pn, desc) = parts[key]
+        minfo = sources.get(pn, [{'mname': defaultMfgr, 'mpn': defaultMpn}])
+        for item in minfo:
+            rows.append((key, pn, desc, item['mname'], item['mpn']))
+    printQueryResults(rows, csvfile)
+
+
+# Query many MPN's listed in a file
+
+def queryMPNs(filename, csvfile=None):
+    global DB
+
+    keys = readKeys(filename)
+    mpns = DB.lookup_mpns(keys)
+    parts = DB.lookup_pns([item[0] for matches in mpns.values() for item in matches])
+
+    rows = []
+    for key in keys:
+        if key not in mpns:
+            rows.append((key, '', 'MPN does not exist', '', ''))
+            continue
+        for (pn, mname, mpn, mid) in mpns[key]:
+            desc = parts[pn][1] if pn in parts else ''
+            rows.append((key, pn, desc, mname, mpn))
+    printQueryResults(rows, csvfile)
+
+
+# Import parts from a .csv file with PartNumber, Description, Manufacturer and MPN columns.
+# Only Description is required. A part number is assigned when PartNumber is blank, and the default
+# manufacturer and MPN are used when those are blank. Rows which repeat a part number add alternate sources.
+# Everything is checked before anything is added, and everything is added in one transaction.
+
+def importParts(filename, dryrun=False, noprompt=False, csvfile=None):
+    global defaultMpn, defaultMfgr
+    global DB
+
+    with open(filename, newline='') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames is None or 'Description' not in reader.fieldnames:
+            print('Error: {} needs a header row with at least a Description column'.format(filename))
+            sys.exit(2)
+        rows = []
+        for row in reader:
+            rows.append({'line': reader.line_num,
+                         'pn': (row.get('PartNumber') or '').strip(),
+                         'desc': (row.get('Description') or '').strip(),
+                         'mname': (row.get('Manufacturer') or '').strip() or defaultMfgr,
+                         'mpn': (row.get('MPN') or '').strip() or defaultMpn})
+
+    conflicts = []
+    descs = {} # Descriptions of the part numbers given in the file
+    for row in rows:
+        if len(row['desc']) > 50 or (len(row['desc']) == 0 and row['pn'] not in descs):
+            conflicts.append((row['line'], 'Description must be between 1 and 50 characters'))
+        if not row['pn']:
+            continue
+        if not checkPN(row['pn']):
+            conflicts.append((row['line'], 'Bad part number format {}, needs to be XXXXXX-YYY'.format(row['pn'])))
+        elif row['pn'] not in descs:
+            descs[row['pn']] = row['desc']
+        elif row['desc'] and row['desc'] != descs[row['pn']]:
+            conflicts.append((row['line'], 'Part number {} is listed with a different description'.format(row['pn'])))
+
+    for pn in DB.lookup_pns(descs.keys()):
+        conflicts.append((None, 'Part number {} already exists'.format(pn)))
+
+    # Duplicate MPN's within the same manufacturer, in the file or in the database
+    seen = {}
+    existing = DB.lookup_mpns_canonical(row['mpn'] for row in rows if row['mpn'] != defaultMpn)
+    for row in rows:
+        if row['mpn'] == defaultMpn:
+            continue
+        key = (row['mname'], mpn_key(row['mpn']))
+        if key in seen:
+            conflicts.append((row['line'], 'MPN {} from {} is also on line {}'.format(row['mpn'], row['mname'], seen[key])))
+            continue
+        seen[key] = row['line']
+        for (pn, mname, mpn, mid) in existing.get(key[1], []):
+            if mname == row['mname']:
+                conflicts.append((row['line'], 'MPN {} from {} already exists under part number {}'.format(mpn, mname, pn)))
+
+    if conflicts:
+        for (line, message) in sorted(conflicts, key=lambda c: c[0] or 0):
+            if line is None:
+                print('Conflict: {}'.format(message))
+            else:
+                print('Conflict on line {}: {}'.format(line, message))
+        print('{} conflicts found, nothing imported'.format(len(conflicts)))
+        sys.exit(2)
+
+    # New manufacturers and rows needing part numbers. The ID's and part numbers are claimed when importing.
+    mids = {item['mname']: item['mid'] for item in DB.get_mid_name_list()}
+    newmfgrs = []
+    for row in rows:
+        if row['mname'] not in mids and row['mname'] not in newmfgrs:
+            newmfgrs.append(row['mname'])
+    newpns = [row for row in rows if not row['pn']]
+
+    print('{} part numbers, {} sources and {} new manufacturers to import'.format(len(descs) + len(newpns), len(rows),
+                                                                                 len(newmfgrs)))
+    if dryrun:
+        print('Dry run, nothing imported')
+        return
+    if not noprompt and query_yes_no('Import parts?', 'no') is False:
+        return
+
+    with DB.transaction():
+        # Claim blocks of ID's and part numbers, the part numbers after the highest one in the file
+        mids.update(zip(newmfgrs, DB.allocate_mids(len(newmfgrs))))
+        for (row, pn) in zip(newpns, DB.allocate_pns(len(newpns), firstPn, max(descs.keys(), default=None))):
+            row['pn'] = pn
+            descs[pn] = row['desc']
+        DB.add_mfgs_to_mlist([(mname, mids[mname]) for mname in newmfgrs])
+        # Add the sources first so the search index picks them up as each part number is added
+        DB.add_mpns([(row['pn'], mids[row['mname']], row['mpn']) for row in rows])
+        DB.add_pns(list(descs.items()))
+
+    results = [(row['line'], row['pn'], descs[row['pn']], row['mname'], row['mpn']) for row in rows]
+    columns = ["Line","Part Num","Title/Description","Manufacturer","MPN"]
+    if csvfile is not None:
+        with open(csvfile, 'w', newline='') as f:
+            out = csv.writer(f, lineterminator='\n', delimiter=',', quotechar='\"', quoting=csv.QUOTE_MINIMAL)
+            out.writerow(columns)
+            for row in results:
+                out.writerow(row)
+    else:
+        print('{0:<6}  {1:<20}  {2:<50}  {3:<30}  {4:<20}'.format(*columns))
+        for row in results:
+            print('{0:<6}  {1:<20}  {2:<50}  {3:<30}  {4:<20}'.format(*row))
+    print('{} part numbers imported'.format(len(descs)))
+
+
+# Apply a batch of changes listed in a .csv file with Change, PartNumber, Current and New columns.
+# Change is one of:
+#   title - Set the title of PartNumber to New
+#   mpn   - Change the manufacturer part number Current of PartNumber to New
+#   mfg   - Change the manufacturer of the manufacturer part number Current of PartNumber to New
+# Every row is checked before anything is changed, and all of the changes are made in one transaction.
+
+def modifyFromFile(filename, csvfile=None):
+    global DB
+
+    with open(filename, newline='') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames is None or not set(['Change', 'PartNumber', 'New']) <= set(reader.fieldnames):
+            print('Error: {} needs a header row with Change, PartNumber, Current and New columns'.format(filename))
+            sys.exit(2)
+        rows = []
+        for row in reader:
+            rows.append({'line': reader.line_num,
+                         'change': (row.get('Change') or '').strip().lower(),
+                         'pn': (row.get('PartNumber') or '').strip(),
+                         'cur': (row.get('Current') or '').strip(),
+                         'new': (row.get('New') or '').strip()})
+
+    parts = DB.lookup_pns(row['pn'] for row in rows)
+    # Sources of each part number, changed as each row is checked so later rows see the earlier changes
+    sources = DB.lookup_mpn_by_pns(parts.keys())
+    mids = {item['mname']: item['mid'] for item in DB.get_mid_name_list()}
+
+    failed = 0
+    for row in rows:
+        row['result'] = 'OK'
+        pn = row['pn']
+        if row['change'] not in ['title', 'mpn', 'mfg']:
+            row['result'] = 'Unknown change {}'.format(row['change'])
+        elif pn not in parts:
+            row['result'] = 'No such part number {}'.format(pn)
+        elif row['change'] == 'title':
+            if len(row['new']) == 0 or len(row['new']) > 50:
+                row['result'] = 'Title must be between 1 and 50 characters'
+        else:
+            matches = [item for item in sources.get(pn, []) if item['mpn'] == row['cur']]
+            if len(matches) != 1:
+                row['result'] = 'No such manufacturer part number {}'.format(row['cur']) if not matches else \
+                    'Manufacturer part number {} is listed more than once'.format(row['cur'])
+            elif row['change'] == 'mpn':
+                if not row['new']:
+                    row['result'] = 'New manufacturer part number is blank'
+                elif any(item['mpn'] == row['new'] and item['mid'] == matches[0]['mid'] for item in sources[pn]):
+                    row['result'] = 'Manufacturer part number {} is already listed'.format(row['new'])
+                else:
+                    row['mid'] = matches[0]['mid']
+                    matches[0]['mpn'] = row['new']
+            elif row['new'] not in mids:
+                row['result'] = 'No such manufacturer {}'.format(row['new'])
+            elif any(item['mpn'] == row['cur'] and item['mid'] == mids[row['new']] for item in sources[pn]):
+                row['result'] = 'Manufacturer part number {} is already listed for {}'.format(row['cur'], row['new'])
+            else:
+                row['mid'] = matches[0]['mid']
+                matches[0]['mid'] = mids[row['new']]
+        if row['result'] != 'OK':
+            failed += 1
+
+    if not failed:
+        with DB.transaction():
+            for row in rows:
+                if row['change'] == 'title':
+                    DB.update_title(row['pn'], row['new'])
+                elif row['change'] == 'mpn':
+                    DB.update_mpn(row['pn'], row['cur'], row['new'], row['mid'])
+                else:
+                    DB.update_mid(row['pn'], row['cur'], row['mid'], mids[row['new']])
+    else:
+        for row in rows:
+            if row['result'] == 'OK':
+                row['result'] = 'Not changed'
+
+    results = [(row['line'], row['change'], row['pn'], row['cur'], row['new'], row['result']) for row in rows]
+    columns = ["Line","Change","Part Num","Current","New","Result"]
+    if csvfile is not None:
+        with open(csvfile, 'w', newline='') as f:
+            out = csv.writer(f, lineterminator='\n', delimiter=',', quotechar='\"', quoting=csv.QUOTE_MINIMAL)
+            out.writerow(columns)
+            for row in results:
+                out.writerow(row)
+    else:
+        print('{0:<6}  {1:<6}  {2:<20}  {3:<20}  {4:<50}  {5}'.format(*columns))
+        for row in results:
+            print('{0:<6}  {1:<6}  {2:<20}  {3:<20}  {4:<50}  {5}'.format(*row))
+
+    if failed:
+        print('{} rows failed, nothing changed'.format(failed))
+        sys.exit(2)
+    print('{} changes made'.format(len(rows)))
+
+
+# Export every part number with its sources to a .csv or JSON lines file. The rows are written as
+# they are read from the database. With since, only part numbers changed after that change marker are
+# exported, along with the part numbers deleted since then. A marker file holds the marker from the
+# last export so each run picks up where the previous one left off. The marker is also saved in the
+# database, which keeps the change log back to it.
+
+exportColumns = ['PartNumber', 'Description', 'Manufacturer', 'MFGId', 'MPN', 'DataSheet']
+
+def exportParts(outfile, fmt='csv', like=None, since=None, markerfile=None):
+    global DB
+
+    if since is None and markerfile is not None and os.path.isfile(markerfile):
+        with open(markerfile) as f:
+            since = int(f.read().strip())
+
+    marker = None
+    if DB.has_changelog():
+        # Read the marker before the rows so nothing changed during the export is missed next time
+        marker = DB.change_marker()
+    elif since is not None or markerfile is not None:
+        print('Error: Incremental exports need a newer database schema. Run bommgr.py migrate to upgrade it')
+        sys.exit(2)
+    if since is not None and since < DB.changelog_start():
+        print('Error: The change log no longer goes back to export marker {}. Export everything without it'.format(since))
+        sys.exit(2)
+
+    columns = list(exportColumns)
+    if since is not None:
+        columns.append('Deleted')
+
+    count = 0
+    with open(outfile, 'w', newline='') as f:
+        if fmt == 'csv':
+            out = csv.writer(f, lineterminator='\n', delimiter=',', quotechar='\"', quoting=csv.QUOTE_MINIMAL)
+            out.writerow(columns)
+            write = lambda row: out.writerow(['' if item is None else item for item in row])
+        else:
+            write = lambda row: f.write(json.dumps(OrderedDict(zip(columns, row))) + '\n')
+
+        for row in DB.export_rows(like, since):
+            write(row + (False,) if since is not None else row)
+            count += 1
+        if since is not None:
+            for pn in DB.deleted_since(since):
+                write((pn, None, None, None, None, None, True))
+                count += 1
+
+    if markerfile is not None:
+        with open(markerfile, 'w') as f:
+            f.write('{}\n'.format(marker))
+        DB.set_setting(changeMarkerPrefix + 'export.' + os.path.abspath(markerfile), marker)
+
+    print('{} rows exported to {}'.format(count, outfile))
+    if marker is not None:
+        print('Export marker: {}'.format(marker))
+
+
 # Modify mpn
 
 def modifyMPN(partnumber, curmpn, newmpn):
@@ -256,7 +595,11 @@ def modifyMPN(partnumber, curmpn, newmpn):
         print('Error: Can\'t get current MPN record')
         raise SystemError
     mid = res[1]
-    DB.update_mpn(partnumber, curmpn, newmpn, mid)
+    try:
+        DB.update_mpn(partnumber, curmpn, newmpn, mid)
+    except ValueError:
+        print('Error: MPN {} is listed more than once under part number {}'.format(curmpn, partnumber))
+        sys.exit(2)
 
 
 # Modify manufacturer name for a given part number and MPN
@@ -281,7 +624,11 @@ def modifyMFG(partnumber, curpn, curmpn, newmfgid):
         raise SystemError
 
     # Update the manufacturer part record
-    DB.update_mid(partnumber, curmpn, oldmfgid, newmfgid)
+    try:
+        DB.update_mid(partnumber, curmpn, oldmfgid, newmfgid)
+    except ValueError:
+        print('Error: MPN {} is listed more than once under part number {}'.format(curmpn, partnumber))
+        sys.exit(2)
 
 
 if __name__ == '__main__':
@@ -294,6 +641,32 @@ if __name__ == '__main__':
 
     parser_nextpn = subparsers.add_parser('nextpn', help='Get next unassigned part number')
 
+    parser_migrate = subparsers.add_parser('migrate', help='Upgrade the database schema to the latest version')
+
+    # Full text search
+    parser_search = subparsers.add_parser('search', help='Search descriptions and MPN\'s for words in any order')
+    parser_search.add_argument('words', help='Words to search for, e.g. "10K 0603"')
+    parser_search.add_argument('--limit', type=int, default=100, help='Maximum number of parts to list')
+
+    # Lookup snapshot for the merge scripts
+    parser_snapshot = subparsers.add_parser('snapshot', help='Write the lookup snapshot used by the merge scripts')
+    parser_snapshot.add_argument('--output', help='Snapshot file to write. Default: snapshot setting in [database], or the database path with .snap added')
+
+    # Export the parts database
+    parser_export = subparsers.add_parser('export', help='Export all part numbers and their sources to a file')
+    parser_export.add_argument('file', help='File to write')
+    parser_export.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help='Output format, csv or jsonl (JSON lines)')
+    parser_export.add_argument('--like', help='Export parts with matching descriptions only')
+    parser_export.add_argument('--since', type=int, help='Export parts changed after this export marker only')
+    parser_export.add_argument('--marker-file', help='Export parts changed since the marker in this file, then save the new marker in it')
+
+    # Import parts from a .csv file
+    parser_import = subparsers.add_parser('import', help='Import parts from a .csv file')
+    parser_import.add_argument('file', help='.csv file with PartNumber, Description, Manufacturer and MPN columns')
+    parser_import.add_argument('--dry-run', action='store_true', help='Check the file and report conflicts without importing')
+    parser_import.add_argument('--noprompt', action='store_true', help='Don\'t ask for confirmation before importing')
+    parser_import.add_argument('--csv', help='Write the imported parts and their part numbers to a .csv file')
+
     # List sub sub-parser
     parser_list = subparsers.add_parser('list', help='List items')
     parser_list_subparser = parser_list.add_subparsers(dest='listwhat', help='List parts or manufacturers')
@@ -309,10 +682,14 @@ if __name__ == '__main__':
     parser_query_subparser = parser_query.add_subparsers(dest='querywhat', help='Query a part or MPN')
 
     parser_query_pn = parser_query_subparser.add_parser('pn', help='Query part number')
-    parser_query_pn.add_argument('partnumber', help='Part Number')
+    parser_query_pn.add_argument('partnumber', nargs='?', help='Part Number')
+    parser_query_pn.add_argument('--from-file', help='Query the part numbers listed one per line in a file')
+    parser_query_pn.add_argument('--csv', help='Write the results of --from-file to a .csv file')
 
     parser_query_mpn = parser_query_subparser.add_parser('mpn', help='Query manufacturer\'s part number')
-    parser_query_mpn.add_argument('mpartnumber', help='Part Number')
+    parser_query_mpn.add_argument('mpartnumber', nargs='?', help='Part Number')
+    parser_query_mpn.add_argument('--from-file', help='Query the manufacturer part numbers listed one per line in a file')
+    parser_query_mpn.add_argument('--csv', help='Write the results of --from-file to a .csv file')
 
 
     # Add sub-subparser
@@ -336,6 +713,8 @@ if __name__ == '__main__':
 
     # Modify sub-subparser
     parser_modify = subparsers.add_parser('modify', help='Modify a title, or manufacturer\'s part number (MPN)')
+    parser_modify.add_argument('--from-file', help='Make the changes listed in a .csv file with Change, PartNumber, Current and New columns')
+    parser_modify.add_argument('--csv', help='Write the results of --from-file to a .csv file')
     parser_modify_title_subparser = parser_modify.add_subparsers(dest='modifywhat', help='Modify a title')
 
     # Modify title
@@ -411,13 +790,33 @@ if __name__ == '__main__':
         print('Error: Database file {} is not writable'.format(db))
         raise(SystemError)
 
-    DB = BOMdb(db)
+    DB = BOMdb(db, options=db_options(config))
 
 
     print()
     print("Info: Database used: {}".format(os.path.abspath(db)))
     print()
 
+    if args.operation == 'migrate':
+        (major, minor) = DB.schema_version()
+        try:
+            applied = DB.migrate()
+        except sqlite3.DatabaseError as e:
+            print('Error: Migration failed, the database was not changed: {}'.format(e))
+            sys.exit(2)
+        if not applied:
+            print('Database schema version {}.{} is up to date'.format(major, minor))
+        else:
+            for description in applied:
+                print('Applied: {}'.format(description))
+            (major, minor) = DB.schema_version()
+            print('Database schema upgraded to version {}.{}'.format(major, minor))
+        sys.exit(0)
+
+    if DB.out_of_date:
+        print('Warning: Database schema is out of date. Run bommgr.py migrate to upgrade it')
+        print()
+
     # Look up default manufacturer
 
     res = DB.lookup_mfg_by_id(defaultMID)
@@ -436,6 +835,27 @@ if __name__ == '__main__':
         print(nextPN())
         sys.exit(0)
 
+    if args.operation == 'search':
+        searchParts(args.words, args.limit)
+        sys.exit(0)
+
+    if args.operation == 'snapshot':
+        snappath = os.path.expanduser(args.output) if args.output else snapshot_path(db, db_options(config))
+        if snappath == 'off':
+            print('Error: the lookup snapshot is turned off in the [database] section')
+            sys.exit(2)
+        count = DB.write_snapshot(snappath)
+        print('Wrote {} part numbers to {}'.format(count, snappath))
+        sys.exit(0)
+
+    if args.operation == 'export':
+        exportParts(args.file, args.format, args.like, args.since, args.marker_file)
+        sys.exit(0)
+
+    if args.operation == 'import':
+        importParts(args.file, args.dry_run, args.noprompt, args.csv)
+        sys.exit(0)
+
     if args.operation == 'list':
         if args.listwhat == 'mfg':
             listMfgrs()
@@ -449,10 +869,21 @@ if __name__ == '__main__':
 
     # Query by pn or mpn
     if args.operation == 'query' :
+        if args.querywhat in ['pn', 'mpn']:
+            key = args.partnumber if args.querywhat == 'pn' else args.mpartnumber
+            if (key is None) == (args.from_file is None):
+                print('Error: specify either a key or --from-file')
+                sys.exit(2)
         if args.querywhat == 'pn':
-            queryPN(args.partnumber)
+            if args.from_file is not None:
+                queryPNs(args.from_file, args.csv)
+            else:
+                queryPN(args.partnumber)
         elif args.querywhat == 'mpn':
-            queryMPN(args.mpartnumber)
+            if args.from_file is not None:
+                queryMPNs(args.from_file, args.csv)
+            else:
+                queryMPN(args.mpartnumber)
         else:
             print('Error: unknown query option {}'.format(args.querywhat))
             sys.exit(2)
@@ -465,7 +896,7 @@ if __name__ == '__main__':
             if args.specpn:
                 pn = args.specpn
             else:
-                pn = nextPN()
+                pn = nextPN() # Claimed when the part is added
             mname = defaultMfgr
             if args.manufacturer:
                 mname = args.manufacturer
@@ -480,9 +911,15 @@ if __name__ == '__main__':
                 print()
                 print("as {}, {}".format(pn, title))
                 print()
+                similar = DB.similar_parts(title, 5)
+                if len(similar):
+                    print('Similar existing parts:')
+                    for (spn, sdesc, similarity) in similar:
+                        print('{0:<20}  {1:<50}  {2:.0%}'.format(spn, sdesc, similarity))
+                    print()
                 if query_yes_no('Add new part?','no') is False:
                     sys.exit(0)
-            pn = newPart(title, pn, mname, mpn)
+            pn = newPart(title, args.specpn, mname, mpn)
             print('New part number added: {}'.format(pn))
         elif args.addwhat == 'altmpn':
             pn = args.part
@@ -494,9 +931,9 @@ if __name__ == '__main__':
                 print('Error: no such part number {}'.format(pn))
                 sys.exit(2)
             desc = res[1]
-            res = DB.lookup_mpn(mpn)
-            if res is not None:
-                print('Error: MPN {} is already in the database'.format(mpn))
+            res = DB.lookup_mpn_canonical(mpn)
+            if len(res):
+                print('Error: MPN {} is already in the database as {} under part number {}'.format(mpn, res[0][2], res[0][0]))
                 sys.exit(2)
             minfo = DB.lookup_mfg(mname)
             if args.forcenewmfg is False and minfo is None:
@@ -526,6 +963,13 @@ if __name__ == '__main__':
     # Modify a title or an MPN
     if args.operation == 'modify':
 
+        if args.from_file is not None:
+            if args.modifywhat is not None:
+                print('Error: specify either a modify option or --from-file')
+                sys.exit(2)
+            modifyFromFile(args.from_file, args.csv)
+            sys.exit(0)
+
         partnumber = ''
         if args.modifywhat in ['title', 'mpn', 'mfg']:
             partnumber = args.partnumber
@@ -536,7 +980,11 @@ if __name__ == '__main__':
 
         # Modify title
         if args.modifywhat == 'title':
-            DB.update_title(partnumber, args.title)
+            try:
+                DB.update_title(partnumber, args.title)
+            except ValueError:
+                print('Error: Part number {} is listed more than once'.format(partnumber))
+                sys.exit(2)
 
         # Modify mpn
         elif args.modifywhat == 'mpn' :
@@ -588,7 +1036,11 @@ if __name__ == '__main__':
             if(DB.lookup_mfg(newmfg) is not None):
                 print('Error: New Manufacturer already in database')
                 sys.exit(2)
-            DB.update_mfg(mid, newmfg)
+            try:
+                DB.update_mfg(mid, newmfg)
+            except ValueError:
+                print('Error: Manufacturer ID {} is listed more than once'.format(mid))
+                sys.exit(2)
 
         else:
             print('Error: unrecognized modifywhat option')
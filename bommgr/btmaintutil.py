@@ -3,39 +3,37 @@ import os
 import sys
 import argparse
 import configparser
+import json
+import re
+import sqlite3
+import time
 import click
 import bommdb
 
 defaultConfigLocations = ['/etc/bommgr/bommgr.conf', '~/.bommgr/bommgr.conf', 'bommgr.conf']
 
+# Config table key holding the change marker of the last completed check. The change log is kept back to it.
+checkMarkerKey = bommdb.changeMarkerPrefix + 'check'
 
-def make_manuf_use_list():
-    """
-    Create manufacturer use list
-    :return: a list of dictionaries with  mid, mname, and reference_count keys for each item in the list.
-    """
-    mlist = db.get_mid_name_list()
-    for item in mlist:
-        item["reference_count"] = 0
-    return mlist
+# Config table key holding the part numbers and manufacturer IDs the last check found problems with,
+# as JSON. The next incremental check looks at them again whether they changed or not.
+recheckKey = 'check_recheck'
 
+# Number of sources looked up by the optimize workload
+workloadSize = 1000
 
-def get_parts_flagged_for_deletion():
+
+def get_parts_flagged_for_deletion(since=None, recheck=None):
     """
     Return a list of parts flagged for deletion.
     If the manufacturer description field contains the word "REMOVE"
     then it is added to the list of part numbers to be deleted.
 
+    :param since: Only look at the part numbers changed after this change marker
+    :param recheck: Part numbers to look at as well as the changed ones
     :return: a list of part numbers to remove
     """
-    parts = db.get_parts()
-
-    parts_to_remove = []
-    for part in parts:
-        if "REMOVE" in part[1]:
-            parts_to_remove.append(part[0])
-
-    return parts_to_remove
+    return [part[0] for part in db.get_parts_containing("REMOVE", since=since, recheck=recheck)]
 
 
 def remove_flagged_parts():
@@ -56,68 +54,180 @@ def remove_flagged_parts():
         print("No parts to remove")
         return
 
-    for pn in parts_to_remove:
-        db.remove_part_number(pn, dryrun=False, annotate=True)
+    with db.transaction():
+        db.remove_part_numbers(parts_to_remove)
 
     print("Parts removed")
 
 
-def make_list_of_dicts_from_list_of_lists(in_list_of_list: list, fieldnames: list):
+def find_merges(shared, descriptions, exclude=()):
     """
-    Convert list of lists to list of dictionaries
-
-    :param in_list_of_list: list of lists to convert to list of dicts
-    :param fieldnames: fieldnames to use
-    :return: list of dicts
+    Pick the part numbers to merge. Two part numbers are duplicates when they have the same MPN from the
+    same manufacturer and the same description, ignoring case. Duplicates of duplicates are merged together,
+    into the lowest part number of the cluster.
+
+    :param shared: MPN groups from db.get_duplicate_sources()
+    :param descriptions: Description groups from db.get_duplicate_descriptions()
+    :param exclude: Part numbers which must not be merged
+    :return: a list of (part number, part number to keep) tuples
+    """
+    desc_of = {}
+    for desc, pns in descriptions:
+        for pn in pns:
+            if pn not in exclude:
+                desc_of[pn] = (desc or '').lower()
+
+    parent = {}
+
+    def find(pn):
+        while parent.get(pn, pn) != pn:
+            pn = parent[pn]
+        return pn
+
+    for group, sources in shared:
+        by_desc = {}
+        for pn, mpn in sources:
+            if pn in desc_of:
+                by_desc.setdefault(desc_of[pn], set()).add(pn)
+        for pns in by_desc.values():
+            pns = sorted(pns)
+            for pn in pns[1:]:
+                (a, b) = sorted([find(pns[0]), find(pn)])
+                if a != b:
+                    parent[b] = a
+
+    return sorted((pn, find(pn)) for pn in parent if find(pn) != pn)
+
+
+def show_groups(title, groups, limit):
     """
-    out_list_of_dicts = []
-    for item in in_list_of_list:
-        d = {fieldnames[index]: item[index] for index in range(len(item))}
-        out_list_of_dicts.append(d)
-    return out_list_of_dicts
+    Print the largest groups of duplicates, then how many more there are
 
+    :param title: Heading for the groups
+    :param groups: List of (heading, list of lines) tuples, largest first
+    :param limit: Number of groups to print
+    :return: None
+    """
+    print(f'{title}: {len(groups)}')
+    for index, (heading, lines) in enumerate(groups[:limit], start=1):
+        print(f'{index:>5d}. {heading}')
+        for line in lines:
+            print(f'         {line}')
+    if len(groups) > limit:
+        print(f'       ... and {len(groups) - limit} more')
 
-def check(fix=False, remove_deleted_pns=False, noprompt=False, test=False):
 
-    def fix_prompt(fix_flag, prompt):
-        y = False
-        if fix_flag:
-            if not noprompt:
-                if click.confirm(prompt):
-                    y = True
-            else:
-                y = True
-        return y
+class FixPlan:
+    """
+    Deletions collected by the check phases. They are shown together and then applied in one transaction.
+    """
+    def __init__(self):
+        self.part_numbers = []  # Part numbers flagged for deletion, removed with all of their sources
+        self.sources = []  # (part number, manufacturer ID, MPN) of sources with invalid manufacturer IDs
+        self.mids = []  # Unused manufacturer IDs
+        self.orphans = []  # Part numbers with sources but no pndesc row, their sources are removed
+        self.duplicates = []  # (part number, manufacturer ID, MPN) of sources listed more than once
+        self.merges = []  # (part number, part number to keep) of duplicate part numbers
+        self.duplicate_pns = []  # Part numbers with more than one pndesc row, only in databases before version 0.2
+        self.duplicate_mids = []  # Manufacturer IDs with more than one mlist row
+
+    def counts(self):
+        return {"part_numbers": len(self.part_numbers), "sources": len(self.sources), "mids": len(self.mids),
+                "orphans": len(set(self.orphans)), "duplicates": len(self.duplicates), "merges": len(self.merges),
+                "duplicate_pns": len(self.duplicate_pns), "duplicate_mids": len(self.duplicate_mids)}
+
+    def empty(self):
+        return not any(self.counts().values())
+
+    def show(self):
+        counts = self.counts()
+        print("Fix plan:")
+        print(f'{counts["part_numbers"]:>8d} part numbers flagged for deletion to remove with their sources')
+        print(f'{counts["sources"]:>8d} sources with invalid manufacturer IDs to remove')
+        print(f'{counts["mids"]:>8d} unused manufacturer IDs to remove')
+        print(f'{counts["orphans"]:>8d} orphaned part numbers to remove the sources of')
+        print(f'{counts["duplicates"]:>8d} repeated sources to remove the extra rows of')
+        print(f'{counts["merges"]:>8d} duplicate part numbers to merge')
+        print(f'{counts["duplicate_pns"]:>8d} part numbers listed more than once to remove the extra rows of')
+        print(f'{counts["duplicate_mids"]:>8d} manufacturer IDs listed more than once to remove the extra rows of')
+
+    def write_json(self, path, dbpath):
+        plan = {"database": os.path.abspath(dbpath), "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                "counts": self.counts(), "part_numbers": self.part_numbers,
+                "sources": [{"pn": pn, "mid": mid, "mpn": mpn} for (pn, mid, mpn) in self.sources],
+                "mids": self.mids, "orphans": sorted(set(self.orphans)),
+                "duplicates": [{"pn": pn, "mid": mid, "mpn": mpn} for (pn, mid, mpn) in self.duplicates],
+                "merges": [{"pn": pn, "keep": keep} for (pn, keep) in self.merges],
+                "duplicate_pns": self.duplicate_pns, "duplicate_mids": self.duplicate_mids}
+        with open(path, 'w') as f:
+            json.dump(plan, f, indent=2)
+
+    def apply(self):
+        """
+        Make all of the deletions with set based DELETEs in one transaction. Nothing is changed if any of them fail.
+        :return: N/A
+        """
+        with db.transaction():
+            if self.duplicate_pns or self.duplicate_mids:
+                count = db.remove_duplicate_keys(self.duplicate_pns, self.duplicate_mids)
+                print(f'Removed {count} extra rows of part numbers and manufacturer IDs listed more than once')
+            if self.part_numbers:
+                (parts, sources) = db.remove_part_numbers(self.part_numbers)
+                print(f'Removed {parts} part numbers and {sources} of their sources')
+            if self.sources:
+                print(f'Removed {db.remove_sources(self.sources)} sources with invalid manufacturer IDs')
+            if self.mids:
+                print(f'Removed {db.remove_mids(self.mids)} unused manufacturer IDs')
+            if self.orphans:
+                print(f'Removed {db.remove_pnmpn_records(sorted(set(self.orphans)))} orphaned sources')
+            if self.duplicates:
+                print(f'Removed {db.remove_duplicate_sources(self.duplicates)} repeated source rows')
+            if self.merges:
+                (parts, sources) = db.merge_parts(self.merges)
+                print(f'Merged {parts} duplicate part numbers, moving {sources} of their sources')
+
+
+def check(fix=False, remove_deleted_pns=False, noprompt=False, test=False, plan_json=None, merge_duplicates=False,
+          dup_limit=20, since=None, recheck=((), ())):
+    """
+    Check the database, then remove what was found if asked to
+    :param fix: Plan to fix the problems found by phases 2 to 4 and the repeated sources and keys found by phase 6
+    :param remove_deleted_pns: Plan to remove the part numbers flagged for deletion
+    :param noprompt: Apply the plan without asking
+    :param test: Add a bogus invalid manufacturer ID reference
+    :param plan_json: Write the plan to this JSON file. If neither fix, remove_deleted_pns nor merge_duplicates are
+    set, the plan has everything all of them would change and nothing is changed.
+    :param merge_duplicates: Plan to merge the duplicate part numbers found by phase 6
+    :param dup_limit: Number of duplicate groups of each kind to list
+    :param since: Only check the part numbers and manufacturer IDs changed after this change marker
+    :param recheck: Tuple of (part numbers, manufacturer IDs) to check as well as the changed ones when since is given
+    :return: Tuple of (part numbers, manufacturer IDs) sets with everything found, whether or not it was fixed
+    """
+    (recheck_pns, recheck_mids) = recheck
+    review = plan_json is not None and not fix and not remove_deleted_pns and not merge_duplicates
+    found = FixPlan()  # Everything the fixes could change, whether or not they were asked for
 
     # Look for parts flagged for deletion
     print()
     print("*** Check ***")
     print()
     print("Phase 1: Part numbers flagged for deletion")
-    to_be_deleted = get_parts_flagged_for_deletion()
+    to_be_deleted = get_parts_flagged_for_deletion(since, recheck_pns)
 
     if to_be_deleted:
         for item, pn in enumerate(to_be_deleted):
             print(f'{item:>5d}. {pn}')
-        yes = fix_prompt(remove_deleted_pns, "Delete unused part numbers")
-        if yes:
-            for pn in to_be_deleted:
-                db.remove_part_number(pn, dryrun=False, annotate=True)
+        found.part_numbers = to_be_deleted
     else:
         print("No part numbers flagged for deletion")
 
     print()
 
     print("Phase 2: Look for invalid Manufacturer ID references")
-    pnmpn = db.get_pnmpn()
-    index = 1
     invalid_manufacturer_ids = []
-    for item in pnmpn:
-        mfgr = db.lookup_mfg_by_id(item[1])
-        if not mfgr[0]:
-            invalid_manufacturer_ids.append({"mpn": item[0], "mid": item[1], "pn":item[2], "mname":mfgr[0]})
-            print(f'{index:>5d}. {invalid_manufacturer_ids[-1]["mid"]:<10s} {invalid_manufacturer_ids[-1]["mname"]:<60s}')
-            index = index + 1
+    for index, (pn, mid, mpn, mname) in enumerate(db.get_dangling_sources(since, recheck_pns), start=1):
+        invalid_manufacturer_ids.append({"mpn": mpn, "mid": mid, "pn": pn, "mname": mname or ''})
+        print(f'{index:>5d}. {mid:<10s} {mname or "":<60s}')
 
     if test:
         invalid_manufacturer_ids = [{"mpn": "3T592", "mid": "M99999", "pn": "999999-101", "mname": "Widget co."}]
@@ -126,61 +236,25 @@ def check(fix=False, remove_deleted_pns=False, noprompt=False, test=False):
     if not invalid_manufacturer_ids:
         print("No invalid manufacturer id's found")
     else:
-        yes = fix_prompt(fix, "Delete invalid manufacturer ID references")
-        if yes:
-            for iid in invalid_manufacturer_ids:
-                db.remove_source(iid["pn"], iid["mid"], iid["mpn"])
+        found.sources = [(iid["pn"], iid["mid"], iid["mpn"]) for iid in invalid_manufacturer_ids]
     print()
 
     # Look for unused MID's
     print("Phase 3: Look for unused Manufacturer ID's")
 
-    manuf_use_list = make_manuf_use_list()
-
     mids_to_delete = []
-    pnmpn = db.get_pnmpn()
-
-    for item in pnmpn:
-        for row in manuf_use_list:
-            if row["mid"] == item[1]:
-                row["reference_count"] = row["reference_count"] + 1
-    index = 1
-    for row in manuf_use_list:
-        if not row["reference_count"]:
-            mfgr = db.lookup_mfg_by_id(row["mid"])
-            mids_to_delete.append(row["mid"])
-            print(f'{index:>5d}. {row["mid"]:<10s} {mfgr[0]:<60s}')
-            index = index + 1
+    for index, (mid, mname) in enumerate(db.get_unused_mfgrs(since, recheck_mids), start=1):
+        mids_to_delete.append(mid)
+        print(f'{index:>5d}. {mid:<10s} {mname or "":<60s}')
 
     if not mids_to_delete:
         print("No unused manufacturer ID's found")
     else:
-        yes = fix_prompt(fix, "Delete unused manufacturer ID references")
-        if yes:
-            for mid in mids_to_delete:
-                db.remove_mid(mid)
-            print("Unused manufacturer ID's removed")
+        found.mids = mids_to_delete
 
     print()
     print("Phase 4: Check for orphaned parts")
-    parts_list = db.get_parts()
-    part_descriptions = make_list_of_dicts_from_list_of_lists(parts_list, ["PartNumber", "Description"])
-
-    pnnpn = db.get_pnmpn()
-    pn_to_mpns = make_list_of_dicts_from_list_of_lists(pnmpn, ["PartNumber", "Manufacturer", "MPN", "DataSheet"])
-    # Add reference count field
-    for pn_to_mpn in pn_to_mpns:
-        pn_to_mpn['reference_count'] = 0
-
-    for part_description in part_descriptions:
-        for pn_to_mpn in pn_to_mpns:
-            if part_description["PartNumber"] == pn_to_mpn["PartNumber"]:
-                pn_to_mpn["reference_count"] = pn_to_mpn["reference_count"] + 1
-
-    orphaned_parts = []
-    for pn_to_mpn in pn_to_mpns:
-        if not pn_to_mpn["reference_count"]:
-            orphaned_parts.append(pn_to_mpn["PartNumber"])
+    orphaned_parts = [pn for (pn, mid, mpn) in db.get_orphan_sources(since, recheck_pns)]
 
     if orphaned_parts:
         print("Orphaned parts found:")
@@ -190,13 +264,238 @@ def check(fix=False, remove_deleted_pns=False, noprompt=False, test=False):
     else:
         print("No orphaned parts found")
 
-    if orphaned_parts:
-        yes = fix_prompt(fix, "Delete orphaned parts")
-        if yes:
-            for part in orphaned_parts:
-                db.remove_pnmpn_record(part)
+    found.orphans = orphaned_parts
+
+    print()
+    print("Phase 5: Check for part numbers without sources")
+    unsourced_parts = db.get_parts_without_sources(since, recheck_pns)
+    if unsourced_parts:
+        for index, (pn, desc) in enumerate(unsourced_parts, start=1):
+            print(f'{index:>5d}. {pn:<20s} {desc}')
+    else:
+        print("No part numbers without sources found")
+
+    print()
+    print("Phase 6: Look for duplicate parts and sources")
+    (repeated, shared) = db.get_duplicate_sources(since=since, recheck=recheck_pns)
+    descriptions = db.get_duplicate_descriptions(since, recheck_pns)
+    (dup_pns, dup_mids) = db.get_duplicate_keys()
+    if dup_pns or dup_mids:
+        show_groups("Part numbers listed more than once", [(pn, [f'{count} rows']) for (pn, count) in dup_pns],
+                    dup_limit)
+        show_groups("Manufacturer IDs listed more than once", [(mid, [f'{count} rows']) for (mid, count) in dup_mids],
+                    dup_limit)
+        found.duplicate_pns = [pn for (pn, count) in dup_pns]
+        found.duplicate_mids = [mid for (mid, count) in dup_mids]
+    if repeated or shared or descriptions:
+        show_groups("Sources listed more than once", [(f'{pn:<20s} {mid:<10s} {mpn}', [f'{count} rows'])
+                                                      for ((pn, mid, mpn), count) in repeated], dup_limit)
+        show_groups("MPNs used by more than one part number", [(f'{mid:<10s} {sources[0][1]}',
+                                                               [f'{pn:<20s} {mpn}' for (pn, mpn) in sources])
+                                                              for ((mid, key), sources) in shared], dup_limit)
+        show_groups("Descriptions used by more than one part number", [(f'{desc} ({len(pns)} part numbers)', [', '.join(pns[:10]) + (', ...' if len(pns) > 10 else '')])
+                                                                       for (desc, pns) in descriptions], dup_limit)
+        merges = find_merges(shared, descriptions, exclude=set(to_be_deleted))
+        print(f'{sum(count - 1 for (source, count) in repeated)} extra source rows, '
+              f'{len(merges)} part numbers with the same MPN and description as another to merge')
+        for pn, keep in merges[:dup_limit]:
+            print(f'       {pn:<20s} into {keep}')
+        if len(merges) > dup_limit:
+            print(f'       ... and {len(merges) - dup_limit} more')
+        found.duplicates = [source for (source, count) in repeated]
+        found.merges = merges
+    elif not (dup_pns or dup_mids):
+        print("No duplicate parts or sources found")
+
+    plan = FixPlan()
+    if remove_deleted_pns or review:
+        plan.part_numbers = found.part_numbers
+    if fix or review:
+        plan.sources = found.sources
+        plan.mids = found.mids
+        plan.orphans = found.orphans
+        plan.duplicates = found.duplicates
+        plan.duplicate_pns = found.duplicate_pns
+        plan.duplicate_mids = found.duplicate_mids
+    if merge_duplicates or review:
+        plan.merges = found.merges
+
+    # The problems found, to look at again next time. Fixed problems are not found again. Descriptions used
+    # more than once are only a problem when the part numbers share an MPN as well, which the merges cover.
+    found_pns = set(found.part_numbers) | set(found.orphans) | set(pn for (pn, desc) in unsourced_parts)
+    found_pns.update(pn for (pn, mid, mpn) in found.sources + found.duplicates)
+    found_pns.update(pn for (group, sources) in shared for (pn, mpn) in sources)
+    found_pns.update(pn for merge in found.merges for pn in merge)
+    found_mids = set(found.mids)
+
+    if not plan.empty():
+        print()
+        plan.show()
+    if plan_json is not None:
+        try:
+            plan.write_json(plan_json, db.dbfile)
+        except OSError as e:
+            print(f'Error: Can\'t write {plan_json}: {e}')
+            sys.exit(2)
+        print(f'Plan written to {plan_json}')
+    if plan.empty() or review or not (noprompt or click.confirm("Apply the fix plan")):
+        return (found_pns, found_mids)
+    try:
+        plan.apply()
+    except sqlite3.Error as e:
+        print(f'Error: Fix failed, nothing was changed: {e}')
+        sys.exit(2)
+    print("Fix plan applied")
+    return (found_pns, found_mids)
+
+
+def workload_ops(wdb):
+    """
+    Return the lookups timed by the optimize workload
+
+    :param wdb: Database to look the parts up in, without a cache
+    :return: a list of (name, function of (part number, MPN), fraction of the samples to use) tuples.
+    Searches are much slower than the other lookups, so they only use some of the samples.
+    """
+    return [("lookup_pn", lambda pn, mpn: wdb.lookup_pn(pn), 1),
+            ("lookup_mpn_by_pn", lambda pn, mpn: wdb.lookup_mpn_by_pn(pn), 1),
+            ("lookup_mpn", lambda pn, mpn: wdb.lookup_mpn(mpn), 1),
+            ("lookup_mpn_canonical", lambda pn, mpn: wdb.lookup_mpn_canonical(mpn), 1),
+            ("search", lambda pn, mpn: wdb.search(mpn, 10), 0.1)]
 
-            print("Orphaned parts removed")
+
+def run_workload(wdb, samples):
+    """
+    Time the workload lookups, once for each sample. The workload is run once first to warm the cache.
+
+    :param wdb: Database to look the parts up in, without a cache
+    :param samples: List of (part number, MPN) tuples
+    :return: a dictionary of the mean milliseconds for each lookup
+    """
+    times = {}
+    for name, op, fraction in workload_ops(wdb):
+        some = samples[:max(int(len(samples) * fraction), 1)]
+        for warm in [True, False]:
+            start = time.perf_counter()
+            for pn, mpn in some:
+                op(pn, mpn)
+            if not warm:
+                times[name] = (time.perf_counter() - start) * 1000 / len(some)
+    return times
+
+
+def workload_plans(wdb, samples):
+    """
+    Find the indexes the workload lookups use, and the statements which scan a whole table
+
+    :param wdb: Database to look the parts up in, without a cache
+    :param samples: List of (part number, MPN) tuples
+    :return: a tuple containing (set of index names, list of statements)
+    """
+    statements = []
+    wdb.conn.set_trace_callback(lambda sql: statements.append(sql) if sql not in statements else None)
+    try:
+        for name, op, fraction in workload_ops(wdb):
+            for pn, mpn in samples[:10]:
+                op(pn, mpn)
+    finally:
+        wdb.conn.set_trace_callback(None)
+    used = set()
+    scans = []
+    for sql in statements:
+        # Skip the schema lookups and the statements FTS5 runs on its own tables
+        if not sql.lstrip().upper().startswith("SELECT") or "sqlite_master" in sql or "'main'." in sql:
+            continue
+        for step in wdb.query_plan(sql):
+            used.update(re.findall(r'USING (?:COVERING )?INDEX (\w+)', step))
+            if step.startswith("SCAN") and "VIRTUAL TABLE" not in step and "INDEX" not in step and sql not in scans:
+                scans.append(sql)
+    return (used, scans)
+
+
+def show_stats(stats, used=None, scans=None):
+    """
+    Print the database size, row counts and index usage
+
+    :param stats: Dictionary returned by db.db_stats()
+    :param used: Names of the indexes used by the workload
+    :param scans: Workload statements which scan a whole table
+    :return: None
+    """
+    pages = stats["page_count"]
+    print(f'Page size: {stats["page_size"]} bytes, {pages} pages ({pages * stats["page_size"] / 1e6:.1f} MB)')
+    print(f'Free pages: {stats["freelist_count"]} ({100.0 * stats["freelist_count"] / max(pages, 1):.1f}%)')
+    print(f'Query planner statistics: {"present" if stats["analyzed"] else "missing, run --optimize"}')
+    print()
+    print(f'{"Table":<30s} {"Rows":>10s} {"Pages":>10s}')
+    for name, rows, tpages in stats["tables"]:
+        print(f'{name:<30s} {rows:>10d} {"" if tpages is None else tpages:>10}')
+    print()
+    print(f'{"Index":<30s} {"Table":<20s} {"Pages":>10s} {"Used":>6s}')
+    for name, table, ipages in stats["indexes"]:
+        if used is None or name.startswith("sqlite_autoindex"):
+            note = ""
+        else:
+            note = "yes" if name in used else "no"
+        print(f'{name:<30s} {table:<20s} {"" if ipages is None else ipages:>10} {note:>6s}')
+    if scans:
+        print()
+        print("Lookups which scan a whole table:")
+        for sql in scans:
+            print(f'       {" ".join(sql.split())[:100]}')
+
+
+def optimize(optimizing=False, vacuum_into=None):
+    """
+    Report the database statistics, then optimize it if asked to, timing a standard lookup workload
+    before and after
+
+    :param optimizing: Run ANALYZE and PRAGMA optimize
+    :param vacuum_into: Also write a compacted copy of the database to this file
+    :return: None
+    """
+    print()
+    print("*** Database statistics ***")
+    print()
+    wdb = bommdb.BOMdb(db.dbfile, options=db.options)
+    samples = db.conn.execute("SELECT PartNumber,MPN FROM pnmpn ORDER BY random() LIMIT ?", [workloadSize]).fetchall()
+    (used, scans) = workload_plans(wdb, samples)
+    show_stats(db.db_stats(), used, scans)
+    if not optimizing:
+        return
+
+    print()
+    print(f'Timing the lookups of {len(samples)} sources')
+    before = run_workload(wdb, samples)
+    wdb.close()
+    start = time.perf_counter()
+    try:
+        pruned = db.prune_changelog() if db.has_changelog() else 0
+        db.optimize(vacuum_into)
+    except sqlite3.Error as e:
+        print(f'Error: Optimize failed: {e}')
+        sys.exit(2)
+    print(f'Optimized in {time.perf_counter() - start:.1f} seconds')
+    if pruned:
+        print(f'Removed {pruned} changes every reader of the change log has seen')
+
+    # New connections, so the planner uses the new statistics
+    timings = [("Before", before)]
+    wdb = bommdb.BOMdb(db.dbfile, options=db.options)
+    timings.append(("After", run_workload(wdb, samples)))
+    wdb.close()
+    if vacuum_into is not None:
+        wdb = bommdb.BOMdb(vacuum_into, options=db.options)
+        timings.append(("Compacted", run_workload(wdb, samples)))
+        wdb.close()
+    print()
+    print(f'{"Lookup (ms)":<24s}' + "".join(f'{title:>12s}' for title, times in timings))
+    for name in before:
+        print(f'{name:<24s}' + "".join(f'{times[name]:>12.3f}' for title, times in timings))
+    if vacuum_into is not None:
+        print()
+        print(f'Compacted copy written to {vacuum_into}: {os.path.getsize(vacuum_into) / 1e6:.1f} MB, '
+              f'was {os.path.getsize(db.dbfile) / 1e6:.1f} MB')
 
 
 if __name__ == '__main__':
@@ -207,6 +506,21 @@ if __name__ == '__main__':
     parser.add_argument("--fix", help="Fix database inconsistencies", action="store_true")
     parser.add_argument("--remove-deleted-pns", help="Remove part numbers marked for deletion", action="store_true")
     parser.add_argument("--noprompt", help="Don't prompt during fix or part number deletion", action="store_true")
+    parser.add_argument("--merge-duplicates", help="Merge part numbers with the same MPN and description",
+                        action="store_true")
+    parser.add_argument("--dup-limit", help="Number of duplicate groups of each kind to list", type=int, default=20)
+    parser.add_argument("--plan-json", help="Write the planned changes to a JSON file. Without --fix, "
+                        "--remove-deleted-pns or --merge-duplicates, nothing is changed and the plan has everything "
+                        "they would change")
+    parser.add_argument("--incremental", help="Only check what changed since the last check. Does a full check "
+                        "if there is no record of one", action="store_true")
+    parser.add_argument("--stats", help="Show the database size, row counts and index usage instead of checking it",
+                        action="store_true")
+    parser.add_argument("--optimize", help="Show the statistics, then update the query planner statistics, "
+                        "timing lookups before and after", action="store_true")
+    parser.add_argument("--vacuum-into", help="With --optimize, also write a compacted copy of the database to "
+                        "this file")
+    parser.add_argument("--cache-stats", help="Print database cache statistics when done", action="store_true")
 
     ## Customize default configurations to user's home directory
 
@@ -236,8 +550,51 @@ if __name__ == '__main__':
     if not os.path.exists(dbpath):
         sys.exit("DB file: {} does not exist".format(dbpath))
     # Make connection to db
-    db = bommdb.BOMdb(dbpath)
-
-    check(fix=args.fix, remove_deleted_pns=args.remove_deleted_pns,  noprompt=args.noprompt)
+    db = bommdb.BOMdb(dbpath, cache=True, options=bommdb.db_options(config))
+    if db.out_of_date:
+        print("Warning: Database schema is out of date. Run bommgr.py migrate to upgrade it")
+
+    if args.vacuum_into is not None:
+        args.vacuum_into = os.path.expanduser(args.vacuum_into)
+        if os.path.exists(args.vacuum_into):
+            print(f'Error: {args.vacuum_into} exists')
+            sys.exit(2)
+    if args.stats or args.optimize or args.vacuum_into is not None:
+        optimize(optimizing=args.optimize or args.vacuum_into is not None, vacuum_into=args.vacuum_into)
+        sys.exit(0)
+
+    # Changes made after this are checked next time, including the ones made by the fixes
+    marker = db.change_marker() if db.has_changelog() else None
+    since = None
+    recheck = ([], [])
+    if args.incremental:
+        last = db.get_setting(checkMarkerKey)
+        if marker is None:
+            print("Warning: Database has no change log, doing a full check. Run bommgr.py migrate to upgrade it")
+        elif last is None or int(last) > marker:
+            print("No record of an earlier check, doing a full check")
+        elif int(last) < db.changelog_start():
+            print("The change log no longer goes back to the last check, doing a full check")
+        else:
+            since = int(last)
+            saved = json.loads(db.get_setting(recheckKey, '{}'))
+            recheck = (saved.get("pns", []), saved.get("mids", []))
+            print(f'Checking what changed since the last check ({marker - since} changes), and the '
+                  f'{len(recheck[0])} part numbers and {len(recheck[1])} manufacturer IDs it found problems with')
+
+    (found_pns, found_mids) = check(fix=args.fix, remove_deleted_pns=args.remove_deleted_pns,  noprompt=args.noprompt,
+                                    plan_json=args.plan_json, merge_duplicates=args.merge_duplicates,
+                                    dup_limit=args.dup_limit, since=since, recheck=recheck)
+
+    # The next incremental check starts from here, and looks at what this one found again
+    if marker is not None:
+        with db.transaction():
+            db.set_setting(checkMarkerKey, marker)
+            db.set_setting(recheckKey, json.dumps({"pns": sorted(found_pns), "mids": sorted(found_mids)}))
+
+    if args.cache_stats:
+        print()
+        for name, counts in db.cache_stats().items():
+            print(f'{name:<10s} cache hits: {counts["hits"]:>8d} misses: {counts["misses"]:>8d}')
 
 
@@ -22,6 +22,7 @@ __author__ = 'srodgers'
 import sys
 import os
 import sqlite3
+import bommdb
 
 
 if len(sys.argv) != 2:
@@ -70,5 +71,9 @@ conn.commit()
 #Create the config table
 conn.execute('CREATE TABLE config (key TEXT,value TEXT)')
 conn.commit()
+conn.close()
+
+# Bring the schema up to the latest version
+bommdb.BOMdb(dbpath).migrate()
 
 sys.exit(0)
\ No newline at end of file
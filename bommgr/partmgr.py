@@ -20,7 +20,9 @@
 __author__ = 'srodgers'
 
 import subprocess
+import sqlite3
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import *
 from tkinter.ttk import *
 from tkinter.filedialog import askopenfilename
@@ -36,6 +38,9 @@ defaultMID = 'M0000000'
 
 listFrame = None
 
+# Worker thread for lookups which would hold up the user interface. BOMdb gives it its own connection.
+lookupExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='partmgr')
+
 #
 #
 #
@@ -219,7 +224,7 @@ class ViewPartsDialog(Dialog):
         self.search_entry.grid(row=0, column=1, sticky=W)
         patframe.pack()
         helpframe=Frame(master)
-        Label(helpframe, text='Use % as a wildcard character').pack()
+        Label(helpframe, text='Use % as a wildcard character, or enter words to search for in any order').pack()
         helpframe.pack()
 
     def validate(self):
@@ -301,7 +306,12 @@ class EditDescription(Dialog):
 
     def apply(self):
         title_entry_text = self.title_entry.get()
-        self.db.update_title(self.values[0], title_entry_text)
+        try:
+            self.db.update_title(self.values[0], title_entry_text)
+        except ValueError as e:
+            # Changed or removed by someone else since the dialog was opened
+            ErrorPopUp(self.parent, message="Description not changed: {}".format(e))
+            return
         self.values[1] = title_entry_text
 
 
@@ -350,7 +360,11 @@ class EditManufacturer(Dialog):
         if res is None:
             raise SystemError
         mid = res[1]
-        self.db.update_mfg(mid, self.newmfgname)
+        try:
+            self.db.update_mfg(mid, self.newmfgname)
+        except ValueError as e:
+            ErrorPopUp(self.parent, message="Manufacturer not changed: {}".format(e))
+            return
         self.values[0] = self.newmfgname
 
 #
@@ -385,8 +399,12 @@ class EditMPN(Dialog):
     def apply(self):
         (pn, mname, mpn, mid) = self.db.lookup_part_by_pn_mpn(self.tags[0], self.values[3])
         newmpn = self.mpn_entry.get()
-        self.db.update_mpn(pn, mpn,
-                           newmpn, mid)
+        try:
+            self.db.update_mpn(pn, mpn,
+                               newmpn, mid)
+        except ValueError as e:
+            ErrorPopUp(self.parent, message="Manufacturer part number not changed: {}".format(e))
+            return
         self.values[3] = newmpn
 
 
@@ -460,12 +478,14 @@ class AddAlternateSourceDialog(Dialog):
             raise SystemError
         self.new_mid = res[1]
 
-        # Check for duplicate manufacturer part record
-        sources = self.db.lookup_mpn_by_pn(self.pn)
+        # Check for duplicate manufacturer part record, ignoring punctuation, spacing and case
         self.new_mpn = self.mpn_entry.get()
-        for item in sources:
-            if self.new_mname == item['mname'] and self.new_mpn == item['mpn']:
-                return False # Item already a valid source
+        for (pn, mname, dupmpn, mid) in self.db.lookup_mpn_canonical(self.new_mpn):
+            if self.new_mname == mname:
+                if pn == self.pn:
+                    return False # Item already a valid source
+                e=ErrorPopUp(self.bodyframe, message="MPN already exists as {} under part number {}".format(dupmpn, pn))
+                return False
 
         return True
 
@@ -593,27 +613,25 @@ class AddPartDialog(Dialog):
         self.deschint = deschint
         Dialog.__init__(self, parent, title, xoffset, yoffset)
 
-    def new_pn(self):
+    def new_pn(self, claim=False):
         """
-        Return the next available part number from the database
+        Return the next available part number from the database, or the next free suffix
+        for the part number hint
+        :param claim: If True, claim the part number so no one else gets it
         :return: Part number string
         """
-        res = self.db.last_pn()
+        if self.pnhint != '':
+            return self.db.allocate_tabulated_pn(self.pnhint, claim=claim)
         # If this is the very first part number added use the default for firstpn
-        if res is None or res[0] is None:
-            pn = firstPn
-        else:
-            pn = res
-        (prefix, suffix) = pn.split('-')
-        nextnum = int(prefix) + 1
-        pn = '{prefix:06d}-{suffix:03d}'.format(prefix=nextnum, suffix=101)
-        return pn
+        return self.db.allocate_pns(1, firstPn, claim=claim)[0]
 
     def body(self, master):
-        if self.pnhint != '':
-            nextpn = self.pnhint
-        else:
+        # The suggested part number is claimed when the part is added
+        try:
             nextpn = self.new_pn()
+        except ValueError:
+            nextpn = self.pnhint
+        self.suggested_pn = nextpn
         self.mfgrs = self.db.get_mfgr_list()
         def_sel = self.mfgrs.index(defaultMfgr)
 
@@ -638,6 +656,68 @@ class AddPartDialog(Dialog):
         self.mpn_entry.insert(0, defaultMpn)
         self.mpn_entry.grid(row=3, column=1, sticky=W)
 
+        # Existing parts with descriptions like the one being typed
+        Label(master, text='Similar Parts').grid(row=4, column=0, sticky=NW)
+        self.similar_list = Listbox(master, width=70, height=5)
+        self.similar_list.grid(row=4, column=1, sticky=W)
+        self.similar_job = None
+        self.similar_lookup = None
+        self.similar_poll = None
+        self.desc_entry.bind('<KeyRelease>', self.desc_changed)
+        self.show_similar()
+
+    def desc_changed(self, event):
+        """
+        Update the similar parts list once the user pauses typing
+        """
+        if self.similar_job is not None:
+            self.after_cancel(self.similar_job)
+        self.similar_job = self.after(250, self.show_similar)
+
+    def show_similar(self):
+        """
+        Look up the parts similar to the description entry on the worker thread
+        """
+        self.similar_job = None
+        # A lookup which hasn't started yet is for an older description
+        if self.similar_lookup is not None:
+            self.similar_lookup.cancel()
+        self.similar_lookup = lookupExecutor.submit(self.db.similar_parts, self.desc_entry.get(), 5)
+        if self.similar_poll is None:
+            self.similar_poll = self.after(50, self.poll_similar)
+
+    def poll_similar(self):
+        """
+        Fill in the similar parts list once the latest lookup is done.
+        Results of lookups for older descriptions are dropped.
+        """
+        if not self.similar_lookup.done():
+            self.similar_poll = self.after(50, self.poll_similar)
+            return
+        self.similar_poll = None
+        lookup = self.similar_lookup
+        self.similar_lookup = None
+        self.similar_list.delete(0, END)
+        try:
+            similar = lookup.result()
+        except sqlite3.Error:
+            return
+        for (pn, desc, similarity) in similar:
+            self.similar_list.insert(END, '{0:<12}{1:<52}{2:.0%}'.format(pn, desc, similarity))
+
+    def cancel(self, event=None):
+        # Don't update the similar parts list after the dialog is gone
+        if self.similar_job is not None:
+            self.after_cancel(self.similar_job)
+            self.similar_job = None
+        if self.similar_poll is not None:
+            self.after_cancel(self.similar_poll)
+            self.similar_poll = None
+        if self.similar_lookup is not None:
+            self.similar_lookup.cancel()
+            self.similar_lookup = None
+        Dialog.cancel(self, event)
+
 
     def validate(self):
 
@@ -655,24 +735,27 @@ class AddPartDialog(Dialog):
             return False
 
         # Validate manufacturer part number
-        x = len(self.mpn_entry.get())
+        mpn = self.mpn_entry.get()
+        x = len(mpn)
         if x < 3 or x > 30:
             return False
 
-        # Validate manufacturer, and add a new manufacturer if need be
+        # Check for the same MPN from the same manufacturer, ignoring punctuation, spacing and case
         selected = self.mfgr_entry.get()
+        if mpn != defaultMpn:
+            for (pn, mname, dupmpn, mid) in self.db.lookup_mpn_canonical(mpn):
+                if mname == selected:
+                    e=ErrorPopUp(self.bodyframe, message="MPN already exists as {} under part number {}".format(dupmpn, pn))
+                    return False
+
+        # Validate manufacturer, and add a new manufacturer if need be
         if selected not in self.mfgrs:
             confirm_mfg = AddMfgrDialog(self.parent, new_mfg=selected)
             if confirm_mfg.confirmed() is False:
                 return False
             else:
                 # Assign a new mid
-                mid = self.db.last_mid()
-                if mid is not None:
-                    mid = int(mid[1:]) + 1
-                else:
-                    mid = 0
-                nextmid = 'M{num:07d}'.format(num=mid)
+                nextmid = nextFreeMID(self.db)
                 # Add manufacturer and MID to manufacturer list
                 self.db.add_mfg_to_mlist(selected, nextmid)
                 self.mfgrs.append(selected)
@@ -694,8 +777,12 @@ class AddPartDialog(Dialog):
             raise SystemError
         mid = res[1]
 
-        # Create the part record and manufacturer part record
-        self.db.add_pn(pn, desc, mid, mpn)
+        # Create the part record and manufacturer part record, claiming the suggested part number
+        # if it wasn't changed. Someone else may have taken it since, so the claimed one can differ.
+        with self.db.transaction():
+            if pn == self.suggested_pn:
+                pn = self.new_pn(claim=True)
+            self.db.add_pn(pn, desc, mid, mpn)
 
 
 #
@@ -839,13 +926,25 @@ class ShowParts(DisplayFrame):
         :param like: - search string
         :return: N/A
         """
-        parts = self.db.get_parts(like)
+        parts = self.db.get_parts_with_sources(like)
 
-        for row,(pn,desc) in enumerate(parts):
-            mfg = defaultMfgr
-            mpn = defaultMpn
+        for row,(pn,desc,sources) in enumerate(parts):
             parent_iid = self.ltree.insert("", "end",  tag=[pn,'partrec'], values=((pn, desc, '', '')))
-            self.populate_source_list(pn, parent_iid)
+            self.populate_source_list(pn, parent_iid, sources)
+
+
+    def refresh_search_processor(self, text):
+        """
+        Process refresh items (full text search, best matches first)
+        :param text: - words to search for
+        :return: N/A
+        """
+        parts = self.db.search(text, limit=500)
+        sources = self.db.lookup_mpn_by_pns([pn for (pn, desc) in parts])
+
+        for (pn, desc) in parts:
+            parent_iid = self.ltree.insert("", "end",  tag=[pn,'partrec'], values=((pn, desc, '', '')))
+            self.populate_source_list(pn, parent_iid, sources.get(pn, []))
 
 
     def refresh(self, like=None, processor='DEFAULT'):
@@ -856,6 +955,7 @@ class ShowParts(DisplayFrame):
         :return: N/A
         """
         self.like = like
+        self.processor = processor
         if(DisplayFrame.frame is not None):
             DisplayFrame.frame.destroy()
         DisplayFrame.frame = Frame(self.parent)
@@ -883,6 +983,8 @@ class ShowParts(DisplayFrame):
             self.refresh_default_processor(like)
         elif processor == 'MPN':
             self.refresh_mpn_processor(like)
+        elif processor == 'SEARCH':
+            self.refresh_search_processor(like)
 
         # add tree and scrollbars to frame
         self.ltree.grid(in_=self.frame, row=0, column=0, sticky=NSEW)
@@ -995,16 +1097,20 @@ class ShowParts(DisplayFrame):
         deschint = self.itemvalues[1]
         a = AddPartDialog(self.parent,title='Add Tabulated Part',db=self.db, pnhint=pnhint, deschint=deschint)
 
-        self.refresh(self.like)
+        self.refresh(self.like, self.processor)
 
-    def populate_source_list(self, pn, itemid):
+    def populate_source_list(self, pn, itemid, sources=None):
         """
         Build the list of sources (mfg, mpn)
         :param pn:
         :param itemid:
+        :param sources: Sources as returned by lookup_mpn_by_pn(). Looked up if None
         :return:
         """
-        res = self.db.lookup_mpn_by_pn(pn)
+        if sources is None:
+            res = self.db.lookup_mpn_by_pn(pn)
+        else:
+            res = sources
 
         # If no MFG/MPN, use default
 
@@ -1088,7 +1194,10 @@ class ShowParts(DisplayFrame):
 
             # update the path
 
-            self.db.update_datasheet(pn, mid, mpn, path)
+            try:
+                self.db.update_datasheet(pn, mid, mpn, path)
+            except ValueError as e:
+                ErrorPopUp(self.parent, message="Datasheet not associated: {}".format(e))
 
 
 #
@@ -1096,12 +1205,8 @@ class ShowParts(DisplayFrame):
 #
 
 def nextFreeMID(db):
-    mid = db.last_mid()
-    if mid is not None:
-        mid = int(mid[1:]) + 1
-    else:
-        mid = 0
-    return 'M{num:07d}'.format(num=mid)
+    # Claimed, so no one else gets the same ID
+    return db.allocate_mids()[0]
 
 
 #
@@ -1116,7 +1221,11 @@ def addPN():
 def viewPartsLike():
     res = ViewPartsDialog(root)
     selected=res.get_selected()
-    parts.refresh(selected)
+    # Patterns without wildcards are full text searches
+    if selected and '%' not in selected:
+        parts.refresh(selected, 'SEARCH')
+    else:
+        parts.refresh(selected)
 
 def viewMPNsLike():
     res = ViewMPNsDialog(root)
@@ -1170,7 +1279,10 @@ if __name__ == '__main__':
         print('Error: Database file {} is not writable'.format(db))
         raise(SystemError)
 
-    DB = BOMdb(db)
+    DB = BOMdb(db, cache=True, options=db_options(config))
+
+    if DB.out_of_date:
+        print('Warning: Database schema is out of date. Run bommgr.py migrate to upgrade it')
 
     # Look up default manufacturer
 
@@ -1215,4 +1327,7 @@ if __name__ == '__main__':
 
     parts.refresh()
 
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+
+    for (name, counts) in DB.cache_stats().items():
+        print('Info: {} cache hits: {} misses: {}'.format(name, counts['hits'], counts['misses']))
\ No newline at end of file
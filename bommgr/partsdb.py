@@ -0,0 +1,344 @@
+__author__ = 'srodgers'
+"""
+    This file is part of BOMtools.
+
+    BOMtools is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    BOMTools is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with BOMTools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+#
+# Parts database access shared by bommdb.py and the merge scripts: the connection settings from the
+# [database] section of bommgr.conf, opening the database, and the lookup snapshot.
+#
+
+import os
+import sqlite3
+import struct
+import mmap
+import urllib.request
+from collections import OrderedDict
+import sqltrace
+
+
+# SQLite connection settings which may be given in the [database] section of bommgr.conf.
+# Each entry maps the setting name to the list of values it accepts, or to int for numeric settings.
+# The settings are applied with PRAGMA statements in this order when the database is opened.
+
+connectionPragmas = OrderedDict([
+    ('busy_timeout', int),
+    ('journal_mode', ['delete', 'truncate', 'persist', 'memory', 'wal', 'off']),
+    ('synchronous', ['off', 'normal', 'full', 'extra']),
+    ('cache_size', int),
+    ('mmap_size', int),
+])
+
+# Ways the merge scripts may open the database, chosen with merge_open in the [database] section:
+# rw (the default), ro (read only), or immutable (read only without locking, only safe when
+# nothing writes to the database)
+
+openModes = ['rw', 'ro', 'immutable']
+
+
+# Lookup snapshot read by the merge scripts, written by write_snapshot().
+# The file starts with a header, followed by the part table sorted by the UTF-8 bytes of the part number
+# (plus one end entry), the source table, and a string table of UTF-8 strings each preceded by its length.
+# The part and source tables refer to strings by their offset in the string table, snapshotNone for NULL.
+# The header records the database stamp (see db_stamp()) so readers can tell when it is stale.
+# Change snapshotVersion if the layout changes.
+
+snapshotMagic = b'BOMSNAP\0'
+snapshotVersion = 1
+# Magic, version, parts, db size, db mtime, wal size, wal mtime, default manufacturer, part, source and string table offsets
+snapshotHeader = struct.Struct('<8sIIqqqqIIII')
+# Part number, description, index of the first source
+snapshotPart = struct.Struct('<III')
+# Manufacturer name, manufacturer part number
+snapshotSource = struct.Struct('<II')
+snapshotLength = struct.Struct('<I')
+snapshotNone = 0xFFFFFFFF
+
+
+def db_options(config):
+    """
+    Return the SQLite connection settings from a configuration file
+    :param config: ConfigParser object
+    :return: Dictionary of settings from the [database] section. Empty if there is no such section.
+    """
+    if not config.has_section('database'):
+        return {}
+    return dict(config.items('database'))
+
+
+def apply_pragmas(conn, options):
+    """
+    Apply the connection settings in connectionPragmas to an open connection.
+    Settings which aren't in connectionPragmas are ignored.
+    :param conn: Database connection
+    :param options: Dictionary of settings as returned by db_options()
+    :return: N/A
+    """
+    for (name, allowed) in connectionPragmas.items():
+        value = options.get(name)
+        if value is None or value == '':
+            continue
+        # PRAGMA values can't be bound as parameters, so only let through values known to be valid
+        if allowed is int:
+            try:
+                value = int(value)
+            except ValueError:
+                raise(ValueError('Database setting {} must be a number, not {}'.format(name, value)))
+        else:
+            value = value.lower()
+            if value not in allowed:
+                raise(ValueError('Database setting {} must be one of {}, not {}'.format(name, ', '.join(allowed), value)))
+        conn.execute('PRAGMA {}={}'.format(name, value)).fetchall()
+
+
+def open_db(path, options):
+    """
+    Open the parts database the way the merge scripts do, with SQL tracing if it is turned on
+    :param path: Database file path
+    :param options: Dictionary of settings as returned by db_options(). merge_open picks one of openModes.
+    :return: Database connection
+    """
+    mode = options.get('merge_open', 'rw').lower()
+    if mode not in openModes:
+        raise(ValueError('Database setting merge_open must be one of {}, not {}'.format(', '.join(openModes), mode)))
+    sqltrace.setup(options)
+    if mode == 'rw':
+        conn = sqltrace.connect(path)
+    else:
+        uri = 'file:' + urllib.request.pathname2url(os.path.abspath(path))
+        uri += '?immutable=1' if mode == 'immutable' else '?mode=ro'
+        conn = sqltrace.connect(uri, uri=True)
+        # The journal mode can't be changed without write access
+        options = {k: v for (k, v) in options.items() if k != 'journal_mode'}
+    try:
+        apply_pragmas(conn, options)
+    except (ValueError, sqlite3.Error):
+        conn.close()
+        raise
+    return conn
+
+
+def db_stamp(path):
+    """
+    Return the sizes and modification times of a database file and its WAL file.
+    An empty WAL file counts as missing, as SQLite creates and deletes them as connections come and go.
+    :param path: Database file path
+    :return: List of database size, database mtime in ns, WAL size and WAL mtime in ns
+    """
+    stamp = []
+    for name in [path, path + '-wal']:
+        try:
+            st = os.stat(name)
+        except OSError:
+            st = None
+        if st is not None and st.st_size:
+            stamp += [st.st_size, st.st_mtime_ns]
+        else:
+            stamp += [0, 0]
+    return stamp
+
+
+def snapshot_path(dbpath, options):
+    """
+    Return the path of the lookup snapshot for a database
+    :param dbpath: Database file path
+    :param options: Settings from the [database] section of the config file (see db_options())
+    :return: Snapshot file path. The default is the database path with .snap added. 'off' if turned off.
+    """
+    return os.path.expanduser(options.get('snapshot', dbpath + '.snap'))
+
+
+def write_snapshot(conn, dbpath, snappath):
+    """
+    Write a lookup snapshot of every part number, description and ordered list of sources.
+    The file is written under a temporary name and renamed, so readers never see a partial snapshot.
+    :param conn: Database connection
+    :param dbpath: Database file path, for the stamp in the header
+    :param snappath: Snapshot file path
+    :return: Number of part numbers written
+    """
+    stamp = db_stamp(dbpath) # Before reading, so changes made while writing make the snapshot stale
+    strings = bytearray()
+    refs = {}
+
+    def ref(s):
+        if s is None:
+            return snapshotNone
+        if s not in refs:
+            refs[s] = len(strings)
+            data = s.encode('utf-8')
+            strings.extend(snapshotLength.pack(len(data)) + data)
+        return refs[s]
+
+    cur = conn.cursor()
+    cur.execute('SELECT MFGName FROM mlist WHERE MFGId=?', ['M0000000'])
+    res = cur.fetchone()
+    defmfg = ref(res[0] if res is not None else None)
+    cur.execute('SELECT PartNumber,Description FROM pndesc WHERE PartNumber IS NOT NULL')
+    descs = dict(cur.fetchall())
+    sources = {}
+    cur.execute('SELECT p.PartNumber,m.MFGName,p.MPN FROM pnmpn p LEFT JOIN mlist m ON m.MFGId = p.Manufacturer '
+                'WHERE p.PartNumber IS NOT NULL ORDER BY p.rowid')
+    for (pn, mname, mpn) in cur:
+        sources.setdefault(pn, []).append((mname, mpn))
+    pns = sorted(set(descs) | set(sources), key=lambda pn: pn.encode('utf-8'))
+
+    parttable = bytearray()
+    sourcetable = bytearray()
+    count = 0
+    for pn in pns:
+        parttable.extend(snapshotPart.pack(ref(pn), ref(descs.get(pn)), count))
+        for (mname, mpn) in sources.get(pn, []):
+            sourcetable.extend(snapshotSource.pack(ref(mname), ref(mpn)))
+            count += 1
+    parttable.extend(snapshotPart.pack(snapshotNone, snapshotNone, count))
+
+    partoffset = snapshotHeader.size
+    sourceoffset = partoffset + len(parttable)
+    stringoffset = sourceoffset + len(sourcetable)
+    tmppath = snappath + '.tmp'
+    with open(tmppath, 'wb') as f:
+        f.write(snapshotHeader.pack(snapshotMagic, snapshotVersion, len(pns), *stamp, defmfg,
+                                    partoffset, sourceoffset, stringoffset))
+        f.write(parttable)
+        f.write(sourcetable)
+        f.write(strings)
+    os.replace(tmppath, snappath)
+    return len(pns)
+
+
+class Snapshot:
+    """
+    Memory mapped lookup snapshot, searched with a binary search on the part number
+    """
+    def __init__(self, snappath, dbpath):
+        """
+        Open a lookup snapshot
+        :param snappath: Snapshot file path
+        :param dbpath: Path of the database the snapshot was written from
+        :return: N/A. Raises ValueError if the snapshot is truncated, in an unknown format or out of date.
+        """
+        with open(snappath, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < snapshotHeader.size:
+            raise(ValueError('Snapshot is truncated'))
+        header = snapshotHeader.unpack_from(self.map, 0)
+        if header[0] != snapshotMagic or header[1] != snapshotVersion:
+            raise(ValueError('Unknown snapshot format'))
+        if list(header[3:7]) != db_stamp(dbpath):
+            raise(ValueError('Snapshot is out of date'))
+        (self.count, self.defmfg, self.partoffset, self.sourceoffset, self.stringoffset) = (header[2],) + header[7:]
+
+    def _string(self, offset):
+        if offset == snapshotNone:
+            return None
+        return self._rawstring(offset).decode('utf-8')
+
+    def _rawstring(self, offset):
+        start = self.stringoffset + offset
+        length = snapshotLength.unpack_from(self.map, start)[0]
+        start += snapshotLength.size
+        return self.map[start:start + length]
+
+    def _find(self, pn):
+        """
+        Find a part number in the part table
+        :param pn: Part number
+        :return: Tuple of the index and the unpacked part table entry, or None if not found
+        """
+        key = pn.encode('utf-8')
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            midkey = self._rawstring(snapshotPart.unpack_from(self.map, self.partoffset + mid * snapshotPart.size)[0])
+            if midkey < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            part = snapshotPart.unpack_from(self.map, self.partoffset + lo * snapshotPart.size)
+            if self._rawstring(part[0]) == key:
+                return (lo, part)
+        return None
+
+    def description(self, pn):
+        """
+        Look up the description of a part number
+        :param pn: Part number
+        :return: Description, or None if the part number isn't in the snapshot
+        """
+        res = self._find(pn)
+        return self._string(res[1][1]) if res is not None else None
+
+    def sources(self, pn):
+        """
+        Look up the sources of a part number
+        :param pn: Part number
+        :return: List of (manufacturer name, manufacturer part number) tuples in database order
+        """
+        res = self._find(pn)
+        if res is None:
+            return []
+        first = res[1][2]
+        last = snapshotPart.unpack_from(self.map, self.partoffset + (res[0] + 1) * snapshotPart.size)[2]
+        return [tuple(self._string(s) for s in snapshotSource.unpack_from(self.map, self.sourceoffset + i * snapshotSource.size))
+                for i in range(first, last)]
+
+    def default_mfgr(self):
+        """
+        :return: Name of the default manufacturer (M0000000), or None if there isn't one
+        """
+        return self._string(self.defmfg)
+
+
+def open_snapshot(snappath, dbpath):
+    """
+    Open a lookup snapshot if it can be used
+    :param snappath: Snapshot file path
+    :param dbpath: Path of the database the snapshot was written from
+    :return: Snapshot object, or None if the snapshot is missing, unreadable or out of date
+    """
+    try:
+        return Snapshot(snappath, dbpath)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def open_lookup(dbpath, options):
+    """
+    Open what the merge scripts look parts up in: the lookup snapshot if it is up to date, otherwise the
+    database, writing a new snapshot for the next run. snapshot = off in the options turns the snapshot off.
+    Which one is used is printed as an Info line.
+    :param dbpath: Database file path
+    :param options: Settings from the [database] section of the config file (see db_options())
+    :return: Tuple containing (snapshot, connection), only one of which is not None.
+    Raises ValueError or sqlite3.Error if the database can't be opened.
+    """
+    snappath = snapshot_path(dbpath, options)
+    if snappath != 'off':
+        snapshot = open_snapshot(snappath, dbpath)
+        if snapshot is not None:
+            print('Info: Using lookup snapshot {}'.format(snappath))
+            return (snapshot, None)
+    conn = open_db(dbpath, options)
+    if snappath != 'off':
+        try:
+            write_snapshot(conn, dbpath, snappath)
+            print('Info: Wrote lookup snapshot {}'.format(snappath))
+        except OSError as e:
+            print('Warning: could not write lookup snapshot {}: {}'.format(snappath, e))
+    return (None, conn)
@@ -8,7 +8,7 @@ setup(
     author='srodgers',
     author_email='steve_at_rodgers619_dot_com',
     description='A bill of materials manager to manage electronic parts',
-    scripts=['bommgr.py', 'bomcost.py', 'partmgr.py', 'bommdb.py'],
+    scripts=['bommgr.py', 'bomcost.py', 'partmgr.py', 'bommdb.py', 'partsdb.py', 'sqltrace.py'],
     requires=['argparse', 'sqlite3', 'configparser', 'tkinter', 'tkinter.ttk',
               'csv', 'json', 'urllib3', 'urllib.parse', 'decimal', 'pyperclip']
 )
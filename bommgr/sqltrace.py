@@ -0,0 +1,283 @@
+__author__ = 'srodgers'
+"""
+    This file is part of BOMtools.
+
+    BOMtools is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    BOMTools is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with BOMTools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+#
+# Optional SQL statement tracing for the BOMTools scripts.
+#
+# Tracing is turned on with trace= in the [database] section of bommgr.conf, or with the BOMMGR_TRACE
+# environment variable, which takes precedence. The value is stderr to print a report when the program
+# exits, or the path of a JSON file to write the report to. trace_slow_ms (or BOMMGR_TRACE_SLOW_MS) sets
+# the time above which a statement is listed as slow, 100ms by default.
+#
+# Connections opened with connect() while tracing is on record the text, caller, row count and elapsed
+# time of every statement. Time spent fetching rows counts towards the statement which returned them.
+#
+
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+envTrace = 'BOMMGR_TRACE'
+envSlow = 'BOMMGR_TRACE_SLOW_MS'
+defaultSlowMs = 100.0
+# Most slow statements kept for the report
+maxSlow = 100
+
+tracer = None
+
+
+class Tracer:
+    """
+    Collects per statement timings from tracing connections and reports them at exit
+    """
+    def __init__(self, output, slow_ms):
+        """
+        :param output: stderr, or the path of a JSON file to write
+        :param slow_ms: Statements taking longer than this many milliseconds are listed as slow
+        """
+        self.output = output
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.slow = []
+        self.started = time.time()
+
+    def record(self, sql, caller, rows, elapsed, done):
+        """
+        Add the time spent on a statement. Called once when it is run and once for each fetch.
+        :param sql: Statement text
+        :param caller: Where the statement was run from
+        :param rows: Rows returned or changed since the last call
+        :param elapsed: Seconds spent since the last call
+        :param done: Total seconds for this run of the statement if it has finished, otherwise None
+        :return: N/A
+        """
+        with self.lock:
+            stat = self.stats.get((sql, caller))
+            if stat is None:
+                stat = self.stats[(sql, caller)] = {'count': 0, 'rows': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            stat['rows'] += rows
+            stat['seconds'] += elapsed
+            if done is not None:
+                stat['count'] += 1
+                stat['max_seconds'] = max(stat['max_seconds'], done)
+                if done * 1000 >= self.slow_ms:
+                    self.slow.append({'sql': sql, 'caller': caller, 'ms': round(done * 1000, 3),
+                                      'at': round(time.time() - self.started, 3)})
+                    self.slow.sort(key=lambda item: -item['ms'])
+                    del self.slow[maxSlow:]
+
+    def report(self):
+        """
+        Return the report as a dictionary
+        """
+        with self.lock:
+            statements = [{'sql': sql, 'caller': caller, 'count': stat['count'], 'rows': stat['rows'],
+                           'total_ms': round(stat['seconds'] * 1000, 3),
+                           'mean_ms': round(stat['seconds'] * 1000 / max(stat['count'], 1), 3),
+                           'max_ms': round(stat['max_seconds'] * 1000, 3)}
+                          for ((sql, caller), stat) in self.stats.items()]
+            slow = list(self.slow)
+        statements.sort(key=lambda item: -item['total_ms'])
+        return {'program': os.path.basename(sys.argv[0]), 'seconds': round(time.time() - self.started, 3),
+                'slow_ms': self.slow_ms, 'statements': statements, 'slow': slow}
+
+    def write_report(self):
+        """
+        Print the report on stderr, or write it to the JSON file
+        """
+        report = self.report()
+        if self.output != 'stderr':
+            try:
+                with open(os.path.expanduser(self.output), 'w') as f:
+                    json.dump(report, f, indent=2)
+            except OSError as e:
+                print('Warning: could not write SQL trace {}: {}'.format(self.output, e), file=sys.stderr)
+            return
+        out = sys.stderr
+        print('SQL trace for {}, {:.1f} seconds'.format(report['program'], report['seconds']), file=out)
+        print('{0:>8}  {1:>8}  {2:>10}  {3:>9}  {4:>9}  {5:<40}  {6}'.format(
+            'Count', 'Rows', 'Total ms', 'Mean ms', 'Max ms', 'Caller', 'Statement'), file=out)
+        for item in report['statements']:
+            print('{0:>8}  {1:>8}  {2:>10.1f}  {3:>9.2f}  {4:>9.2f}  {5:<40}  {6}'.format(
+                item['count'], item['rows'], item['total_ms'], item['mean_ms'], item['max_ms'],
+                item['caller'], shorten(item['sql'])), file=out)
+        if report['slow']:
+            print('Statements slower than {}ms:'.format(report['slow_ms']), file=out)
+            for item in report['slow']:
+                print('{0:>10.1f}  {1:<40}  {2}'.format(item['ms'], item['caller'], shorten(item['sql'])), file=out)
+
+
+def shorten(sql, width=100):
+    """
+    Put a statement on one line and cut it short for the text report
+    """
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= width else sql[:width - 3] + '...'
+
+
+def caller():
+    """
+    Return where the statement being traced was run from, as file:function:line
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+    return '{}:{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name, frame.f_lineno)
+
+
+class TracingCursor(sqlite3.Cursor):
+    """
+    Cursor which reports each statement and the rows fetched from it to the tracer
+    """
+    _trace = None
+
+    def _finish(self):
+        # Count the statement run before, if it hadn't returned all of its rows
+        if self._trace is not None and tracer is not None:
+            (sql, where, total) = self._trace
+            self._trace = None
+            tracer.record(sql, where, 0, 0.0, total)
+
+    def _run(self, method, sql, args):
+        self._finish()
+        where = caller()
+        start = time.perf_counter()
+        try:
+            method(self, sql, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.description is None:
+                # Nothing to fetch, the statement is done
+                tracer.record(sql, where, max(self.rowcount, 0), elapsed, elapsed)
+            else:
+                tracer.record(sql, where, 0, elapsed, None)
+                self._trace = (sql, where, elapsed)
+        return self
+
+    def _fetched(self, start, rows, exhausted):
+        if self._trace is None:
+            return
+        elapsed = time.perf_counter() - start
+        (sql, where, total) = self._trace
+        total += elapsed
+        if exhausted:
+            self._trace = None
+            tracer.record(sql, where, rows, elapsed, total)
+        else:
+            self._trace = (sql, where, total)
+            tracer.record(sql, where, rows, elapsed, None)
+
+    def execute(self, sql, *args):
+        return self._run(sqlite3.Cursor.execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self._run(sqlite3.Cursor.executemany, sql, args)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = sqlite3.Cursor.fetchone(self)
+        self._fetched(start, 0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchmany(self, *args)
+        self._fetched(start, len(rows), len(rows) == 0)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchall(self)
+        self._fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = sqlite3.Cursor.__next__(self)
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+        self._fetched(start, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        self._finish()
+
+
+class TracingConnection(sqlite3.Connection):
+    """
+    Connection whose cursors are traced, including the ones made by the execute() shortcuts
+    """
+    def cursor(self, factory=TracingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+
+def setup(options=None):
+    """
+    Turn tracing on if the environment or the [database] settings ask for it.
+    The first call which turns it on decides where the report goes.
+    :param options: Settings from the [database] section of the config file
+    :return: The tracer, or None if tracing is off
+    """
+    global tracer
+    if tracer is not None:
+        return tracer
+    options = options or {}
+    output = os.environ.get(envTrace) or options.get('trace', '')
+    if output in ['', 'off']:
+        return None
+    try:
+        slow_ms = float(os.environ.get(envSlow) or options.get('trace_slow_ms', defaultSlowMs))
+    except ValueError:
+        slow_ms = defaultSlowMs
+    tracer = Tracer(output, slow_ms)
+    atexit.register(tracer.write_report)
+    return tracer
+
+
+def connect(*args, **kwargs):
+    """
+    Same as sqlite3.connect(), but returns a traced connection when tracing is on
+    """
+    if tracer is not None and 'factory' not in kwargs:
+        kwargs['factory'] = TracingConnection
+    return sqlite3.connect(*args, **kwargs)
+
+
+if __name__ == '__main__':
+    print ("SQL tracing module for BOMTools, not meant to be run on its own")
+    exit(1)
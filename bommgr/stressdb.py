@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+    This file is part of BOMtools.
+
+    BOMtools is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    BOMTools is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with BOMTools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'srodgers'
+
+#
+# Stress test for sharing one BOMdb object between threads.
+#
+# Many threads hammer the lookups on a shared BOMdb object while one thread changes titles.
+# With --async, many coroutines do the same through one AsyncBOMdb object instead, and the
+# event loop is checked for stalls.
+# Every result is checked, and the exit status is 1 if anything came back wrong.
+#
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import bommdb
+from benchconn import makedb
+
+
+def pnfor(i):
+    return '{:06d}-101'.format(800000 + i)
+
+
+def lookups(db, numparts, seconds, counts, errors):
+    """
+    Run a mix of lookups until time runs out
+    """
+    done = 0
+    end = time.monotonic() + seconds
+    try:
+        while time.monotonic() < end:
+            i = random.randrange(numparts)
+            pn = pnfor(i)
+            res = db.lookup_pn(pn)
+            if res is None or res[0] != pn or not res[1].startswith('PART {}'.format(i)):
+                errors.append('lookup_pn({}) returned {}'.format(pn, res))
+            sources = db.lookup_mpn_by_pn(pn)
+            if len(sources) != 1 or sources[0]['mpn'] != 'MPN{}'.format(i):
+                errors.append('lookup_mpn_by_pn({}) returned {}'.format(pn, sources))
+            if db.lookup_mfg_by_id('M0000000') != ('Open Market', 'M0000000'):
+                errors.append('lookup_mfg_by_id returned the wrong manufacturer')
+            # Nested use: stream some parts while making other lookups
+            for (spn, desc, ssources) in db.get_parts_with_sources('PART {}%'.format(i)):
+                if db.lookup_pn(spn) is None:
+                    errors.append('lookup_pn({}) failed while streaming parts'.format(spn))
+            done += 1
+    except Exception as e:
+        errors.append('{}: {}'.format(type(e).__name__, e))
+    counts.append(done)
+
+
+def writer(db, numparts, stop, errors):
+    """
+    Change titles until told to stop, checking each change is seen by the writing thread
+    """
+    rev = 0
+    try:
+        while not stop.is_set():
+            i = random.randrange(numparts)
+            title = 'PART {} REV {}'.format(i, rev)
+            db.update_title(pnfor(i), title)
+            if db.lookup_pn(pnfor(i))[1] != title:
+                errors.append('Title change to {} not seen by the writer'.format(pnfor(i)))
+            rev += 1
+    except Exception as e:
+        errors.append('{}: {}'.format(type(e).__name__, e))
+
+
+def run(path, cache, numparts, numthreads, seconds):
+    """
+    Run the stress test on one BOMdb object
+    :return: Tuple containing (operations per second, list of errors)
+    """
+    db = bommdb.BOMdb(path, cache=cache, options={'journal_mode': 'wal', 'busy_timeout': '10000'})
+    counts = []
+    errors = []
+    stop = threading.Event()
+    wthread = threading.Thread(target=writer, args=(db, numparts, stop, errors))
+    threads = [threading.Thread(target=lookups, args=(db, numparts, seconds, counts, errors))
+               for i in range(numthreads)]
+    wthread.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    wthread.join()
+    db.close()
+    return (sum(counts) / seconds, errors)
+
+
+async def async_lookups(adb, numparts, seconds, counts, errors):
+    """
+    Coroutine version of lookups()
+    """
+    done = 0
+    end = time.monotonic() + seconds
+    try:
+        while time.monotonic() < end:
+            i = random.randrange(numparts)
+            pn = pnfor(i)
+            (res, sources) = await asyncio.gather(adb.lookup_pn(pn), adb.lookup_mpn_by_pn(pn))
+            if res is None or res[0] != pn or not res[1].startswith('PART {}'.format(i)):
+                errors.append('lookup_pn({}) returned {}'.format(pn, res))
+            if len(sources) != 1 or sources[0]['mpn'] != 'MPN{}'.format(i):
+                errors.append('lookup_mpn_by_pn({}) returned {}'.format(pn, sources))
+            async for (spn, desc, ssources) in adb.get_parts_with_sources('PART {}%'.format(i)):
+                if await adb.lookup_pn(spn) is None:
+                    errors.append('lookup_pn({}) failed while streaming parts'.format(spn))
+            done += 1
+    except Exception as e:
+        errors.append('{}: {}'.format(type(e).__name__, e))
+    counts.append(done)
+
+
+async def async_writer(adb, numparts, stop, errors):
+    """
+    Coroutine version of writer(). Every other change is made in a transaction block, half of which roll back.
+    """
+    rev = 0
+    try:
+        while not stop.is_set():
+            i = random.randrange(numparts)
+            pn = pnfor(i)
+            title = 'PART {} REV {}'.format(i, rev)
+            if rev % 2:
+                await adb.update_title(pn, title)
+            else:
+                old = (await adb.lookup_pn(pn))[1]
+                rollback = rev % 4 == 0
+                try:
+                    async with adb.transaction():
+                        await adb.update_title(pn, title)
+                        if (await adb.lookup_pn(pn))[1] != title:
+                            errors.append('Title change to {} not seen inside the transaction'.format(pn))
+                        if rollback:
+                            raise KeyError(pn)
+                except KeyError:
+                    title = old
+            if (await adb.lookup_pn(pn))[1] != title:
+                errors.append('Title of {} is not {} after the change'.format(pn, title))
+            rev += 1
+            await asyncio.sleep(0)
+    except Exception as e:
+        errors.append('{}: {}'.format(type(e).__name__, e))
+
+
+async def ticker(stop, lags):
+    """
+    Measure how late the event loop wakes up from short sleeps
+    """
+    while not stop.is_set():
+        start = time.monotonic()
+        await asyncio.sleep(0.01)
+        lags.append(time.monotonic() - start - 0.01)
+
+
+async def run_async(path, cache, numparts, numtasks, seconds):
+    """
+    Run the stress test on one AsyncBOMdb object
+    :return: Tuple containing (operations per second, list of errors)
+    """
+    adb = bommdb.AsyncBOMdb(path, cache=cache, options={'journal_mode': 'wal', 'busy_timeout': '10000'}, workers=4)
+    counts = []
+    errors = []
+    lags = []
+    stop = asyncio.Event()
+    background = [asyncio.ensure_future(async_writer(adb, numparts, stop, errors)),
+                  asyncio.ensure_future(ticker(stop, lags))]
+    await asyncio.gather(*[async_lookups(adb, numparts, seconds, counts, errors) for i in range(numtasks)])
+    stop.set()
+    await asyncio.gather(*background)
+    await adb.close()
+    if max(lags, default=0) > 0.1:
+        errors.append('Event loop stalled for {:.0f}ms'.format(max(lags) * 1000))
+    return (sum(counts) / seconds, errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BOMdb thread stress test', prog='stressdb.py')
+    parser.add_argument('--parts', type=int, default=5000, help='Number of part numbers in the test database')
+    parser.add_argument('--threads', type=int, default=16, help='Number of lookup threads, or coroutines with --async')
+    parser.add_argument('--seconds', type=float, default=5.0, help='Seconds to run with and without the cache')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Test AsyncBOMdb with coroutines instead of threads')
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'stress.db')
+        makedb(path, args.parts)
+        for cache in [False, True]:
+            if args.use_async:
+                (rate, errors) = asyncio.run(run_async(path, cache, args.parts, args.threads, args.seconds))
+            else:
+                (rate, errors) = run(path, cache, args.parts, args.threads, args.seconds)
+            print('Cache {:<5}  {:>10.0f} operations/sec  {:>6d} errors'.format(str(cache), rate, len(errors)))
+            for error in errors[:10]:
+                print('    ' + error)
+            failed = failed or len(errors) > 0
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+    This file is part of BOMtools.
+
+    BOMtools is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    BOMTools is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with BOMTools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'srodgers'
+
+#
+# Build a synthetic parts database for benchmarking.
+#
+# The database is created by gendb.py, so it has the same schema as a real one, then filled through
+# the BOMdb bulk methods. Part numbers are mostly single, with some tabulated families (-101, -102, ...).
+# Most parts have one source, some have up to four. A few manufacturers supply most of the sources,
+# the same as a real parts list, and most sources have a datasheet.
+#
+
+import argparse
+import itertools
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import bommdb
+
+# Sizes which may be given by name
+sizes = {'1k': 1000, '10k': 10000, '100k': 100000, '1M': 1000000}
+
+# Manufacturers with the most parts come first
+mfgrNames = ['Yageo', 'Murata', 'Vishay', 'Texas Instruments', 'TDK', 'Samsung Electro-Mechanics', 'Kemet',
+             'Panasonic', 'Analog Devices', 'Microchip', 'ON Semiconductor', 'STMicroelectronics', 'NXP',
+             'Bourns', 'Molex', 'TE Connectivity', 'Nexperia', 'Diodes Inc', 'Wurth Elektronik', 'Infineon',
+             'Maxim Integrated', 'Littelfuse', 'Coilcraft', 'Amphenol', 'Rohm', 'KOA Speer', 'AVX',
+             'Renesas', 'Toshiba', 'Lite-On']
+
+# Number of sources for a part and how often it occurs
+sourceCounts = [1, 2, 3, 4]
+sourceWeights = [60, 25, 10, 5]
+
+resistorValues = ['10', '22', '47', '100', '220', '470', '1K', '2.2K', '4.7K', '10K', '22K', '47K', '100K', '1M']
+capacitorValues = ['10P', '22P', '100P', '1N', '10N', '100N', '1U', '4.7U', '10U', '22U']
+packages = ['0402', '0603', '0805', '1206']
+
+
+def part_descriptions(rnd):
+    """
+    Return a family of descriptions for one part number prefix, one for each tabulated suffix
+    """
+    kind = rnd.random()
+    if kind < 0.35:
+        base = 'RES,{},{}'.format(rnd.choice(resistorValues), rnd.choice(packages))
+        variants = ['1%', '5%', '0.1%']
+    elif kind < 0.65:
+        base = 'CAP,{},{},{}'.format(rnd.choice(capacitorValues), rnd.choice(packages), rnd.choice(['X7R', 'X5R', 'C0G']))
+        variants = ['16V', '25V', '50V']
+    elif kind < 0.8:
+        base = 'IC,{},{}'.format(rnd.choice(['OPAMP,DUAL', 'LDO,3.3V', 'MCU,32 BIT', 'EEPROM,64K', 'BUCK CONV']),
+                                 rnd.choice(['SOIC8', 'SOT23-5', 'QFN32', 'TSSOP14']))
+        variants = ['COMMERCIAL', 'INDUSTRIAL', 'AUTOMOTIVE']
+    elif kind < 0.9:
+        base = 'CONN,HEADER,{} POS,{}'.format(rnd.randint(2, 40), rnd.choice(['2.54MM', '1.27MM', '2MM']))
+        variants = ['VERT', 'RA', 'SMD']
+    else:
+        base = 'DIODE,{},{}'.format(rnd.choice(['SCHOTTKY', 'TVS', 'ZENER', 'SIGNAL']), rnd.choice(['SOD123', 'SMA', 'SOT23']))
+        variants = ['1A', '2A', '3A']
+    # Most part numbers stand alone, some are tabulated families
+    count = 1 if rnd.random() < 0.85 else rnd.randint(2, len(variants))
+    return ['{},{}'.format(base, variant) for variant in variants[:count]]
+
+
+def generate(dbpath, numparts, seed=1):
+    """
+    Create and fill a synthetic parts database
+    :param dbpath: Database file to create. It must not exist.
+    :param numparts: Number of part numbers
+    :param seed: Random seed, the same seed always gives the same database
+    :return: Tuple containing (part numbers, sources, manufacturers)
+    """
+    rnd = random.Random(seed)
+    gendb = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gendb.py')
+    subprocess.check_call([sys.executable, gendb, os.path.abspath(dbpath)])
+
+    # Skewed manufacturer sizes: the n'th manufacturer supplies about 1/n as many parts as the first
+    nummfgrs = max(len(mfgrNames), numparts // 200)
+    mfgrs = [(mfgrNames[i] if i < len(mfgrNames) else 'Manufacturer {}'.format(i + 1), 'M{:07d}'.format(i + 1))
+             for i in range(nummfgrs)]
+    mids = ['M0000000'] + [mid for (name, mid) in mfgrs]
+    # Each manufacturer's MPNs start with the same letters
+    codes = ['GEN'] + [re.sub(r'\W', '', name).upper()[:3] for (name, mid) in mfgrs]
+    weights = list(itertools.accumulate([0.5] + [1.0 / (i + 1) for i in range(nummfgrs)]))
+
+    parts = []
+    sources = []
+    datasheets = []
+    prefix = 100000
+    while len(parts) < numparts:
+        if prefix > 999999:
+            raise(ValueError('Too many part numbers for six digit prefixes'))
+        for (suffix, desc) in enumerate(part_descriptions(rnd)[:numparts - len(parts)]):
+            pn = '{:06d}-{}'.format(prefix, 101 + suffix)
+            parts.append((pn, desc))
+            count = rnd.choices(sourceCounts, sourceWeights)[0]
+            chosen = []
+            while len(chosen) < count:
+                i = rnd.choices(range(len(mids)), cum_weights=weights)[0]
+                if i not in chosen:
+                    chosen.append(i)
+            for i in chosen:
+                mid = mids[i]
+                mpn = '{}{}-{:04d}{}'.format(codes[i], desc.split(',')[0][:3], len(sources), rnd.choice('ABTRXZ'))
+                sources.append((pn, mid, mpn))
+                if rnd.random() < 0.7:
+                    datasheets.append(('datasheets/{}/{}.pdf'.format(mid, mpn.lower()), pn, mpn))
+        prefix += 1
+
+    db = bommdb.BOMdb(dbpath)
+    with db.transaction():
+        db.add_mfgs_to_mlist(mfgrs)
+        # Sources first, so adding the part numbers builds the search index with their MPNs in one pass
+        db.add_mpns(sources)
+        db.add_pns(parts)
+        db.conn.executemany('UPDATE pnmpn SET DataSheet=? WHERE PartNumber=? AND MPN=?', datasheets)
+    db.conn.execute('ANALYZE')
+    db.close()
+    return (len(parts), len(sources), len(mfgrs) + 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic parts database generator', prog='synthdb.py')
+    parser.add_argument('--parts', default='10k', help='Number of part numbers, or one of ' + ', '.join(sizes))
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('dbpath', help='Database file to create')
+    args = parser.parse_args()
+
+    try:
+        numparts = sizes.get(args.parts) or int(args.parts)
+    except ValueError:
+        print('Error: --parts must be a number or one of {}'.format(', '.join(sizes)))
+        sys.exit(2)
+    if os.path.exists(args.dbpath):
+        print('Error: file {} exists'.format(args.dbpath))
+        sys.exit(2)
+
+    start = time.time()
+    (numparts, numsources, nummfgrs) = generate(args.dbpath, numparts, args.seed)
+    print('Created {} with {} part numbers, {} sources and {} manufacturers in {:.1f} seconds'.format(
+        args.dbpath, numparts, numsources, nummfgrs, time.time() - start))
+
+    sys.exit(0)
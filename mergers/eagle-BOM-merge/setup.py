@@ -10,5 +10,5 @@ setup(
     author_email='steve_at_rodgers619_dot_com',
     description='A bill of materials merge utility for Eagle EDA',
     scripts=['bommerge-eagle.py'],
-    requires=['argparse', 'sqlite3', 'configparser','csv']
+    requires=['argparse', 'sqlite3', 'configparser','csv','partsdb']
 )
\ No newline at end of file
@@ -41,6 +41,12 @@ import csv
 import sys
 import os
 import sqlite3
+try:
+    # partsdb.py is installed with bommgr, and opens the database and the lookup snapshot
+    import partsdb
+except ImportError:
+    print('Error: partsdb.py from bommgr must be on the Python path, install bommgr first')
+    sys.exit(1)
 import configparser
 import argparse
 
@@ -87,6 +93,9 @@ def getdescr(pn):
     global unk
     if len(pn) == 0 :
         return pn
+    if snapshot is not None:
+        res = snapshot.description(pn)
+        return res if res is not None else unk
     cur.execute('SELECT Description FROM pndesc WHERE PartNumber=?', [pn])
     res = cur.fetchone()
 
@@ -120,6 +129,12 @@ def getmfginfo(pn):
     if len(pn) == 0 :
         return res
 
+    if snapshot is not None:
+        info = snapshot.sources(pn)
+        if len(info):
+            res = [{'MFG': mname if mname is not None else defaultMfgr, 'MPN': mpn} for (mname, mpn) in info]
+        return res
+
     cur.execute('SELECT Manufacturer,MPN FROM pnmpn WHERE PartNumber=?', [pn])
     info = cur.fetchall()
 
@@ -445,6 +460,11 @@ try:
 except configparser.NoSectionError:
     configdict['merge']={}
 
+try:
+    configdict['database'] = dict(Config.items("database"))
+except configparser.NoSectionError:
+    configdict['database']={}
+
 # Get list of ignored reference designators if it exists
 ignoredrefs = []
 if 'ignorerefs' in configdict['merge']:
@@ -477,13 +497,22 @@ infile = args.infile
 outfile = args.outfile
 
 
-# Set up the database connection
-conn = sqlite3.connect(dbpath)
-cur = conn.cursor()
+# Use the lookup snapshot if it is up to date. Otherwise set up the database connection and
+# rebuild the snapshot for next time. snapshot = off in the [database] section turns this off.
+try:
+    (snapshot, conn) = partsdb.open_lookup(dbpath, configdict['database'])
+except (ValueError, sqlite3.Error) as e:
+    print('Error: {}'.format(e))
+    sys.exit(1)
+if conn is not None:
+    cur = conn.cursor()
 
 
 # Get the default manufacturer from the database
-defaultMfgr = getmfgr('M0000000')
+if snapshot is not None:
+    defaultMfgr = snapshot.default_mfgr()
+else:
+    defaultMfgr = getmfgr('M0000000')
 if defaultMfgr is None:
     defaultMfgr = 'Default MFG Error'
 
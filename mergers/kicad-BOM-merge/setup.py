@@ -10,5 +10,5 @@ setup(
     author_email='steve_at_rodgers619_dot_com',
     description='A bill of materials merge utility for Kicad EDA',
     scripts=['bommerge.py'],
-    requires=['argparse', 'sqlite3', 'ConfigParser','csv','kicad_netlist_reader']
+    requires=['argparse', 'sqlite3', 'ConfigParser','csv','kicad_netlist_reader','partsdb']
 )
\ No newline at end of file